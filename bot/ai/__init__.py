@@ -1,2 +1,8 @@
+from . import cache
 from . import chat
+from . import clients
 from . import images
+from . import ratelimit
+from . import retry
+from . import router
+from . import tokens
@@ -0,0 +1,60 @@
+"""Cache for identical chat completion requests."""
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import time
+from typing import Optional
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+# Cached answers by request key, least recently used first.
+# Each value is an (answer, expires_at) pair.
+_answers: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+
+def key(request: dict) -> Optional[str]:
+    """
+    Returns the cache key for a chat completion request,
+    or None if the request should not be cached.
+    """
+    if not config.completion_cache.enabled:
+        return None
+    # non-zero temperature means the model is expected to answer differently
+    # every time, so such requests are not cached unless explicitly allowed
+    # (the provider default temperature is not zero)
+    temperature = request.get("temperature", 1)
+    if temperature and not config.completion_cache.allow_random:
+        return None
+    data = json.dumps(request, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def get(key: Optional[str]) -> Optional[str]:
+    """Returns the cached answer for the key (if any)."""
+    if key is None or key not in _answers:
+        return None
+    answer, expires_at = _answers[key]
+    if expires_at <= time.time():
+        del _answers[key]
+        return None
+    _answers.move_to_end(key)
+    logger.debug("completion cache hit: key=%s", key)
+    return answer
+
+
+def put(key: Optional[str], answer: str) -> None:
+    """Caches the answer, evicting the least recently used ones if necessary."""
+    if key is None:
+        return
+    _answers[key] = (answer, time.time() + config.completion_cache.ttl)
+    _answers.move_to_end(key)
+    while len(_answers) > config.completion_cache.size:
+        _answers.popitem(last=False)
+
+
+def clear() -> None:
+    """Removes all cached answers."""
+    _answers.clear()
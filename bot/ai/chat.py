@@ -1,10 +1,22 @@
 """OpenAI-compatible language model."""
 
+import bisect
+import itertools
+import json
 import logging
+import time
+from typing import AsyncIterator, Optional
 import httpx
+from bot import metrics
 from bot.config import config
+from bot.models import MessageTokens
+from . import cache
+from . import clients
+from . import ratelimit
+from . import retry
+from . import router
+from . import tokens
 
-client = httpx.AsyncClient(timeout=60.0)
 logger = logging.getLogger(__name__)
 
 # Known models and their context windows
@@ -41,6 +53,33 @@ MODELS = {
     "gpt-3.5-turbo": 16385,
 }
 
+# Tokenizer encodings for known models.
+# Models not listed here use an estimation based on words.
+ENCODINGS = {
+    # OpenAI
+    "o1": "o200k_base",
+    "o1-mini": "o200k_base",
+    "o1-pro": "o200k_base",
+    "o3": "o200k_base",
+    "o3-mini": "o200k_base",
+    "o4": "o200k_base",
+    "o4-mini": "o200k_base",
+    "gpt-5": "o200k_base",
+    "gpt-5-mini": "o200k_base",
+    "gpt-5-nano": "o200k_base",
+    "gpt-4.1": "o200k_base",
+    "gpt-4.1-mini": "o200k_base",
+    "gpt-4.1-nano": "o200k_base",
+    "gpt-4o": "o200k_base",
+    "gpt-4o-mini": "o200k_base",
+    "gpt-4-turbo": "cl100k_base",
+    "gpt-4-turbo-preview": "cl100k_base",
+    "gpt-4-vision-preview": "cl100k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-4-32k": "cl100k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+}
+
 # Prompt role name overrides.
 ROLE_OVERRIDES = {
     "o1": "user",
@@ -73,36 +112,62 @@ class Model:
     def __init__(self, name: str) -> None:
         """Creates a wrapper for a given OpenAI large language model."""
         self.name = name
+        self.encoding = ENCODINGS.get(name) or tokens.WordEncoder.name
 
-    async def ask(self, prompt: str, question: str, history: list[tuple[str, str]]) -> str:
-        """Asks the language model a question and returns an answer."""
-        model = self.name
-        prompt_role = ROLE_OVERRIDES.get(model) or "system"
-        params_func = PARAM_OVERRIDES.get(model) or (lambda params: params)
+    async def ask(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> str:
+        """
+        Asks the language model a question and returns an answer.
+        `history_tokens` are the known token counts for the history messages (if any).
+        """
+        request, n_prompt = self._prepare_request(prompt, question, history, history_tokens)
+        cache_key = cache.key(request)
+        answer = cache.get(cache_key)
+        if answer is not None:
+            return answer
 
-        n_input = _calc_n_input(model, n_output=config.openai.params["max_tokens"])
-        messages = self._generate_messages(prompt_role, prompt, question, history)
-        messages = shorten(messages, length=n_input)
+        n_estimated = self._estimate_tokens(request, n_prompt)
+        # a request can be sent several times (retries, failover, hedging),
+        # and each attempt reserves tokens until its response is settled
+        limiters: dict[httpx.Response, ratelimit.Limiter] = {}
 
-        params = params_func(config.openai.params)
-        logger.debug(
-            "> chat request: model=%s, params=%s, messages=%s",
-            model,
-            params,
-            messages,
-        )
-        response = await client.post(
-            f"{config.openai.url}/chat/completions",
-            headers={"Authorization": f"Bearer {config.openai.api_key}"},
-            json={
-                "model": model,
-                "messages": messages,
-                **params,
-            },
-        )
+        async def send(endpoint: router.Endpoint) -> httpx.Response:
+            limiter = ratelimit.get(endpoint.url, self.name)
+            await limiter.acquire(n_estimated)
+            try:
+                response = await clients.get(endpoint.url).post(
+                    f"{endpoint.url}/chat/completions",
+                    headers={"Authorization": f"Bearer {endpoint.api_key}"},
+                    json=request,
+                )
+            except BaseException:
+                # failed or cancelled (e.g. the hedged twin has won)
+                limiter.settle(n_estimated, 0)
+                raise
+            limiter.update(response.headers)
+            if response.status_code in retry.RETRYABLE_STATUSES:
+                # a failed attempt does not use the tokens
+                limiter.settle(n_estimated, 0)
+            else:
+                limiters[response] = limiter
+            return response
+
+        response = await router.request(self.name, send, hedge=config.hedging.enabled)
+        limiter = limiters.pop(response, None)
+        for discarded in limiters.values():
+            # the response of the hedged twin nobody is going to read
+            discarded.settle(n_estimated, 0)
         resp = response.json()
         if "usage" not in resp:
+            if limiter:
+                limiter.settle(n_estimated, 0)
             raise Exception(resp)
+        limiter.settle(n_estimated, resp["usage"]["total_tokens"])
         logger.debug(
             "< chat response: prompt_tokens=%s, completion_tokens=%s, total_tokens=%s",
             resp["usage"]["prompt_tokens"],
@@ -110,8 +175,163 @@ class Model:
             resp["usage"]["total_tokens"],
         )
         answer = self._prepare_answer(resp)
+        cache.put(cache_key, answer)
         return answer
 
+    async def ask_stream(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Asks the language model a question
+        and yields parts of the answer as soon as they arrive.
+        """
+        request, n_prompt = self._prepare_request(prompt, question, history, history_tokens)
+        cache_key = cache.key(request)
+        answer = cache.get(cache_key)
+        if answer is not None:
+            yield answer
+            return
+
+        n_estimated = self._estimate_tokens(request, n_prompt)
+        request["stream"] = True
+        # the last chunk reports the tokens used
+        request["stream_options"] = {"include_usage": True}
+        start = time.perf_counter()
+        limiters: dict[httpx.Response, ratelimit.Limiter] = {}
+
+        async def send(endpoint: router.Endpoint) -> httpx.Response:
+            limiter = ratelimit.get(endpoint.url, self.name)
+            await limiter.acquire(n_estimated)
+            client = clients.get(endpoint.url)
+            http_request = client.build_request(
+                "POST",
+                f"{endpoint.url}/chat/completions",
+                headers={"Authorization": f"Bearer {endpoint.api_key}"},
+                json=request,
+            )
+            try:
+                response = await client.send(http_request, stream=True)
+            except BaseException:
+                limiter.settle(n_estimated, 0)
+                raise
+            limiter.update(response.headers)
+            if response.status_code != 200:
+                # a failed attempt does not use the tokens
+                limiter.settle(n_estimated, 0)
+            else:
+                limiters[response] = limiter
+            return response
+
+        # only the request itself is retried, not an interrupted stream
+        response = await router.request(self.name, send)
+        limiter = limiters.pop(response, None)
+        # a failed or abandoned stream is refunded in full
+        n_actual = 0
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(response.json())
+            deltas = []
+            usage = None
+            async for line in response.aiter_lines():
+                chunk = _parse_event(line)
+                if not chunk:
+                    continue
+                usage = chunk.get("usage") or usage
+                delta = _get_delta(chunk)
+                if not delta:
+                    continue
+                if not deltas:
+                    metrics.provider_first_token_seconds.observe(
+                        time.perf_counter() - start, model=self.name
+                    )
+                deltas.append(delta)
+                yield delta
+            if usage:
+                n_actual = usage["total_tokens"]
+            else:
+                # the provider does not report usage for streams
+                n_actual = n_prompt + tokens.count("".join(deltas), self.encoding)
+        finally:
+            await response.aclose()
+            if limiter:
+                limiter.settle(n_estimated, n_actual)
+        logger.debug("< chat response: n_chunks=%s, usage=%s", len(deltas), usage)
+        if not deltas:
+            raise ValueError("received an empty answer")
+        cache.put(cache_key, "".join(deltas).strip())
+
+    def count(self, question: str, answer: str) -> MessageTokens:
+        """Counts tokens in a question and an answer."""
+        return MessageTokens(
+            version=tokens.stamp(self.encoding),
+            question=tokens.count(question, self.encoding),
+            answer=tokens.count(answer, self.encoding),
+        )
+
+    def count_input(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> int:
+        """
+        Counts tokens in the messages sent to the model
+        (the prompt, history and question).
+        """
+        prompt_role = ROLE_OVERRIDES.get(self.name) or "system"
+        messages = self._generate_messages(prompt_role, prompt, question, history)
+        return sum(self._calc_lengths(messages, history_tokens))
+
+    def _prepare_request(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> tuple[dict, int]:
+        """
+        Builds a chat completion request body.
+        Returns the request and the number of tokens in its messages.
+        """
+        model = self.name
+        prompt_role = ROLE_OVERRIDES.get(model) or "system"
+        params_func = PARAM_OVERRIDES.get(model) or (lambda params: params)
+
+        n_input = max_input_tokens(model)
+        messages = self._generate_messages(prompt_role, prompt, question, history)
+        lengths = self._calc_lengths(messages, history_tokens)
+        messages = shorten(messages, length=n_input, encoding=self.encoding, lengths=lengths)
+        # shortened messages fit into (and almost fill) the input limit
+        n_prompt = min(sum(lengths), n_input)
+
+        params = params_func(config.openai.params)
+        logger.debug(
+            "> chat request: model=%s, params=%s, messages=%s",
+            model,
+            params,
+            messages,
+        )
+        request = {
+            "model": model,
+            "messages": messages,
+            **params,
+        }
+        return request, n_prompt
+
+    def _estimate_tokens(self, request: dict, n_prompt: int) -> int:
+        """
+        Estimates the maximum number of tokens the request uses
+        (the prompt plus the longest possible answer).
+        """
+        n_output = request.get("max_completion_tokens") or request.get("max_tokens") or 0
+        return n_prompt + n_output
+
     def _generate_messages(
         self,
         prompt_role: str,
@@ -127,6 +347,28 @@ class Model:
         messages.append({"role": "user", "content": question})
         return messages
 
+    def _calc_lengths(
+        self, messages: list[dict], history_tokens: Optional[list[Optional[MessageTokens]]]
+    ) -> list[int]:
+        """
+        Counts tokens in each message,
+        reusing the known counts for the history messages.
+        """
+        # messages are [prompt, question 1, answer 1, ..., question]
+        history_tokens = history_tokens or []
+        if len(history_tokens) != (len(messages) - 2) // 2:
+            history_tokens = []
+        stamp = tokens.stamp(self.encoding)
+        known = {}
+        for idx, counts in enumerate(history_tokens):
+            if counts and counts.version == stamp:
+                known[2 * idx + 1] = counts.question
+                known[2 * idx + 2] = counts.answer
+        return [
+            known[idx] if idx in known else tokens.count(message["content"], self.encoding)
+            for idx, message in enumerate(messages)
+        ]
+
     def _prepare_answer(self, resp) -> str:
         """Post-processes an answer from the language model."""
         if len(resp["choices"]) == 0:
@@ -137,39 +379,83 @@ class Model:
         return answer
 
 
-def shorten(messages: list[dict], length: int) -> list[dict]:
+def shorten(
+    messages: list[dict],
+    length: int,
+    encoding: str = tokens.WordEncoder.name,
+    lengths: Optional[list[int]] = None,
+) -> list[dict]:
     """
     Truncates messages so that the total number or tokens
     does not exceed the specified length.
+    Counts tokens in messages unless their `lengths` are given.
     """
-    lengths = [_calc_tokens(m["content"]) for m in messages]
+    if lengths is None:
+        lengths = [tokens.count(m["content"], encoding) for m in messages]
     total_len = sum(lengths)
     if total_len <= length:
         return messages
 
     # exclude older messages to fit into the desired length
-    # can't exclude the prompt though
-    prompt_msg, messages = messages[0], messages[1:]
-    prompt_len, lengths = lengths[0], lengths[1:]
-    while len(messages) > 1 and total_len > length:
-        messages = messages[1:]
-        first_len, lengths = lengths[0], lengths[1:]
-        total_len -= first_len
-    messages = [prompt_msg] + messages
+    # can't exclude the prompt or the last message though:
+    # find the first message to keep using cumulative lengths,
+    # where excluded[k] = total length of the k oldest messages after the prompt
+    prompt_len = lengths[0]
+    excluded = list(itertools.accumulate(lengths[1:-1], initial=0))
+    first_idx = 1 + bisect.bisect_left(excluded, total_len - length)
+    first_idx = min(first_idx, len(messages) - 1)
+    total_len -= excluded[first_idx - 1]
+    messages = [messages[0]] + messages[first_idx:]
     if total_len <= length:
         return messages
 
     # there is only one message left, and it's still longer than allowed
-    # so we have to shorten it
+    # so we have to shorten it (keeping both the beginning and the end)
     maxlen = length - prompt_len
-    tokens = messages[1]["content"].split()[:maxlen]
-    messages[1]["content"] = " ".join(tokens)
+    content = tokens.truncate(messages[1]["content"], maxlen, encoding)
+    messages[1] = {**messages[1], "content": content}
     return messages
 
 
-def _calc_tokens(s: str) -> int:
-    """Calculates the number of tokens in a string."""
-    return int(len(s.split()) * 1.2)
+def _parse_chunk(line: str) -> Optional[str]:
+    """
+    Extracts the answer delta from a server-sent event line
+    of a streaming chat completion response.
+    """
+    chunk = _parse_event(line)
+    if not chunk:
+        return None
+    return _get_delta(chunk)
+
+
+def _parse_event(line: str) -> Optional[dict]:
+    """
+    Extracts the chunk from a server-sent event line
+    of a streaming chat completion response.
+    """
+    # events look like `data: {...}`, the stream ends with `data: [DONE]`,
+    # and everything else (comments, empty lines, other fields) is ignored
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    chunk = json.loads(data)
+    if "choices" not in chunk and "usage" not in chunk:
+        raise Exception(chunk)
+    return chunk
+
+
+def _get_delta(chunk: dict) -> Optional[str]:
+    """Returns the answer delta from a chunk (if any)."""
+    if not chunk.get("choices"):
+        return None
+    return chunk["choices"][0].get("delta", {}).get("content")
+
+
+def max_input_tokens(name: str) -> int:
+    """Returns the maximum number of input tokens for the model."""
+    return _calc_n_input(name, n_output=config.openai.params["max_tokens"])
 
 
 def _calc_n_input(name: str, n_output: int) -> int:
@@ -0,0 +1,51 @@
+"""Shared HTTP clients for AI provider calls."""
+
+import logging
+import httpx
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+# Clients by provider base URL.
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def get(url: str) -> httpx.AsyncClient:
+    """
+    Returns a pooled client for the provider base URL.
+    Creates the client on first use and reuses it afterwards,
+    so that requests share warm connections.
+    """
+    if url not in _clients:
+        _clients[url] = _create()
+    return _clients[url]
+
+
+def init() -> None:
+    """Creates clients for the configured providers."""
+    get(config.openai.url)
+    for provider in config.providers:
+        get(provider.url)
+
+
+async def close() -> None:
+    """Frees network connections."""
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+
+
+def _create() -> httpx.AsyncClient:
+    """Creates a client according to the connection settings."""
+    limits = httpx.Limits(
+        max_connections=config.http.max_connections,
+        max_keepalive_connections=config.http.max_keepalive_connections,
+        keepalive_expiry=config.http.keepalive_expiry,
+    )
+    timeout = httpx.Timeout(config.http.read_timeout, connect=config.http.connect_timeout)
+    if config.http.http2:
+        try:
+            return httpx.AsyncClient(limits=limits, timeout=timeout, http2=True)
+        except ImportError:
+            logger.warning("HTTP/2 requires the 'h2' package, falling back to HTTP/1.1")
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
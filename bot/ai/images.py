@@ -2,8 +2,9 @@
 
 import httpx
 from bot.config import config
-
-client = httpx.AsyncClient(timeout=60.0)
+from . import clients
+from . import ratelimit
+from . import router
 
 
 class Model:
@@ -11,16 +12,24 @@ class Model:
 
     async def imagine(self, prompt: str, size: str) -> str:
         """Generates an image of the specified size according to the description."""
-        response = await client.post(
-            f"{config.openai.url}/images/generations",
-            headers={"Authorization": f"Bearer {config.openai.api_key}"},
-            json={
-                "model": config.openai.image_model,
-                "prompt": prompt,
-                "size": size,
-                "n": 1,
-            },
-        )
+
+        async def send(endpoint: router.Endpoint) -> httpx.Response:
+            limiter = ratelimit.get(endpoint.url, config.openai.image_model)
+            await limiter.acquire()
+            response = await clients.get(endpoint.url).post(
+                f"{endpoint.url}/images/generations",
+                headers={"Authorization": f"Bearer {endpoint.api_key}"},
+                json={
+                    "model": config.openai.image_model,
+                    "prompt": prompt,
+                    "size": size,
+                    "n": 1,
+                },
+            )
+            limiter.update(response.headers)
+            return response
+
+        response = await router.request(config.openai.image_model, send)
         resp = response.json()
         if "data" not in resp:
             raise Exception(resp)
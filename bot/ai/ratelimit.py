@@ -0,0 +1,139 @@
+"""
+Rate limiting for AI provider requests.
+
+Keeps request and token budgets per provider and model,
+and makes callers wait for the budget instead of getting 429 errors.
+The budgets come from the config and from the x-ratelimit-* response headers.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from typing import Mapping, Optional
+from bot import metrics
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+# Durations in the x-ratelimit-reset-* headers, e.g. 1s, 6m0s, 20ms.
+duration_re = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+duration_units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+
+class TokenBucket:
+    """
+    A budget that refills continuously up to its capacity.
+    Zero capacity means an unlimited budget.
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def delay(self, amount: int) -> float:
+        """Returns the number of seconds to wait until the amount is available."""
+        if not self.capacity:
+            return 0
+        self._refill()
+        # requests larger than the capacity only have to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount: int) -> None:
+        """Takes the amount from the budget."""
+        if not self.capacity:
+            return
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount: int) -> None:
+        """Returns the amount to the budget."""
+        if not self.capacity:
+            return
+        self._refill()
+        self.level = min(self.level + amount, self.capacity)
+
+    def update(self, limit: int, remaining: int, reset_after: Optional[float]) -> None:
+        """Updates the budget according to the provider's numbers."""
+        self.capacity = limit
+        self.updated_at = time.monotonic()
+        if remaining == 0 and reset_after:
+            # the provider tells exactly when the budget becomes available again
+            self.level = -reset_after * limit / 60
+        else:
+            self.level = float(remaining)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.level + (now - self.updated_at) * self.capacity / 60, self.capacity)
+        self.updated_at = now
+
+
+class Limiter:
+    """Limits the number of requests and tokens per minute for a model."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        # callers take turns in the order they arrive
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, n_tokens: int = 0) -> None:
+        """Waits until there is budget for a request that uses `n_tokens`."""
+        start = time.perf_counter()
+        async with self.lock:
+            while True:
+                delay = max(self.requests.delay(1), self.tokens.delay(n_tokens))
+                if delay <= 0:
+                    break
+                logger.debug("rate limit: waiting for %.2fs", delay)
+                await asyncio.sleep(delay)
+            self.requests.take(1)
+            self.tokens.take(n_tokens)
+        metrics.ratelimit_wait_seconds.observe(time.perf_counter() - start)
+
+    def settle(self, n_estimated: int, n_actual: int) -> None:
+        """Returns the tokens that were reserved but not used."""
+        self.tokens.give(n_estimated - n_actual)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """Updates the budgets from the x-ratelimit-* response headers (if any)."""
+        for name, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            limit = headers.get(f"x-ratelimit-limit-{name}")
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            if not limit or not remaining:
+                continue
+            try:
+                reset_after = parse_duration(headers.get(f"x-ratelimit-reset-{name}") or "")
+                bucket.update(int(limit), int(remaining), reset_after)
+            except ValueError:
+                logger.debug("rate limit: invalid %s headers: %s, %s", name, limit, remaining)
+
+
+# Limiters by provider URL and model name.
+_limiters: dict[tuple[str, str], Limiter] = {}
+
+
+def get(url: str, model: str) -> Limiter:
+    """Returns the limiter for the provider and model."""
+    key = (url, model)
+    if key not in _limiters:
+        limits = config.ratelimit.models.get(model) or {}
+        _limiters[key] = Limiter(
+            requests_per_minute=limits.get("requests_per_minute")
+            or config.ratelimit.requests_per_minute,
+            tokens_per_minute=limits.get("tokens_per_minute") or config.ratelimit.tokens_per_minute,
+        )
+    return _limiters[key]
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parses a duration like 6m0s or 20ms into seconds."""
+    parts = duration_re.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * duration_units[unit] for number, unit in parts)
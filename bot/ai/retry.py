@@ -0,0 +1,125 @@
+"""
+Retries for AI provider requests.
+
+Retries requests that fail with transient errors (rate limits, server errors,
+timeouts and connection failures) using exponential backoff with jitter,
+as long as the overall deadline allows.
+"""
+
+import asyncio
+from collections import Counter
+import email.utils
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional
+import httpx
+from bot import metrics
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+# Response statuses worth retrying.
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# Errors worth retrying.
+RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+# Number of retries by reason (status code or error class name),
+# and the number of requests that failed after all the retries.
+counts: Counter[str] = Counter()
+metrics.provider_retries.set_function(lambda: counts)
+
+
+class Backoff:
+    """
+    Calculates delays between attempts.
+    `deadline` is the time (as in time.monotonic) after which there are no more attempts,
+    `retry.deadline` seconds from now by default.
+    """
+
+    def __init__(self, deadline: Optional[float] = None) -> None:
+        self.attempt = 1
+        self.deadline = deadline if deadline is not None else make_deadline()
+
+    def next_delay(self, response: Optional[httpx.Response] = None) -> Optional[float]:
+        """
+        Returns the number of seconds to wait before the next attempt,
+        or None if there should be no more attempts.
+        """
+        if self.attempt >= config.retry.max_attempts:
+            return None
+        # full jitter: a random delay up to the exponentially growing limit
+        max_delay = min(config.retry.max_delay, config.retry.base_delay * 2 ** (self.attempt - 1))
+        delay = random.uniform(0, max_delay)
+        retry_after = _parse_retry_after(response)
+        if retry_after is not None:
+            delay = retry_after
+        if time.monotonic() + delay > self.deadline:
+            return None
+        self.attempt += 1
+        return delay
+
+
+def make_deadline() -> float:
+    """Returns the time by which the request and all its retries should be done."""
+    return time.monotonic() + config.retry.deadline
+
+
+async def request(
+    send: Callable[[], Awaitable[httpx.Response]], deadline: Optional[float] = None
+) -> httpx.Response:
+    """
+    Sends a request using the `send` function, retrying on transient errors
+    until the `deadline` (see Backoff).
+    Returns the last response, or raises the last error if there is no response.
+    """
+    backoff = Backoff(deadline)
+    while True:
+        try:
+            response = await send()
+        except RETRYABLE_ERRORS as exc:
+            reason = exc.__class__.__name__
+            delay = backoff.next_delay()
+            if delay is None:
+                counts["failed"] += 1
+                raise
+        else:
+            if response.status_code not in RETRYABLE_STATUSES:
+                return response
+            reason = str(response.status_code)
+            delay = backoff.next_delay(response)
+            if delay is None:
+                counts["failed"] += 1
+                return response
+            # free the connection before retrying
+            await response.aclose()
+
+        counts[reason] += 1
+        logger.warning("Retrying in %.1fs (attempt %s): %s", delay, backoff.attempt, reason)
+        await asyncio.sleep(delay)
+
+
+def _parse_retry_after(response: Optional[httpx.Response]) -> Optional[float]:
+    """Returns the delay the provider asks to wait (if any)."""
+    if response is None:
+        return None
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    # the value can also be an HTTP date
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
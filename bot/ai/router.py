@@ -0,0 +1,359 @@
+"""
+Routing requests between AI providers.
+
+Picks a provider endpoint for each request according to its weight
+and recent latency and error rate, fails over to other endpoints on errors,
+and stops sending requests to an endpoint that keeps failing (circuit breaker).
+Optionally hedges slow requests by sending them a second time.
+"""
+
+import asyncio
+from collections import deque
+import logging
+import random
+import statistics
+import time
+from typing import Awaitable, Callable, Optional
+import httpx
+from bot import metrics
+from bot.config import config, Provider
+from . import retry
+
+logger = logging.getLogger(__name__)
+
+# Response statuses caused by the endpoint itself (e.g. a bad API key or a missing model),
+# so another endpoint may succeed where this one fails.
+ENDPOINT_STATUSES = {401, 403, 404}
+
+# Response statuses the endpoint fails with.
+FAILED_STATUSES = retry.RETRYABLE_STATUSES | ENDPOINT_STATUSES
+
+# The number of recent requests to calculate endpoint statistics from.
+WINDOW_SIZE = 100
+
+# Latency assumed for endpoints without statistics (in seconds).
+DEFAULT_LATENCY = 1.0
+
+# The minimum number of recent requests to derive the hedging delay from.
+HEDGE_MIN_SAMPLES = 10
+
+# The maximum number of hedged requests that can be saved up.
+HEDGE_MAX_BALANCE = 10.0
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an endpoint after several consecutive failures.
+    After a cooldown, lets a single trial request through:
+    if it succeeds, the endpoint is back in service, otherwise the cooldown restarts.
+    """
+
+    def __init__(self) -> None:
+        self.n_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        """True if the endpoint is out of service."""
+        return self.opened_at is not None
+
+    def is_available(self) -> bool:
+        """Checks if a request to the endpoint would be allowed, without making one."""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < config.router.cooldown:
+            return False
+        if self.trial_at is not None and now - self.trial_at < config.router.cooldown:
+            # the trial request is (probably) still in progress
+            return False
+        return True
+
+    def allow(self) -> bool:
+        """
+        Checks if a request to the endpoint is allowed.
+        After the cooldown, the allowed request is the trial one.
+        """
+        if not self.is_available():
+            return False
+        if self.opened_at is not None:
+            self.trial_at = time.monotonic()
+        return True
+
+    def succeed(self) -> None:
+        """Records a successful request."""
+        self.n_failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def fail(self) -> None:
+        """Records a failed request."""
+        self.n_failures += 1
+        if self.trial_at is not None or self.n_failures >= config.router.max_failures:
+            self.opened_at = time.monotonic()
+            self.trial_at = None
+
+
+class Endpoint:
+    """An AI provider endpoint with its recent statistics."""
+
+    def __init__(self, provider: Provider) -> None:
+        self.provider = provider
+        self.latencies: deque[float] = deque(maxlen=WINDOW_SIZE)
+        self.outcomes: deque[bool] = deque(maxlen=WINDOW_SIZE)
+        self.breaker = CircuitBreaker()
+
+    @property
+    def url(self) -> str:
+        return self.provider.url
+
+    @property
+    def api_key(self) -> str:
+        return self.provider.api_key
+
+    def serves(self, model: str) -> bool:
+        """Checks if the endpoint serves the model."""
+        return not self.provider.models or model in self.provider.models
+
+    def latency(self) -> tuple[float, float]:
+        """Returns the median and 95th percentile latency (in seconds)."""
+        return self.percentile(50), self.percentile(95)
+
+    def percentile(self, pct: int) -> float:
+        """Returns the latency percentile (in seconds)."""
+        if not self.latencies:
+            return DEFAULT_LATENCY
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        if pct == 50:
+            return statistics.median(self.latencies)
+        return statistics.quantiles(self.latencies, n=100)[pct - 1]
+
+    def error_rate(self) -> float:
+        """Returns the share of recent requests that failed."""
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def score(self) -> float:
+        """
+        Returns the endpoint score (the higher the better)
+        according to its weight, latency and error rate.
+        """
+        p50, p95 = self.latency()
+        return self.provider.weight * (1 - self.error_rate()) ** 2 / max((p50 + p95) / 2, 0.001)
+
+    def succeed(self, latency: float) -> None:
+        """Records a successful request."""
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.breaker.succeed()
+
+    def fail(self) -> None:
+        """Records a failed request."""
+        self.outcomes.append(False)
+        self.breaker.fail()
+        if self.breaker.is_open:
+            logger.warning("Provider %s is out of service", self.url)
+
+
+# Endpoints by provider URL.
+_endpoints: dict[str, Endpoint] = {}
+
+
+def providers() -> list[Provider]:
+    """
+    Returns the configured providers.
+    Uses the `openai` settings if there are no providers.
+    """
+    if config.providers:
+        return config.providers
+    return [Provider(url=config.openai.url, api_key=config.openai.api_key)]
+
+
+def get(provider: Provider) -> Endpoint:
+    """Returns the endpoint for the provider."""
+    endpoint = _endpoints.get(provider.url)
+    if endpoint is None:
+        endpoint = Endpoint(provider)
+        _endpoints[provider.url] = endpoint
+    # pick up config changes
+    endpoint.provider = provider
+    return endpoint
+
+
+def select(model: str) -> list[Endpoint]:
+    """
+    Returns the endpoints to send a request for the model to, in the order to try them.
+    The first endpoint is chosen randomly according to the endpoint scores,
+    the rest are ordered by score.
+    """
+    endpoints = [get(provider) for provider in providers()]
+    endpoints = [endpoint for endpoint in endpoints if endpoint.serves(model)] or endpoints
+    available = [endpoint for endpoint in endpoints if endpoint.breaker.is_available()]
+    if not available:
+        # all endpoints are out of service, so try them anyway
+        available = endpoints
+    if len(available) == 1:
+        return available
+    scores = [endpoint.score() for endpoint in available]
+    if not any(scores):
+        scores = None
+    first = random.choices(available, weights=scores)[0]
+    rest = sorted((e for e in available if e is not first), key=Endpoint.score, reverse=True)
+    return [first] + rest
+
+
+class HedgeBudget:
+    """
+    Limits the share of hedged requests.
+    Each request adds `max_rate` to the balance, and each hedged request takes 1 from it.
+    """
+
+    def __init__(self) -> None:
+        self.balance = 0.0
+
+    def deposit(self) -> None:
+        """Records a request."""
+        self.balance = min(self.balance + config.hedging.max_rate, HEDGE_MAX_BALANCE)
+
+    def withdraw(self) -> bool:
+        """Takes a hedged request from the balance if there is enough."""
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+budget = HedgeBudget()
+
+
+def hedge_delay(endpoint: Endpoint) -> Optional[float]:
+    """
+    Returns the number of seconds to wait for the endpoint
+    before hedging the request, or None if there are too few statistics.
+    """
+    if len(endpoint.latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return endpoint.percentile(config.hedging.percentile)
+
+
+async def request(
+    model: str, send: Callable[[Endpoint], Awaitable[httpx.Response]], hedge: bool = False
+) -> httpx.Response:
+    """
+    Sends a request for the model using the `send` function,
+    retrying on transient errors and failing over to other endpoints.
+    Returns the response from the first endpoint that did not fail.
+    If `hedge` is true, sends the request a second time if the first one is slow.
+    The retries, the failover and the hedged request all share a single deadline.
+    """
+    endpoints = select(model)
+    deadline = retry.make_deadline()
+    if not hedge:
+        return await _request(endpoints, send, deadline)
+
+    budget.deposit()
+    delay = hedge_delay(endpoints[0])
+    primary = asyncio.create_task(_request(endpoints, send, deadline))
+    if delay is None:
+        return await primary
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    if done or not budget.withdraw():
+        return await primary
+
+    # prefer another endpoint for the second request
+    backup = endpoints[1:] + endpoints[:1]
+    logger.debug("Hedging the request to %s with %s", endpoints[0].url, backup[0].url)
+    secondary = asyncio.create_task(_request(backup, send, deadline))
+    return await _first(primary, secondary)
+
+
+async def _first(*tasks: asyncio.Task) -> httpx.Response:
+    """
+    Returns the first successful response from the tasks and cancels the rest.
+    If none succeeds, returns the result of the first task.
+    """
+    pending = set(tasks)
+    winner = None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if _succeeded(task):
+                    winner = task
+                    break
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    winner = winner or tasks[0]
+    for task in tasks:
+        # free the connections of the responses nobody is going to read
+        if task is not winner and _succeeded(task):
+            await task.result().aclose()
+    return winner.result()
+
+
+def _succeeded(task: asyncio.Task) -> bool:
+    """Checks if the task has finished with a successful response."""
+    if not task.done() or task.cancelled() or task.exception():
+        return False
+    return task.result().status_code not in FAILED_STATUSES
+
+
+async def _request(
+    endpoints: list[Endpoint],
+    send: Callable[[Endpoint], Awaitable[httpx.Response]],
+    deadline: float,
+) -> httpx.Response:
+    """
+    Sends a request to the endpoints in turn until one of them does not fail.
+    Does not move on to the next endpoint after the deadline.
+    """
+    for idx, endpoint in enumerate(endpoints):
+        if not endpoint.breaker.allow() and idx < len(endpoints) - 1:
+            # another request is trying the recovering endpoint
+            continue
+        start = time.monotonic()
+        try:
+            response = await retry.request(lambda: send(endpoint), deadline)
+        except retry.RETRYABLE_ERRORS as exc:
+            endpoint.fail()
+            _observe(endpoint, start, "error")
+            is_last = idx == len(endpoints) - 1 or time.monotonic() >= deadline
+            if is_last:
+                raise
+            logger.warning("Provider %s failed, trying the next one: %s", endpoint.url, exc)
+            continue
+
+        if response.status_code in FAILED_STATUSES:
+            endpoint.fail()
+            _observe(endpoint, start, "error")
+            is_last = idx == len(endpoints) - 1 or time.monotonic() >= deadline
+            if is_last:
+                return response
+            logger.warning(
+                "Provider %s failed, trying the next one: status=%s",
+                endpoint.url,
+                response.status_code,
+            )
+            await response.aclose()
+            continue
+
+        endpoint.succeed(time.monotonic() - start)
+        _observe(endpoint, start, "ok")
+        return response
+
+
+def _observe(endpoint: Endpoint, start: float, outcome: str) -> None:
+    """Records the request latency metric."""
+    metrics.provider_request_seconds.observe(
+        time.monotonic() - start, provider=endpoint.url, outcome=outcome
+    )
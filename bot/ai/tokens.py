@@ -0,0 +1,242 @@
+"""
+Token counting for language models.
+
+Uses byte-pair encoding vocabularies in the tiktoken format
+(e.g. https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken)
+when they are available in `config.vocab_path`,
+and falls back to a rough estimation otherwise.
+"""
+
+import base64
+from collections import OrderedDict
+import functools
+import heapq
+import logging
+import mmap
+import os
+import re
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class Encoder:
+    """Counts tokens in text."""
+
+    # Encoding name.
+    name = ""
+    # Counting algorithm version. Increments when the counts change.
+    version = 1
+
+    def count(self, text: str) -> int:
+        """Returns the number of tokens in the text."""
+        raise NotImplementedError()
+
+
+class WordEncoder(Encoder):
+    """Estimates the number of tokens from the number of words and characters."""
+
+    name = "words"
+    version = 2
+
+    # Chinese, Japanese and Korean characters take about a token each.
+    wide_re = re.compile(r"[ᄀ-ᇿ⺀-鿿가-힯豈-﫿＀-￯]")
+
+    def count(self, text: str) -> int:
+        n_words = len(text.split())
+        n_wide = len(self.wide_re.findall(text))
+        # English prose is about 1.2 tokens per word,
+        # while code and markup are closer to 4 characters per token
+        n_narrow = max(n_words * 1.2, (len(text) - n_wide) / 4)
+        return int(n_narrow) + n_wide
+
+
+class BPEEncoder(Encoder):
+    """Counts tokens using a byte-pair encoding vocabulary."""
+
+    version = 1
+
+    # Splits text into words, numbers, punctuation and whitespace
+    # before applying the byte-pair merges.
+    # Approximates the cl100k_base pattern without the \p{...} classes.
+    pattern = re.compile(
+        r"'(?i:[sdmt]|ll|ve|re)"
+        r"|(?:[^\r\n\w]|_)?[^\W\d_]+"
+        r"|\d{1,3}"
+        r"| ?(?:[^\s\w]|_)+[\r\n]*"
+        r"|\s*[\r\n]+"
+        r"|\s+(?!\S)"
+        r"|\s+"
+    )
+
+    # Longer pieces (e.g. base64 blobs) are not cached, so they do not stay in memory.
+    max_cached_piece = 256
+
+    def __init__(self, name: str, path: str) -> None:
+        self.name = name
+        self.path = path
+        self._ranks = None
+        self._count_piece = functools.lru_cache(maxsize=65536)(self._merge)
+
+    @property
+    def ranks(self) -> dict[bytes, int]:
+        """Token ranks, loaded on first use."""
+        if self._ranks is None:
+            self._ranks = self._load()
+        return self._ranks
+
+    def count(self, text: str) -> int:
+        n_tokens = 0
+        for match in self.pattern.finditer(text):
+            piece = match.group().encode("utf-8")
+            if len(piece) > self.max_cached_piece:
+                n_tokens += self._merge(piece)
+            else:
+                n_tokens += self._count_piece(piece)
+        return n_tokens
+
+    def _load(self) -> dict[bytes, int]:
+        """Reads the vocabulary file (one 'base64-token rank' pair per line)."""
+        ranks = {}
+        with open(self.path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for line in iter(data.readline, b""):
+                    token, _, rank = line.partition(b" ")
+                    if not rank:
+                        continue
+                    ranks[base64.b64decode(token)] = int(rank)
+        logger.info("loaded vocabulary: name=%s, n_tokens=%s", self.name, len(ranks))
+        return ranks
+
+    def _merge(self, piece: bytes) -> int:
+        """
+        Returns the number of tokens the piece is encoded with.
+        Repeatedly merges the adjacent pair of parts with the lowest rank
+        (the leftmost one on ties). The candidate pairs are kept in a heap,
+        so long pieces take O(n log n) instead of O(n²).
+        """
+        ranks = self.ranks
+        if piece in ranks:
+            return 1
+        size = len(piece)
+        # parts are piece[start:nexts[start]], linked by their start positions
+        nexts = list(range(1, size + 1))
+        prevs = list(range(-1, size - 1))
+        is_merged = [False] * size
+
+        def push(start: int) -> None:
+            # adds the pair of parts starting at `start`, if it's a token
+            middle = nexts[start]
+            if middle < size:
+                end = nexts[middle]
+                rank = ranks.get(piece[start:end])
+                if rank is not None:
+                    heapq.heappush(heap, (rank, start, end))
+
+        heap = [
+            (ranks[piece[idx : idx + 2]], idx, idx + 2)
+            for idx in range(size - 1)
+            if piece[idx : idx + 2] in ranks
+        ]
+        heapq.heapify(heap)
+        n_parts = size
+        while heap:
+            _, start, end = heapq.heappop(heap)
+            middle = nexts[start]
+            if is_merged[start] or middle >= size or nexts[middle] != end:
+                # the pair has changed since it was added
+                continue
+            nexts[start] = end
+            is_merged[middle] = True
+            if end < size:
+                prevs[end] = start
+            n_parts -= 1
+            if prevs[start] >= 0:
+                push(prevs[start])
+            push(start)
+        return n_parts
+
+
+# Replaces the middle of a text that is too long.
+TRUNCATED = "\n[...]\n"
+
+_encoders: dict[str, Encoder] = {}
+
+# The number of recent token counts to remember.
+COUNT_CACHE_SIZE = 4096
+
+# Token counts by (encoding, text length, text hash),
+# so that the cache does not keep the texts themselves alive.
+_counts: OrderedDict[tuple, int] = OrderedDict()
+
+
+def get_encoder(encoding: str) -> Encoder:
+    """
+    Returns an encoder for the encoding name.
+    If there is no vocabulary for the encoding, returns a word-based encoder.
+    """
+    if encoding in _encoders:
+        return _encoders[encoding]
+    path = os.path.join(config.vocab_path, f"{encoding}.tiktoken")
+    if os.path.exists(path):
+        encoder = BPEEncoder(encoding, path)
+    else:
+        encoder = WordEncoder()
+    _encoders[encoding] = encoder
+    return encoder
+
+
+def count(text: str, encoding: str = WordEncoder.name) -> int:
+    """
+    Returns the number of tokens in the text.
+    Caches the counts, so repeated messages are not re-tokenized.
+    """
+    key = (encoding, len(text), hash(text))
+    if key in _counts:
+        _counts.move_to_end(key)
+        return _counts[key]
+    n_tokens = get_encoder(encoding).count(text)
+    _counts[key] = n_tokens
+    if len(_counts) > COUNT_CACHE_SIZE:
+        _counts.popitem(last=False)
+    return n_tokens
+
+
+def truncate(text: str, length: int, encoding: str = WordEncoder.name) -> str:
+    """
+    Shortens the text to the specified number of tokens,
+    keeping its beginning and end and cutting out the middle.
+    """
+    encoder = get_encoder(encoding)
+    n_tokens = encoder.count(text)
+    if n_tokens <= length:
+        return text
+    if length <= encoder.count(TRUNCATED):
+        return ""
+
+    # estimate the number of characters to keep from the token ratio,
+    # then reduce it until the text fits
+    n_chars = len(text) * length // n_tokens
+    while n_chars > 0:
+        half = n_chars // 2
+        head, tail = text[:half], text[len(text) - half :]
+        # avoid cutting words in half
+        if " " in head[half // 2 :]:
+            head = head[: head.rindex(" ")]
+        if " " in tail[: half // 2]:
+            tail = tail[tail.index(" ") + 1 :]
+        result = f"{head}{TRUNCATED}{tail}"
+        n_tokens = encoder.count(result)
+        if n_tokens <= length:
+            return result
+        n_chars = min(n_chars - 1, n_chars * length // n_tokens)
+    return ""
+
+
+def stamp(encoding: str) -> str:
+    """
+    Returns the counting algorithm stamp for the encoding.
+    Token counts with a different stamp should be recalculated.
+    """
+    encoder = get_encoder(encoding)
+    return f"{encoder.name}/{encoder.version}"
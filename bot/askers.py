@@ -3,25 +3,66 @@ Asker is an abstraction that sends questions to the AI
 and responds to the user with answers provided by the AI.
 """
 
-import io
+import asyncio
 import re
-import textwrap
+import time
+from typing import Optional
 
 from telegram import Chat, Message
-from telegram.constants import MessageLimit, ParseMode
+from telegram.constants import ChatAction, MessageLimit, ParseMode
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext
 
 from bot import ai
 from bot import markdown
+from bot.models import MessageTokens
 
 
 class Asker:
     """Asks AI questions and responds with answers."""
 
-    async def ask(self, prompt: str, question: str, history: list[tuple[str, str]]) -> str:
+    # The chat action to show while the answer is being prepared.
+    action = ChatAction.TYPING
+
+    async def ask(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> str:
         """Asks AI a question."""
         pass
 
+    async def ask_stream(
+        self,
+        message: Message,
+        context: CallbackContext,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> str:
+        """
+        Asks AI a question, replying with a partial answer as it arrives.
+        Askers that do not support streaming simply return the answer.
+        """
+        return await self.ask(prompt, question, history, history_tokens)
+
+    def count(self, question: str, answer: str) -> Optional[MessageTokens]:
+        """Counts tokens in a question and an answer (if applicable)."""
+        return None
+
+    def count_input(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> int:
+        """Estimates the number of tokens AI receives with the question."""
+        return ai.tokens.count(question)
+
     async def reply(self, message: Message, context: CallbackContext, answer: str) -> None:
         """Replies with an answer from AI."""
         pass
@@ -30,38 +71,124 @@ class Asker:
 class TextAsker(Asker):
     """Works with chat completion AI."""
 
+    # Minimum delay between partial answer edits (in seconds).
+    # Telegram allows about one message per second in a private chat
+    # and about 20 messages per minute in a group, so in groups the edits
+    # take half of the budget, leaving the rest for the full answer and other replies.
+    edit_interval = 1
+    group_edit_interval = 6
+
     def __init__(self, model_name: str) -> None:
         self.model = ai.chat.Model(model_name)
-
-    async def ask(self, prompt: str, question: str, history: list[tuple[str, str]]) -> str:
+        self.partial: Optional[Message] = None
+        # the partial answer being sent or edited (if any)
+        self.updating: Optional[asyncio.Task] = None
+
+    async def ask(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> str:
         """Asks AI a question."""
-        return await self.model.ask(prompt, question, history)
+        return await self.model.ask(prompt, question, history, history_tokens)
+
+    async def ask_stream(
+        self,
+        message: Message,
+        context: CallbackContext,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> str:
+        """
+        Asks AI a question, replying with a partial answer as it arrives.
+        Sends the first tokens as soon as they are received,
+        then periodically edits the message to show the rest.
+        The message is updated in the background, one update at a time,
+        so the answer keeps arriving while an update waits for the rate limits.
+        """
+        interval = (
+            self.edit_interval if message.chat.type == Chat.PRIVATE else self.group_edit_interval
+        )
+        parts = []
+        shown = ""
+        last_edit = 0.0
+        try:
+            async for delta in self.model.ask_stream(prompt, question, history, history_tokens):
+                parts.append(delta)
+                if self.updating and not self.updating.done():
+                    # the next update will show everything received so far
+                    continue
+                if self.updating:
+                    # raise the update error (if any)
+                    self.updating.result()
+                if self.partial and time.monotonic() - last_edit < interval:
+                    continue
+                text = _shorten_partial("".join(parts))
+                if not text or text == shown:
+                    continue
+                self.updating = asyncio.create_task(self._update_partial(message, text))
+                shown = text
+                last_edit = time.monotonic()
+        finally:
+            if self.updating:
+                # the full answer replaces the partial one, so wait for the update to finish
+                await self.updating
+                self.updating = None
+        return "".join(parts).strip()
+
+    def count(self, question: str, answer: str) -> Optional[MessageTokens]:
+        """Counts tokens in a question and an answer."""
+        return self.model.count(question, answer)
+
+    def count_input(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> int:
+        """Counts tokens in the prompt, history and question."""
+        return self.model.count_input(prompt, question, history, history_tokens)
 
     async def reply(self, message: Message, context: CallbackContext, answer: str) -> None:
         """Replies with an answer from AI."""
         html_answer = markdown.to_html(answer)
-        if len(html_answer) <= MessageLimit.MAX_TEXT_LENGTH:
-            await message.reply_text(html_answer, parse_mode=ParseMode.HTML)
-            return
-
-        doc = io.StringIO(answer)
-        caption = (
-            textwrap.shorten(answer, width=255, placeholder="...")
-            + " (see attachment for the rest)"
-        )
-        reply_to_message_id = message.id if message.chat.type != Chat.PRIVATE else None
-        await context.bot.send_document(
-            chat_id=message.chat_id,
-            caption=caption,
-            filename=f"{message.id}.md",
-            document=doc,
-            reply_to_message_id=reply_to_message_id,
-        )
+        # long answers are sent as several messages
+        chunks = markdown.split(html_answer, MessageLimit.MAX_TEXT_LENGTH) or [html_answer]
+        if self.partial:
+            # replace the partial answer with the full one (or its first part)
+            await self._edit_partial(chunks[0])
+        else:
+            await message.reply_text(chunks[0], parse_mode=ParseMode.HTML)
+        for chunk in chunks[1:]:
+            # one by one, so the parts arrive in order
+            await message.reply_text(chunk, parse_mode=ParseMode.HTML, quote=False)
+
+    async def _update_partial(self, message: Message, text: str) -> None:
+        """Sends or edits the partial answer."""
+        if self.partial:
+            await self.partial.edit_text(text)
+        else:
+            self.partial = await message.reply_text(text)
+
+    async def _edit_partial(self, html_answer: str) -> None:
+        """Replaces the partial answer with the full one."""
+        try:
+            await self.partial.edit_text(html_answer, parse_mode=ParseMode.HTML)
+        except BadRequest as exc:
+            # the partial answer already shows the full answer
+            if "not modified" not in str(exc):
+                raise
 
 
 class ImagineAsker(Asker):
     """Works with image generation AI."""
 
+    action = ChatAction.UPLOAD_PHOTO
     model = ai.images.Model()
     size_re = re.compile(r"(256|512|1024)(?:x\1)?\s?(?:px)?")
     sizes = {
@@ -75,7 +202,13 @@ class ImagineAsker(Asker):
     def __init__(self) -> None:
         self.caption = ""
 
-    async def ask(self, prompt: str, question: str, history: list[tuple[str, str]]) -> str:
+    async def ask(
+        self,
+        prompt: str,
+        question: str,
+        history: list[tuple[str, str]],
+        history_tokens: Optional[list[Optional[MessageTokens]]] = None,
+    ) -> str:
         """Asks AI a question."""
         size = self._extract_size(question)
         self.caption = self._extract_caption(question)
@@ -97,6 +230,14 @@ class ImagineAsker(Asker):
         return caption
 
 
+def _shorten_partial(text: str) -> str:
+    """Fits a partial answer into a single Telegram message."""
+    text = text.strip()
+    if len(text) <= MessageLimit.MAX_TEXT_LENGTH:
+        return text
+    return text[: MessageLimit.MAX_TEXT_LENGTH - 1] + "…"
+
+
 def create(model: str, question: str) -> Asker:
     """Creates a new asker based on the question asked."""
     if question.startswith("/imagine"):
@@ -12,12 +12,17 @@ from telegram.ext import (
     CallbackContext,
     CommandHandler,
     MessageHandler,
-    PicklePersistence,
 )
+from bot import ai
 from bot import askers
 from bot import commands
+from bot import heartbeat
 from bot import questions
+from bot import metrics
 from bot import models
+from bot import persistence
+from bot import scheduler
+from bot import sender
 from bot.config import config
 from bot.fetcher import Fetcher
 from bot.filters import Filters
@@ -47,20 +52,31 @@ filters = Filters()
 
 
 def main():
-    persistence = PicklePersistence(filepath=config.persistence_path)
     application = (
         ApplicationBuilder()
         .token(config.telegram.token)
         .post_init(post_init)
         .post_shutdown(post_shutdown)
-        .persistence(persistence)
-        .concurrent_updates(True)
+        .persistence(persistence.create(config.persistence_path))
+        .concurrent_updates(scheduler.ChatUpdateProcessor(config.scheduler.concurrency))
+        .rate_limiter(sender.FloodLimiter())
         .get_updates_http_version("1.1")
-        .http_version("1.1")
+        .request(metrics.TelegramRequest(connection_pool_size=256, http_version="1.1"))
         .build()
     )
     add_handlers(application)
-    application.run_polling()
+    if config.webhook:
+        application.run_webhook(
+            listen=config.webhook.listen,
+            port=config.webhook.port,
+            url_path=config.webhook.path,
+            webhook_url=config.webhook.url,
+            secret_token=config.webhook.secret_token or None,
+            cert=config.webhook.cert or None,
+            key=config.webhook.key or None,
+        )
+    else:
+        application.run_polling()
 
 
 def add_handlers(application: Application):
@@ -100,15 +116,22 @@ async def post_init(application: Application) -> None:
     logging.info(f"allowed users: {config.telegram.usernames}")
     logging.info(f"allowed chats: {config.telegram.chat_ids}")
     logging.info(f"admins: {config.telegram.admins}")
+    logging.info(f"updates: {'webhook' if config.webhook else 'polling'}")
     logging.info(f"api url: {config.openai.url}")
     logging.info(f"model name: {config.openai.model}")
     logging.info(f"bot: username={bot.username}, id={bot.id}")
     await bot.set_my_commands(commands.BOT_COMMANDS)
+    ai.clients.init()
+    if config.metrics.enabled:
+        await metrics.serve(config.metrics.listen, config.metrics.port)
 
 
 async def post_shutdown(application: Application) -> None:
     """Frees acquired resources."""
     await fetcher.close()
+    await questions.close()
+    await ai.clients.close()
+    await metrics.close()
 
 
 def with_message_limit(func):
@@ -147,25 +170,26 @@ async def reply_to(
     update: Update, message: Message, context: CallbackContext, question: str
 ) -> None:
     """Replies to a specific question."""
-    await message.chat.send_action(action="typing", message_thread_id=message.message_thread_id)
-
     try:
         chat = ChatData(context.chat_data)
         model = chat.model or config.openai.model
         asker = askers.create(model=model, question=question)
-        if message.chat.type == Chat.PRIVATE and message.forward_date:
-            # this is a forwarded message, don't answer yet
-            answer = "This is a forwarded message. What should I do with it?"
-        else:
-            answer = await _ask_question(message, context, question, asker)
-
-        user = UserData(context.user_data)
-        user.messages.add(question, answer)
-        logger.debug(user.messages)
-        await asker.reply(message, context, answer)
+        # keep the chat action visible until the answer is sent
+        async with heartbeat.keep(message, asker.action):
+            if message.chat.type == Chat.PRIVATE and message.forward_date:
+                # this is a forwarded message, don't answer yet
+                answer = "This is a forwarded message. What should I do with it?"
+            else:
+                answer = await _ask_question(message, context, question, asker)
+
+            user = UserData(context.user_data)
+            user.messages.add(question, answer, tokens=asker.count(question, answer))
+            logger.debug(user.messages)
+            await asker.reply(message, context, answer)
 
     except Exception as exc:
         class_name = f"{exc.__class__.__module__}.{exc.__class__.__qualname__}"
+        metrics.errors.inc(type=class_name)
         error_text = f"{class_name}: {exc}"
         logger.error("Failed to answer: %s", error_text)
         text = textwrap.shorten(f"⚠️ {error_text}", width=255, placeholder="...")
@@ -178,10 +202,10 @@ async def _ask_question(
     """Answers a question using the OpenAI model."""
     user_id = message.from_user.username or message.from_user.id
     logger.info(f"-> question id={message.id}, user={user_id}, n_chars={len(question)}")
+    metrics.questions.inc(chat_type=message.chat.type)
 
     question, is_follow_up = questions.prepare(question)
-    question = await fetcher.substitute_urls(question)
-    logger.debug(f"Prepared question: {question}")
+    chat = ChatData(context.chat_data)
 
     user = UserData(context.user_data)
     if message.chat.type == Chat.PRIVATE:
@@ -190,21 +214,43 @@ async def _ask_question(
             # this is a follow-up question,
             # so the bot should retain the previous history
             history = user.messages.as_list()
+            history_tokens = user.messages.tokens_list()
         else:
             # user is asking a question 'from scratch',
             # so the bot should forget the previous history
             user.messages.clear()
             history = []
+            history_tokens = []
     else:
         # in group chats the bot only answers direct questions
         # or follow-up questions to the bot messages
         prev_message = questions.extract_prev(message, context)
         history = [("", prev_message)] if prev_message else []
+        history_tokens = []
+
+    # leave the rest of the model context for the linked contents
+    model = chat.model or config.openai.model
+    n_input = asker.count_input(chat.prompt, question, history, history_tokens)
+    max_tokens = ai.chat.max_input_tokens(model) - n_input
+    question = await fetcher.substitute_urls(question, max_tokens=max_tokens)
+    logger.debug(f"Prepared question: {question}")
 
-    chat = ChatData(context.chat_data)
     start = time.perf_counter_ns()
-    answer = await asker.ask(prompt=chat.prompt, question=question, history=history)
+    if config.openai.stream:
+        answer = await asker.ask_stream(
+            message,
+            context,
+            prompt=chat.prompt,
+            question=question,
+            history=history,
+            history_tokens=history_tokens,
+        )
+    else:
+        answer = await asker.ask(
+            prompt=chat.prompt, question=question, history=history, history_tokens=history_tokens
+        )
     elapsed = int((time.perf_counter_ns() - start) / 1e6)
+    metrics.answer_seconds.observe(elapsed / 1000)
 
     logger.info(
         f"<- answer id={message.id}, user={user_id}, "
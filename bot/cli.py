@@ -13,6 +13,7 @@ import textwrap
 from bot.config import config
 from bot.fetcher import Fetcher
 import bot.ai.chat
+import bot.ai.clients
 
 
 async def main(question):
@@ -22,6 +23,7 @@ async def main(question):
     ai = init_model()
     answer = await ai.ask(prompt=config.openai.prompt, question=question, history=[])
     await fetcher.close()
+    await bot.ai.clients.close()
     lines = textwrap.wrap(answer, width=60)
     for line in lines:
         print(line)
@@ -4,6 +4,7 @@ import logging
 import textwrap
 from telegram import Chat, Update
 from telegram.ext import CallbackContext
+from bot import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +20,7 @@ class ErrorCommand:
             return
 
         class_name = f"{context.error.__class__.__module__}.{context.error.__class__.__qualname__}"
+        metrics.errors.inc(type=class_name)
         error_text = f"{class_name}: {context.error}"
         logger.warning("Exception while handling an update %s: %s", update, error_text)
         text = textwrap.shorten(f"⚠️ {error_text}", width=255, placeholder="...")
@@ -15,6 +15,121 @@ class Telegram:
     chat_ids: list
 
 
+@dataclass
+class Webhook:
+    url: str
+    listen: str
+    port: int
+    path: str
+    secret_token: str
+    cert: str
+    key: str
+
+    default_listen = "127.0.0.1"
+    default_port = 8080
+
+    def __init__(
+        self,
+        url: str = "",
+        listen: str = default_listen,
+        port: int = default_port,
+        path: str = "",
+        secret_token: str = "",
+        cert: str = "",
+        key: str = "",
+    ) -> None:
+        self.url = url or ""
+        self.listen = listen or self.default_listen
+        self.port = port or self.default_port
+        self.path = path or ""
+        self.secret_token = secret_token or ""
+        self.cert = cert or ""
+        self.key = key or ""
+
+    def __bool__(self) -> bool:
+        return bool(self.url)
+
+
+@dataclass
+class Scheduler:
+    concurrency: int
+
+    default_concurrency = 16
+
+    def __init__(self, concurrency: int = default_concurrency) -> None:
+        self.concurrency = concurrency or self.default_concurrency
+
+
+@dataclass
+class Metrics:
+    enabled: bool
+    listen: str
+    port: int
+
+    default_listen = "127.0.0.1"
+    default_port = 9090
+
+    def __init__(
+        self, enabled: bool = False, listen: str = default_listen, port: int = default_port
+    ) -> None:
+        self.enabled = enabled or False
+        self.listen = listen or self.default_listen
+        self.port = port or self.default_port
+
+
+@dataclass
+class Provider:
+    url: str
+    api_key: str
+    weight: float
+    models: list
+
+    default_weight = 1.0
+
+    def __init__(
+        self, url: str, api_key: str, weight: float = default_weight, models: list = None
+    ) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.weight = weight or self.default_weight
+        self.models = models or []
+
+
+@dataclass
+class Router:
+    max_failures: int
+    cooldown: float
+
+    default_max_failures = 5
+    default_cooldown = 30.0
+
+    def __init__(
+        self, max_failures: int = default_max_failures, cooldown: float = default_cooldown
+    ) -> None:
+        self.max_failures = max_failures or self.default_max_failures
+        self.cooldown = cooldown or self.default_cooldown
+
+
+@dataclass
+class Hedging:
+    enabled: bool
+    percentile: int
+    max_rate: float
+
+    default_percentile = 95
+    default_max_rate = 0.1
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        percentile: int = default_percentile,
+        max_rate: float = default_max_rate,
+    ) -> None:
+        self.enabled = enabled or False
+        self.percentile = percentile or self.default_percentile
+        self.max_rate = max_rate or self.default_max_rate
+
+
 @dataclass
 class OpenAI:
     url: str
@@ -24,6 +139,7 @@ class OpenAI:
     window: int
     prompt: str
     params: dict
+    stream: bool
 
     default_url = "https://api.openai.com/v1"
     default_model = "gpt-4o-mini"
@@ -34,6 +150,7 @@ class OpenAI:
         "temperature": 0.7,
         "max_tokens": 4096,
     }
+    default_stream = False
 
     def __init__(
         self,
@@ -44,6 +161,7 @@ class OpenAI:
         window: int,
         prompt: str,
         params: dict,
+        stream: bool = default_stream,
     ) -> None:
         self.url = url or self.default_url
         self.api_key = api_key
@@ -53,6 +171,7 @@ class OpenAI:
         self.prompt = prompt or self.default_prompt
         self.params = self.default_params.copy()
         self.params.update(params)
+        self.stream = stream or self.default_stream
 
 
 @dataclass
@@ -85,6 +204,105 @@ class Conversation:
         self.message_limit = RateLimit(**message_limit)
 
 
+@dataclass
+class HTTP:
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float
+    http2: bool
+    connect_timeout: float
+    read_timeout: float
+
+    default_max_connections = 100
+    default_max_keepalive_connections = 20
+    default_keepalive_expiry = 60.0
+    default_http2 = False
+    default_connect_timeout = 5.0
+    default_read_timeout = 60.0
+
+    def __init__(
+        self,
+        max_connections: int = default_max_connections,
+        max_keepalive_connections: int = default_max_keepalive_connections,
+        keepalive_expiry: float = default_keepalive_expiry,
+        http2: bool = default_http2,
+        connect_timeout: float = default_connect_timeout,
+        read_timeout: float = default_read_timeout,
+    ) -> None:
+        self.max_connections = max_connections or self.default_max_connections
+        self.max_keepalive_connections = (
+            max_keepalive_connections or self.default_max_keepalive_connections
+        )
+        self.keepalive_expiry = keepalive_expiry or self.default_keepalive_expiry
+        self.http2 = http2 or self.default_http2
+        self.connect_timeout = connect_timeout or self.default_connect_timeout
+        self.read_timeout = read_timeout or self.default_read_timeout
+
+
+@dataclass
+class CompletionCache:
+    enabled: bool
+    size: int
+    ttl: int
+    allow_random: bool
+
+    default_enabled = False
+    default_size = 1000
+    default_ttl = 3600
+    default_allow_random = False
+
+    def __init__(
+        self,
+        enabled: bool = default_enabled,
+        size: int = default_size,
+        ttl: int = default_ttl,
+        allow_random: bool = default_allow_random,
+    ) -> None:
+        self.enabled = enabled or self.default_enabled
+        self.size = size or self.default_size
+        self.ttl = ttl or self.default_ttl
+        self.allow_random = allow_random or self.default_allow_random
+
+
+@dataclass
+class Retry:
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+    deadline: float
+
+    default_max_attempts = 3
+    default_base_delay = 0.5
+    default_max_delay = 10.0
+    default_deadline = 60.0
+
+    def __init__(
+        self,
+        max_attempts: int = default_max_attempts,
+        base_delay: float = default_base_delay,
+        max_delay: float = default_max_delay,
+        deadline: float = default_deadline,
+    ) -> None:
+        self.max_attempts = max_attempts or self.default_max_attempts
+        self.base_delay = base_delay or self.default_base_delay
+        self.max_delay = max_delay or self.default_max_delay
+        self.deadline = deadline or self.default_deadline
+
+
+@dataclass
+class ProviderRateLimit:
+    requests_per_minute: int
+    tokens_per_minute: int
+    models: dict
+
+    def __init__(
+        self, requests_per_minute: int = 0, tokens_per_minute: int = 0, models: dict = None
+    ) -> None:
+        self.requests_per_minute = requests_per_minute or 0
+        self.tokens_per_minute = tokens_per_minute or 0
+        self.models = models or {}
+
+
 @dataclass
 class Imagine:
     enabled: str
@@ -93,6 +311,66 @@ class Imagine:
         self.enabled = enabled if enabled in ("none", "users_only", "users_and_groups") else "none"
 
 
+@dataclass
+class Fetcher:
+    concurrency: int
+    global_concurrency: int
+    budget: float
+    cache_size: int
+    cache_ttl: int
+    cache_path: str
+    max_bytes: int
+
+    default_concurrency = 4
+    default_global_concurrency = 16
+    default_budget = 10.0
+    default_cache_size = 16 * 1024 * 1024
+    default_cache_ttl = 600
+    default_cache_path = ""
+    default_max_bytes = 4 * 1024 * 1024
+
+    def __init__(
+        self,
+        concurrency: int = default_concurrency,
+        global_concurrency: int = default_global_concurrency,
+        budget: float = default_budget,
+        cache_size: int = default_cache_size,
+        cache_ttl: int = default_cache_ttl,
+        cache_path: str = default_cache_path,
+        max_bytes: int = default_max_bytes,
+    ) -> None:
+        self.concurrency = concurrency or self.default_concurrency
+        self.global_concurrency = global_concurrency or self.default_global_concurrency
+        self.budget = budget or self.default_budget
+        # zero cache size disables the cache
+        self.cache_size = self.default_cache_size if cache_size is None else cache_size
+        self.cache_ttl = self.default_cache_ttl if cache_ttl is None else cache_ttl
+        self.cache_path = cache_path or self.default_cache_path
+        self.max_bytes = max_bytes or self.default_max_bytes
+
+
+@dataclass
+class Documents:
+    max_bytes: int
+    max_tokens: int
+    window_share: float
+
+    default_max_bytes = 1024 * 1024
+    default_max_tokens = 0
+    default_window_share = 0.5
+
+    def __init__(
+        self,
+        max_bytes: int = default_max_bytes,
+        max_tokens: int = default_max_tokens,
+        window_share: float = default_window_share,
+    ) -> None:
+        self.max_bytes = max_bytes or self.default_max_bytes
+        # zero means 'as many as the window share allows'
+        self.max_tokens = max_tokens or self.default_max_tokens
+        self.window_share = window_share or self.default_window_share
+
+
 class Config:
     """Config properties."""
 
@@ -113,6 +391,28 @@ class Config:
             chat_ids=src["telegram"].get("chat_ids") or [],
         )
 
+        # Telegram update delivery settings.
+        src_webhook = src.get("webhook") or {}
+        self.webhook = Webhook(
+            url=src_webhook.get("url"),
+            listen=src_webhook.get("listen"),
+            port=src_webhook.get("port"),
+            path=src_webhook.get("path"),
+            secret_token=src_webhook.get("secret_token"),
+            cert=src_webhook.get("cert"),
+            key=src_webhook.get("key"),
+        )
+
+        # Update processing settings.
+        src_scheduler = src.get("scheduler") or {}
+        self.scheduler = Scheduler(concurrency=src_scheduler.get("concurrency"))
+        src_metrics = src.get("metrics") or {}
+        self.metrics = Metrics(
+            enabled=src_metrics.get("enabled"),
+            listen=src_metrics.get("listen"),
+            port=src_metrics.get("port"),
+        )
+
         # OpenAI settings.
         self.openai = OpenAI(
             url=src["openai"].get("url"),
@@ -122,6 +422,29 @@ class Config:
             window=src["openai"].get("window"),
             prompt=src["openai"].get("prompt"),
             params=src["openai"].get("params") or {},
+            stream=src["openai"].get("stream"),
+        )
+
+        # Additional AI providers.
+        self.providers = [
+            Provider(
+                url=src_provider.get("url"),
+                api_key=src_provider.get("api_key"),
+                weight=src_provider.get("weight"),
+                models=src_provider.get("models"),
+            )
+            for src_provider in src.get("providers") or []
+        ]
+        src_router = src.get("router") or {}
+        self.router = Router(
+            max_failures=src_router.get("max_failures"),
+            cooldown=src_router.get("cooldown"),
+        )
+        src_hedging = src.get("hedging") or {}
+        self.hedging = Hedging(
+            enabled=src_hedging.get("enabled"),
+            percentile=src_hedging.get("percentile"),
+            max_rate=src_hedging.get("max_rate"),
         )
 
         # Conversation settings.
@@ -133,9 +456,69 @@ class Config:
         # Image generation settings.
         self.imagine = Imagine(enabled=src["imagine"].get("enabled") or "")
 
+        # AI provider connection settings.
+        src_http = src.get("http") or {}
+        self.http = HTTP(
+            max_connections=src_http.get("max_connections"),
+            max_keepalive_connections=src_http.get("max_keepalive_connections"),
+            keepalive_expiry=src_http.get("keepalive_expiry"),
+            http2=src_http.get("http2"),
+            connect_timeout=src_http.get("connect_timeout"),
+            read_timeout=src_http.get("read_timeout"),
+        )
+
+        # AI provider retry settings.
+        src_retry = src.get("retry") or {}
+        self.retry = Retry(
+            max_attempts=src_retry.get("max_attempts"),
+            base_delay=src_retry.get("base_delay"),
+            max_delay=src_retry.get("max_delay"),
+            deadline=src_retry.get("deadline"),
+        )
+
+        # AI provider rate limits.
+        src_ratelimit = src.get("ratelimit") or {}
+        self.ratelimit = ProviderRateLimit(
+            requests_per_minute=src_ratelimit.get("requests_per_minute"),
+            tokens_per_minute=src_ratelimit.get("tokens_per_minute"),
+            models=src_ratelimit.get("models"),
+        )
+
+        # Chat completion cache settings.
+        src_cache = src.get("completion_cache") or {}
+        self.completion_cache = CompletionCache(
+            enabled=src_cache.get("enabled"),
+            size=src_cache.get("size"),
+            ttl=src_cache.get("ttl"),
+            allow_random=src_cache.get("allow_random"),
+        )
+
+        # Remote content settings.
+        src_fetcher = src.get("fetcher") or {}
+        self.fetcher = Fetcher(
+            concurrency=src_fetcher.get("concurrency"),
+            global_concurrency=src_fetcher.get("global_concurrency"),
+            budget=src_fetcher.get("budget"),
+            cache_size=src_fetcher.get("cache_size"),
+            cache_ttl=src_fetcher.get("cache_ttl"),
+            cache_path=src_fetcher.get("cache_path"),
+            max_bytes=src_fetcher.get("max_bytes"),
+        )
+
+        # Document (file) settings.
+        src_documents = src.get("documents") or {}
+        self.documents = Documents(
+            max_bytes=src_documents.get("max_bytes"),
+            max_tokens=src_documents.get("max_tokens"),
+            window_share=src_documents.get("window_share"),
+        )
+
         # Where to store the chat context file.
         self.persistence_path = src.get("persistence_path") or "./data/persistence.pkl"
 
+        # Where to look for tokenizer vocabulary files.
+        self.vocab_path = src.get("vocab_path") or "./data/vocab"
+
         # Custom AI commands (additional prompts).
         self.shortcuts = src.get("shortcuts") or {}
 
@@ -144,10 +527,23 @@ class Config:
         return {
             "schema_version": self.schema_version,
             "telegram": dataclasses.asdict(self.telegram),
+            "webhook": dataclasses.asdict(self.webhook),
+            "scheduler": dataclasses.asdict(self.scheduler),
+            "metrics": dataclasses.asdict(self.metrics),
             "openai": dataclasses.asdict(self.openai),
+            "providers": [dataclasses.asdict(provider) for provider in self.providers],
+            "router": dataclasses.asdict(self.router),
+            "hedging": dataclasses.asdict(self.hedging),
             "conversation": dataclasses.asdict(self.conversation),
             "imagine": dataclasses.asdict(self.imagine),
+            "http": dataclasses.asdict(self.http),
+            "retry": dataclasses.asdict(self.retry),
+            "ratelimit": dataclasses.asdict(self.ratelimit),
+            "completion_cache": dataclasses.asdict(self.completion_cache),
+            "fetcher": dataclasses.asdict(self.fetcher),
+            "documents": dataclasses.asdict(self.documents),
             "persistence_path": self.persistence_path,
+            "vocab_path": self.vocab_path,
             "shortcuts": self.shortcuts,
         }
 
@@ -169,14 +565,29 @@ class ConfigEditor:
     immediate = [
         "telegram",
         "openai",
+        "router",
+        "hedging",
         "conversation",
         "imagine",
         "shortcuts",
+        "completion_cache",
+        "retry",
+        "fetcher",
+        "documents",
     ]
     # Changes made to these properties take effect after a restart.
     delayed = [
         "telegram.token",
+        "webhook",
+        "metrics",
+        "scheduler",
+        "http",
+        "ratelimit",
+        "fetcher.global_concurrency",
+        "fetcher.cache_size",
+        "fetcher.cache_path",
         "persistence_path",
+        "vocab_path",
     ]
     # All editable properties.
     editable = immediate + delayed
@@ -256,7 +667,7 @@ class ConfigEditor:
         if names[0] not in self.editable:
             raise ValueError(f"Property {property} is not editable")
 
-        is_immediate = property not in self.delayed
+        is_immediate = property not in self.delayed and names[0] not in self.delayed
 
         obj = self.config
         for name in names[:-1]:
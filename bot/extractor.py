@@ -0,0 +1,289 @@
+"""
+HTML to text extraction.
+
+Makes a single streaming pass over the HTML, drops the parts that are of no use
+to the language model (scripts, styles, navigation, footers) and keeps
+the document structure (headings, lists, code blocks) as lightweight Markdown.
+"""
+
+from html.parser import HTMLParser
+import re
+from typing import Optional
+
+# Elements skipped together with their contents.
+SKIP_TAGS = {
+    "aside",
+    "footer",
+    "head",
+    "iframe",
+    "nav",
+    "noscript",
+    "script",
+    "style",
+    "svg",
+    "template",
+}
+
+# Elements allowed in <head>. Any other element implicitly closes the <head>.
+HEAD_TAGS = {"base", "link", "meta", "noscript", "script", "style", "template", "title"}
+
+# Elements that never have contents or an end tag.
+VOID_TAGS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "track",
+    "wbr",
+}
+
+# Elements that start on a new line.
+BLOCK_TAGS = {
+    "address",
+    "article",
+    "body",
+    "br",
+    "dd",
+    "div",
+    "dl",
+    "dt",
+    "figcaption",
+    "figure",
+    "form",
+    "header",
+    "hr",
+    "main",
+    "section",
+    "tr",
+}
+
+# Elements separated from the surrounding text by an empty line.
+PARAGRAPH_TAGS = {"blockquote", "ol", "p", "table", "ul"}
+
+HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+
+space_re = re.compile(r"\s+")
+
+
+def extract_text(html: str) -> str:
+    """
+    Extracts human-readable text from the HTML.
+    Returns the contents of the <main> element if there is one,
+    or the whole document otherwise.
+    """
+    extractor = TextExtractor()
+    parser = _Parser(extractor)
+    parser.feed(html)
+    parser.close()
+    return extractor.close()
+
+
+class TextExtractor:
+    """Collects text from parser events."""
+
+    def __init__(self) -> None:
+        self.parts: list[str] = []
+        # number of newlines at the end of the text
+        self.n_newlines = 2
+        # open elements, so that the end tags left out
+        # in the HTML can be implied from the enclosing ones
+        self.open: list[str] = []
+        # where the skipped element is in `open` (None when not skipping)
+        self.skip_at: Optional[int] = None
+        self.n_pre = 0
+        # ordered list item numbers (None for unordered lists)
+        self.lists: list[Optional[int]] = []
+        # where the <main> element starts and ends in `parts`
+        self.main_start = None
+        self.main_end = None
+        self.n_main = 0
+
+    def start(self, tag: str, attrib: dict) -> None:
+        """Handles an opening tag."""
+        if self.skip_at is not None and self.open[self.skip_at] == "head" and tag not in HEAD_TAGS:
+            # the </head> is optional, the body content closes the head
+            del self.open[self.skip_at :]
+            self.skip_at = None
+        if tag not in VOID_TAGS:
+            self.open.append(tag)
+            if tag in SKIP_TAGS and self.skip_at is None:
+                self.skip_at = len(self.open) - 1
+        if self.skip_at is not None:
+            return
+        if tag == "main":
+            if self.main_start is None:
+                self.main_start = len(self.parts)
+            self.n_main += 1
+        if tag in BLOCK_TAGS or (tag in ("ol", "ul") and self.lists):
+            # nested lists continue the outer list
+            self._newline(1)
+        elif tag in PARAGRAPH_TAGS:
+            self._newline(2)
+        elif tag in HEADING_TAGS:
+            self._newline(2)
+            self._write("#" * HEADING_TAGS[tag] + " ")
+        elif tag == "pre":
+            self._newline(2)
+            self._write("```\n")
+            self.n_pre += 1
+        elif tag == "code" and not self.n_pre:
+            self._write("`")
+        elif tag in ("td", "th"):
+            self._write(" ")
+
+        if tag == "ol":
+            self.lists.append(0)
+        elif tag == "ul":
+            self.lists.append(None)
+        elif tag == "li":
+            self._newline(1)
+            indent = "  " * max(len(self.lists) - 1, 0)
+            if self.lists and self.lists[-1] is not None:
+                self.lists[-1] += 1
+                self._write(f"{indent}{self.lists[-1]}. ")
+            else:
+                self._write(f"{indent}- ")
+
+    def end(self, tag: str) -> None:
+        """Handles a closing tag."""
+        idx = _rindex(self.open, tag)
+        if idx is not None:
+            # closes the element along with any elements left open inside it
+            del self.open[idx:]
+        if self.skip_at is not None:
+            if idx is None or idx > self.skip_at:
+                return
+            is_skipped = idx == self.skip_at
+            self.skip_at = None
+            if is_skipped:
+                return
+        if tag in BLOCK_TAGS or (tag in ("ol", "ul") and len(self.lists) > 1):
+            self._newline(1)
+        elif tag in PARAGRAPH_TAGS or tag in HEADING_TAGS:
+            self._newline(2)
+        elif tag == "pre" and self.n_pre:
+            self.n_pre -= 1
+            self._newline(1)
+            self._write("```")
+            self._newline(2)
+        elif tag == "code" and not self.n_pre:
+            self._write("`")
+
+        if tag in ("ol", "ul") and self.lists:
+            self.lists.pop()
+        elif tag == "main" and self.n_main:
+            self.n_main -= 1
+            if not self.n_main:
+                self.main_end = len(self.parts)
+
+    def data(self, text: str) -> None:
+        """Handles text between tags."""
+        if self.skip_at is not None:
+            return
+        if self.n_pre:
+            self._write(text)
+            return
+        text = space_re.sub(" ", text)
+        if self.n_newlines or (self.parts and self.parts[-1].endswith(" ")):
+            text = text.lstrip(" ")
+        self._write(text)
+
+    def close(self) -> str:
+        """Returns the extracted text."""
+        parts = self.parts
+        if self.main_start is not None:
+            main_parts = parts[self.main_start : self.main_end]
+            if "".join(main_parts).strip():
+                parts = main_parts
+        return "".join(parts).strip()
+
+    def _write(self, text: str) -> None:
+        """Appends text to the output."""
+        if not text:
+            return
+        self.parts.append(text)
+        stripped = text.rstrip("\n")
+        if stripped:
+            self.n_newlines = len(text) - len(stripped)
+        else:
+            self.n_newlines += len(text)
+
+    def _newline(self, count: int) -> None:
+        """Makes sure the text ends with at least `count` newlines."""
+        if self.n_newlines >= count:
+            return
+        if self.parts and self.parts[-1].endswith(" ") and not self.n_pre:
+            self.parts[-1] = self.parts[-1].rstrip(" ")
+        self._write("\n" * (count - self.n_newlines))
+
+
+def _rindex(items: list[str], item: str) -> Optional[int]:
+    """Returns the index of the last occurrence of the item, or None if there is none."""
+    for idx in range(len(items) - 1, -1, -1):
+        if items[idx] == item:
+            return idx
+    return None
+
+
+class _Parser(HTMLParser):
+    """Forwards the standard library parser events to the extractor."""
+
+    def __init__(self, target: TextExtractor) -> None:
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        self.target.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        self.target.start(tag, dict(attrs))
+        self.target.end(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        self.target.end(tag)
+
+    def handle_data(self, data: str) -> None:
+        self.target.data(data)
+
+
+def _benchmark(paths: list[str], repeat: int = 5) -> None:
+    """
+    Compares the extraction speed and output size
+    with the BeautifulSoup-based extraction on a set of saved pages.
+    """
+    import time
+    from bs4 import BeautifulSoup
+
+    def extract_soup(html: str) -> str:
+        soup = BeautifulSoup(html, "html.parser")
+        article = soup.find("main") or soup.find("body")
+        return article.get_text() if article else ""
+
+    pages = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as file:
+            pages.append(file.read())
+    n_bytes = sum(len(page) for page in pages)
+    print(f"pages: {len(pages)}, size: {n_bytes // 1024} KiB")
+
+    for name, func in (("beautifulsoup", extract_soup), ("extractor", extract_text)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            texts = [func(page) for page in pages]
+        elapsed = (time.perf_counter() - start) / repeat
+        n_chars = sum(len(text) for text in texts)
+        print(f"{name:>14}: {elapsed * 1000:8.1f} ms, {n_chars:>9} chars of text")
+
+
+if __name__ == "__main__":
+    # Usage: python -m bot.extractor page.html [page.html ...]
+    import sys
+
+    _benchmark(sys.argv[1:])
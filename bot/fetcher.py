@@ -1,8 +1,26 @@
 """Retrieves remote content over HTTP."""
 
+import asyncio
+import codecs
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+import logging
+import os
+import pickle
 import re
+import time
+from typing import NamedTuple, Optional
+from urllib import parse
 import httpx
-from bs4 import BeautifulSoup
+from bot import extractor
+from bot import metrics
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+
+# Approximate number of characters per token.
+CHARS_PER_TOKEN = 4
 
 
 class Fetcher:
@@ -14,39 +32,195 @@ class Fetcher:
 
     def __init__(self):
         self.client = httpx.AsyncClient(follow_redirects=True, timeout=self.timeout)
+        # limits concurrent requests across all messages
+        self.semaphore = asyncio.Semaphore(config.fetcher.global_concurrency)
+        self.cache = ContentCache(
+            max_size=config.fetcher.cache_size, path=config.fetcher.cache_path
+        )
 
-    async def substitute_urls(self, text: str) -> str:
+    async def substitute_urls(self, text: str, max_tokens: Optional[int] = None) -> str:
         """
         Extracts URLs from text, fetches their contents,
         and appends the contents to the text.
+        If `max_tokens` is set, stops reading the contents
+        once they are enough to fill that many tokens,
+        and does not fetch anything if there is no room left.
         """
         urls = self._extract_urls(text)
+        if not urls:
+            return text
+        if max_tokens is not None and max_tokens <= 0:
+            logger.debug("No room for the contents of %s URLs, skipping", len(urls))
+            return text
+        max_chars = None
+        if max_tokens is not None:
+            max_chars = max(max_tokens * CHARS_PER_TOKEN // len(set(urls)), 1)
+        contents = await self._fetch_urls(urls, max_chars)
         for url in urls:
-            content = await self._fetch_url(url)
-            text += f"\n\n---\n{url} contents:\n\n{content}\n---"
+            text += f"\n\n---\n{url} contents:\n\n{contents[url]}\n---"
         return text
 
     async def close(self) -> None:
-        """Frees network connections."""
+        """Frees network connections and saves cached contents."""
         await self.client.aclose()
+        self.cache.save()
 
     def _extract_urls(self, text: str) -> list[str]:
         """Extracts URLs from text."""
         urls = self.url_re.findall(text)
         return urls
 
-    async def _fetch_url(self, url: str) -> str:
-        """Retrieves URL content and returns it as text."""
+    async def _fetch_urls(self, urls: list[str], max_chars: Optional[int] = None) -> dict[str, str]:
+        """
+        Retrieves URL contents concurrently.
+        Gives up on the URLs that are not retrieved within the time budget.
+        """
+        # limits concurrent requests for a single message
+        semaphore = asyncio.Semaphore(config.fetcher.concurrency)
+
+        async def fetch(url: str) -> str:
+            async with semaphore, self.semaphore:
+                return await self._fetch_url(url, max_chars)
+
+        tasks = {url: asyncio.create_task(fetch(url)) for url in dict.fromkeys(urls)}
+        _, pending = await asyncio.wait(tasks.values(), timeout=config.fetcher.budget)
+        for task in pending:
+            task.cancel()
+
+        contents = {}
+        for url, task in tasks.items():
+            if task in pending:
+                contents[url] = "Failed to fetch (builtins.TimeoutError)"
+            else:
+                contents[url] = task.result()
+        return contents
+
+    async def _fetch_url(self, url: str, max_chars: Optional[int] = None) -> str:
+        """
+        Retrieves URL content and returns it as text.
+        Reads at most `max_chars` characters of text (if set).
+        Uses the cached content if it's still fresh or has not been modified.
+        """
+        key = _normalize_url(url)
+        entry = self.cache.get(key)
+        if entry and entry.expires_at > time.time():
+            metrics.fetch_seconds.observe(0, result="cached")
+            return _limit_text(entry.text, max_chars)
+        start = time.perf_counter()
         try:
-            response = await self.client.get(url)
-            response.raise_for_status()
-            content = Content(response)
-            return content.extract_text()
+            headers = entry.validators() if entry else {}
+            async with self.client.stream("GET", url, headers=headers) as response:
+                if entry and response.status_code == 304:
+                    # the cached content is still valid
+                    self.cache.put(key, entry._replace(expires_at=_calc_expires_at(response)))
+                    metrics.fetch_seconds.observe(
+                        time.perf_counter() - start, result="not_modified"
+                    )
+                    return _limit_text(entry.text, max_chars)
+                response.raise_for_status()
+                content = Content(response)
+                text = await content.read_text(config.fetcher.max_bytes, max_chars)
+            metrics.fetch_seconds.observe(time.perf_counter() - start, result="fetched")
+            metrics.fetch_bytes.inc(content.n_bytes)
+            if _is_cacheable(response) and not content.is_partial:
+                self.cache.put(
+                    key,
+                    CacheEntry(
+                        text=text,
+                        etag=response.headers.get("etag", ""),
+                        last_modified=response.headers.get("last-modified", ""),
+                        expires_at=_calc_expires_at(response),
+                    ),
+                )
+            return text
         except Exception as exc:
+            metrics.fetch_seconds.observe(time.perf_counter() - start, result="error")
             class_name = f"{exc.__class__.__module__}.{exc.__class__.__qualname__}"
             return f"Failed to fetch ({class_name})"
 
 
+class CacheEntry(NamedTuple):
+    """Extracted URL content along with its cache validators."""
+
+    text: str
+    etag: str
+    last_modified: str
+    # Unix time after which the content should be revalidated.
+    expires_at: float
+
+    def validators(self) -> dict:
+        """Returns conditional request headers."""
+        headers = {}
+        if self.etag:
+            headers["if-none-match"] = self.etag
+        if self.last_modified:
+            headers["if-modified-since"] = self.last_modified
+        return headers
+
+
+class ContentCache:
+    """
+    Caches extracted URL contents.
+    Evicts least recently used entries when the total size exceeds the limit.
+    """
+
+    def __init__(self, max_size: int, path: str = "") -> None:
+        # max_size is the maximum total size of the contents, in bytes.
+        # path is the file to save the cache to (if any).
+        self.max_size = max_size
+        self.path = path
+        self.size = 0
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.load()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Returns a cached entry (if any)."""
+        entry = self.entries.get(key)
+        if entry:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        """Adds an entry to the cache, evicting older ones if necessary."""
+        self.remove(key)
+        entry_size = _calc_size(entry)
+        if entry_size > self.max_size:
+            return
+        self.entries[key] = entry
+        self.size += entry_size
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= _calc_size(evicted)
+
+    def remove(self, key: str) -> None:
+        """Removes an entry from the cache."""
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= _calc_size(entry)
+
+    def load(self) -> None:
+        """Loads cached entries from disk."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as file:
+                entries = pickle.load(file)
+        except Exception as exc:
+            logger.warning("Failed to load content cache: %s", exc)
+            return
+        for key, entry in entries.items():
+            self.put(key, CacheEntry(*entry))
+
+    def save(self) -> None:
+        """Saves cached entries to disk."""
+        if not self.path:
+            return
+        # store plain tuples so that the file does not depend on the class
+        entries = {key: tuple(entry) for key, entry in self.entries.items()}
+        with open(self.path, "wb") as file:
+            pickle.dump(entries, file)
+
+
 class Content:
     """Extracts resource content as human-readable text."""
 
@@ -62,16 +236,62 @@ class Content:
         self.response = response
         content_type, _, _ = response.headers.get("content-type").partition(";")
         self.content_type = content_type
+        # True if the text was cut short to fit the requested length
+        self.is_partial = False
+        # the number of bytes read from the response
+        self.n_bytes = 0
 
     def extract_text(self) -> str:
         """Extracts resource content as human-readable text."""
         if not self.is_text():
             return "Unknown binary content"
+        return self._extract(self.response.text)
+
+    async def read_text(self, max_bytes: int, max_chars: Optional[int] = None) -> str:
+        """
+        Reads the content (at most `max_bytes`) from a streaming response
+        and extracts it as human-readable text.
+        Stops reading as soon as there are `max_chars` characters of text (if set).
+        Does not read the content at all unless it is text.
+        """
+        if not self.is_text():
+            return "Unknown binary content"
+
+        decoder = codecs.getincrementaldecoder(self.response.encoding or "utf-8")("replace")
+        parts = []
+        n_bytes, n_chars = 0, 0
+        is_truncated = False
+        async for chunk in self.response.aiter_bytes():
+            if n_bytes + len(chunk) > max_bytes:
+                chunk = chunk[: max_bytes - n_bytes]
+                is_truncated = True
+            n_bytes += len(chunk)
+            self.n_bytes = n_bytes
+            part = decoder.decode(chunk)
+            parts.append(part)
+            n_chars += len(part)
+            if is_truncated:
+                break
+            # html markup takes more space than the resulting text,
+            # so only stop early for plain text
+            if max_chars is not None and self.content_type != "text/html" and n_chars > max_chars:
+                break
+        parts.append(decoder.decode(b"", final=True))
+
+        text = self._extract("".join(parts))
+        if max_chars is not None and len(text) > max_chars:
+            text = text[:max_chars]
+            self.is_partial = True
+            is_truncated = True
+        if is_truncated:
+            text += "\n[truncated]"
+        return text
+
+    def _extract(self, text: str) -> str:
+        """Extracts human-readable text from the content."""
         if self.content_type != "text/html":
-            return self.response.text
-        html = BeautifulSoup(self.response.text, "html.parser")
-        article = html.find("main") or html.find("body")
-        return article.get_text()
+            return text
+        return extractor.extract_text(text)
 
     def is_text(self) -> bool:
         """Checks if the content type is plain text."""
@@ -82,3 +302,52 @@ class Content:
         if self.content_type in self.allowed_content_types:
             return True
         return False
+
+
+def _limit_text(text: str, max_chars: Optional[int]) -> str:
+    """Cuts the (cached) text short to fit the requested length."""
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    return text[:max_chars] + "\n[truncated]"
+
+
+def _normalize_url(url: str) -> str:
+    """Normalizes the URL so that equivalent URLs share a cache entry."""
+    parts = parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, parts.port) in (("http", 80), ("https", 443)):
+        netloc = netloc.rpartition(":")[0]
+    path = parts.path or "/"
+    return parse.urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+def _is_cacheable(response: httpx.Response) -> bool:
+    """Checks if the response is allowed to be cached."""
+    cache_control = response.headers.get("cache-control", "").lower()
+    return response.status_code == 200 and "no-store" not in cache_control
+
+
+def _calc_expires_at(response: httpx.Response) -> float:
+    """Returns the time until which the response is fresh."""
+    now = time.time()
+    cache_control = response.headers.get("cache-control", "").lower()
+    directives = [item.strip() for item in cache_control.split(",")]
+    if "no-cache" in directives:
+        # always revalidate
+        return now
+    for directive in directives:
+        name, _, value = directive.partition("=")
+        if name == "max-age" and value.isdigit():
+            return now + int(value)
+    if "expires" in response.headers:
+        try:
+            return parsedate_to_datetime(response.headers["expires"]).timestamp()
+        except (TypeError, ValueError):
+            return now
+    return now + config.fetcher.cache_ttl
+
+
+def _calc_size(entry: CacheEntry) -> int:
+    """Returns the approximate size of the cache entry in bytes."""
+    return len(entry.text.encode("utf-8")) + len(entry.etag) + len(entry.last_modified)
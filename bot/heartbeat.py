@@ -0,0 +1,80 @@
+"""
+Chat action heartbeat.
+
+Telegram shows a chat action ("typing", "sending photo") for about 5 seconds,
+so the bot repeats the action while it is working on an answer.
+"""
+
+import asyncio
+import contextlib
+import logging
+from typing import AsyncIterator, Optional
+from telegram import Bot, Message
+
+logger = logging.getLogger(__name__)
+
+# How often to repeat the action (in seconds).
+INTERVAL = 4.0
+
+
+class Heartbeat:
+    """Repeats a chat action until stopped."""
+
+    def __init__(self, bot: Bot, chat_id: int, action: str, thread_id: Optional[int]) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.action = action
+        self.thread_id = thread_id
+        # the number of answers the action is shown for
+        self.n_users = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Starts repeating the action."""
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops repeating the action."""
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.bot.send_chat_action(
+                    chat_id=self.chat_id, action=self.action, message_thread_id=self.thread_id
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # the action is nice to have, so never fail because of it
+                logger.debug("Failed to send chat action %s: %s", self.action, exc)
+            await asyncio.sleep(INTERVAL)
+
+
+# Running heartbeats by chat, thread and action.
+_heartbeats: dict[tuple, Heartbeat] = {}
+
+
+@contextlib.asynccontextmanager
+async def keep(message: Message, action: str) -> AsyncIterator[None]:
+    """
+    Shows the chat action in the message's chat (and thread)
+    for as long as the `async with` block runs.
+    Answers in progress in the same chat share the heartbeat.
+    """
+    key = (message.chat_id, message.message_thread_id, action)
+    heartbeat = _heartbeats.get(key)
+    if heartbeat is None:
+        heartbeat = Heartbeat(message.get_bot(), message.chat_id, action, message.message_thread_id)
+        _heartbeats[key] = heartbeat
+        heartbeat.start()
+    heartbeat.n_users += 1
+    try:
+        yield
+    finally:
+        heartbeat.n_users -= 1
+        if heartbeat.n_users == 0:
+            del _heartbeats[key]
+            await heartbeat.stop()
@@ -1,38 +1,384 @@
 """Markdown/HTML text formatting."""
 
 import re
+from typing import Callable
 
-# Code blocks, e.g.:
+# Code block fences, e.g.:
 # ```sql
 # select count(*) from messages;
 # ```
-pre_re = re.compile(r"^[ ]*```\w*$(.+?)^```$", re.MULTILINE | re.DOTALL)
+fence_re = re.compile(r"[ ]*```([\w+#-]*)[ ]*$")
 
-# Inline code, e.g.:
-# `print(message)` displays the message.
-code_re = re.compile(r"`([^`\n]+)`")
-
-# Bold text, e.g.:
-# **Note**. Cats **do** like boxes.
-bold_re = re.compile(r"\*\*([^<*]+?)\*\*")
+# Headings, e.g.:
+# ## Installation
+heading_re = re.compile(r"#{1,6}[ ]+(.+?)[ #]*$")
 
 # Unordered list items, e.g.:
 # *   Wake up.
-# *   Have breakfast.
-# *   Go to work.
-bullet_re = re.compile(r"^\*\s\s+(.+)$", re.MULTILINE)
+# -   Have breakfast.
+# +   Go to work.
+bullet_re = re.compile(r"([ ]*)[*+-][ ]+(?=\S)")
+
+# Characters that start inline formatting or need escaping.
+inline_re = re.compile(r"[`*_\[&<>]")
+
+# Characters that start block-level syntax (headings and list items).
+block_chars = ("#", "*", "+", "-", " ")
+
+# Link URL schemes Telegram accepts.
+link_schemes = ("http://", "https://", "tg://", "mailto:")
+
+# Opening and closing HTML tags, e.g. <pre>, <a href="...">, </b>.
+tag_re = re.compile(r"<(/?)(\w+)[^>]*>")
+
+# HTML entities Telegram requires to escape.
+entities = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+
+# Inline formatting markers and their tags.
+inline_tags = {"**": "b", "__": "b", "*": "i", "_": "i"}
 
 
 def to_html(text: str) -> str:
     """
     Converts Markdown text to "Telegram HTML", which supports only some of the tags.
     See https://core.telegram.org/bots/api#html-style for details.
-    Escapes certain entities and converts `code` and `pre`,
-    but ignores all other formatting.
-    """
-    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-    text = pre_re.sub(r"<pre>\1</pre>", text)
-    text = code_re.sub(r"<code>\1</code>", text)
-    text = bold_re.sub(r"<b>\1</b>", text)
-    text = bullet_re.sub(r"— \1", text)
-    return text
+    Supports code blocks, inline code, bold and italic text, links,
+    headings, lists and blockquotes, and escapes everything else.
+    Renders the text in a single pass, so code blocks are never reformatted.
+    """
+    out = []
+    pos = 0
+    while pos <= len(text):
+        start, lang, code_start = _find_fence(text, pos)
+        if start < 0:
+            out.append(_render_lines(text[pos:]))
+            break
+        if start > pos:
+            # the text before the code block ends with a line break
+            out.append(_render_lines(text[pos : start - 1]))
+            out.append("\n")
+        end, next_pos = _find_closing_fence(text, code_start)
+        code = _escape(text[code_start:end])
+        if lang:
+            out.append(f'<pre><code class="language-{lang}">{code}</code></pre>')
+        else:
+            out.append(f"<pre>{code}</pre>")
+        if next_pos > len(text):
+            break
+        out.append("\n")
+        pos = next_pos
+    return "".join(out)
+
+
+def _find_fence(text: str, pos: int) -> tuple[int, str, int]:
+    """
+    Finds the next opening code fence starting from `pos`.
+    Returns the start of the fence line, the code language and the start of the code,
+    or -1 as the start if there is no code block.
+    """
+    idx = text.find("```", pos)
+    while idx >= 0:
+        line_start = max(text.rfind("\n", pos, idx) + 1, pos)
+        line_end = text.find("\n", idx)
+        if line_end < 0:
+            line_end = len(text)
+        match = fence_re.match(text, line_start, line_end)
+        if match and (line_start == 0 or text[line_start - 1] == "\n"):
+            return line_start, match.group(1), min(line_end + 1, len(text))
+        idx = text.find("```", line_end)
+    return -1, "", -1
+
+
+def _find_closing_fence(text: str, pos: int) -> tuple[int, int]:
+    """
+    Finds the closing code fence starting from `pos`.
+    Returns the end of the code and the position after the fence line.
+    The code block lasts to the end of the text if there is no closing fence.
+    """
+    idx = text.find("```", pos)
+    while idx >= 0:
+        line_start = max(text.rfind("\n", pos, idx) + 1, pos)
+        line_end = text.find("\n", idx)
+        if line_end < 0:
+            line_end = len(text)
+        if text[line_start:line_end].strip(" ") == "```":
+            return max(line_start - 1, pos), line_end + 1
+        idx = text.find("```", line_end)
+    return len(text), len(text) + 1
+
+
+def _render_lines(text: str) -> str:
+    """Renders text without code blocks line by line."""
+    out = []
+    quoted: list[str] = []
+    for line in text.split("\n"):
+        first = line[:1]
+        if first == ">":
+            quoted.append(line[2:] if line[1:2] == " " else line[1:])
+            continue
+        if quoted:
+            out.append(_render_quote(quoted))
+            quoted = []
+        if first in block_chars:
+            out.append(_render_line(line))
+        else:
+            out.append(_render_inline(line))
+    if quoted:
+        out.append(_render_quote(quoted))
+    return "\n".join(out)
+
+
+def _render_quote(lines: list[str]) -> str:
+    """Renders a blockquote."""
+    return "<blockquote>" + "\n".join(_render_line(line) for line in lines) + "</blockquote>"
+
+
+def _render_line(line: str) -> str:
+    """Renders a line outside of code blocks."""
+    first = line[:1]
+    if first == " ":
+        first = line.lstrip(" ")[:1]
+    if first == "#":
+        match = heading_re.match(line)
+        if match:
+            return "<b>" + _render_inline(match.group(1)) + "</b>"
+    elif first in ("*", "+", "-"):
+        match = bullet_re.match(line)
+        if match:
+            return match.group(1) + "— " + _render_inline(line[match.end() :])
+    return _render_inline(line)
+
+
+def _render_inline(text: str) -> str:
+    """Renders inline code, bold and italic text and links."""
+    match = inline_re.search(text)
+    if not match:
+        return text
+    out = []
+    pos = 0
+    # results of the searches for closing markers (see `_find`)
+    found: dict[str, tuple[int, int]] = {}
+    while match:
+        idx = match.start()
+        out.append(text[pos:idx])
+        char = match.group()
+        if char == "`":
+            html, pos = _render_code(text, idx)
+        elif char == "*" or char == "_":
+            html, pos = _render_emphasis(text, idx, found)
+        elif char == "[":
+            html, pos = _render_link(text, idx, found)
+        else:
+            html, pos = entities[char], idx + 1
+        out.append(html)
+        match = inline_re.search(text, pos)
+    out.append(text[pos:])
+    return "".join(out)
+
+
+def _render_code(text: str, start: int) -> tuple[str, int]:
+    """Renders inline code starting at `start`, e.g. `print(message)` or ``a`b``."""
+    after = start + 1
+    while after < len(text) and text[after] == "`":
+        after += 1
+    ticks = text[start:after]
+    end = text.find(ticks, after)
+    while end >= 0 and text[end + len(ticks) : end + len(ticks) + 1] == "`":
+        # the closing backticks should be as many as the opening ones
+        end = text.find(ticks, end + len(ticks) + 1)
+    if end <= after:
+        return ticks, after
+    return "<code>" + _escape(text[after:end]) + "</code>", end + len(ticks)
+
+
+def _render_emphasis(text: str, start: int, found: dict[str, tuple[int, int]]) -> tuple[str, int]:
+    """Renders bold or italic text starting at `start`, e.g. **bold** or _italic_."""
+    char = text[start]
+    marker = char * 2 if text.startswith(char * 2, start) else char
+    after = start + len(marker)
+    if after >= len(text) or text[after].isspace() or text[after] == char:
+        # not an opening marker
+        return marker, after
+    if char == "_" and start > 0 and text[start - 1].isalnum():
+        # underscores inside words, e.g. snake_case
+        return marker, after
+    end = _find(found, marker, after, lambda pos: _find_closing(text, marker, pos))
+    if end < 0:
+        return marker, after
+    tag = inline_tags[marker]
+    inner = _render_inline(text[after:end])
+    return f"<{tag}>{inner}</{tag}>", end + len(marker)
+
+
+def _find_closing(text: str, marker: str, start: int) -> int:
+    """Returns the position of the closing emphasis marker, or -1 if there is none."""
+    char = marker[0]
+    end = text.find(marker, start)
+    while end >= 0:
+        after = end + len(marker)
+        if (
+            not text[end - 1].isspace()
+            and text[end - 1] != char
+            and text[after : after + 1] != char
+            and not (char == "_" and text[after : after + 1].isalnum())
+        ):
+            return end
+        end = text.find(marker, end + 1)
+    return -1
+
+
+def _render_link(text: str, start: int, found: dict[str, tuple[int, int]]) -> tuple[str, int]:
+    """Renders a link starting at `start`, e.g. [Documentation](https://example.com)."""
+    middle = _find(found, "](", start + 1, lambda pos: text.find("](", pos))
+    if middle <= start + 1:
+        return "[", start + 1
+    end = _find(found, ")", middle + 2, lambda pos: text.find(")", pos))
+    if end < 0:
+        return "[", start + 1
+    url = text[middle + 2 : end]
+    if not url.startswith(link_schemes) or " " in url:
+        return "[", start + 1
+    label = _render_inline(text[start + 1 : middle])
+    url = _escape(url).replace('"', "&quot;")
+    return f'<a href="{url}">{label}</a>', end + 1
+
+
+def _find(
+    found: dict[str, tuple[int, int]], key: str, start: int, search: Callable[[int], int]
+) -> int:
+    """
+    Returns `search(start)`, the first position of `key` at or after `start` (or -1),
+    reusing the previous search for the same key when it gives the same result.
+    Otherwise, every opening marker without a closing one would rescan the rest of the text.
+    """
+    if key in found:
+        prev_start, prev_end = found[key]
+        if prev_start <= start and (prev_end < 0 or start <= prev_end):
+            return prev_end
+    end = search(start)
+    found[key] = (start, end)
+    return end
+
+
+def _escape(text: str) -> str:
+    """Escapes the HTML entities Telegram requires to escape."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def split(html: str, size: int) -> list[str]:
+    """
+    Splits Telegram HTML into chunks of at most `size` characters.
+    Prefers to split between paragraphs, then between lines, then between words.
+    Keeps the tags balanced: the tags open at the end of a chunk
+    (e.g. a <pre> block split in two) are closed there and reopened in the next chunk.
+    """
+    chunks = []
+    open_tags: list[tuple[str, str]] = []
+    pos = 0
+    while pos < len(html):
+        prefix = "".join(tag for _, tag in open_tags)
+        budget = size - len(prefix)
+        while True:
+            end = _find_cut(html, pos, pos + budget)
+            tags = _scan_tags(html, pos, end, open_tags)
+            suffix = "".join(f"</{name}>" for name, _ in reversed(tags))
+            if len(prefix) + (end - pos) + len(suffix) <= size or budget <= 1:
+                break
+            # leave room for the closing tags
+            budget = size - len(prefix) - len(suffix)
+        chunk = html[pos:end].rstrip()
+        if chunk:
+            chunks.append(prefix + chunk + suffix)
+        open_tags = tags
+        pos = end
+        if html[pos : pos + 1] == " ":
+            # split between words
+            pos += 1
+        while pos < len(html) and html[pos] == "\n":
+            pos += 1
+    return chunks
+
+
+def _find_cut(html: str, start: int, limit: int) -> int:
+    """
+    Returns the position to split the html at, at most `limit`.
+    Never splits inside a tag or an entity.
+    """
+    if limit >= len(html):
+        return len(html)
+    # prefer chunks that are at least half full
+    min_cut = start + (limit - start) // 2
+    for sep, min_pos in (("\n\n", min_cut), ("\n", min_cut), (" ", min_cut), (" ", start + 1)):
+        cut = html.rfind(sep, min_pos, limit + len(sep))
+        if cut > start:
+            break
+    else:
+        cut = limit
+    # move the cut before a tag or an entity it falls into
+    tag_start = html.rfind("<", start, cut)
+    if tag_start > html.rfind(">", start, cut):
+        cut = tag_start
+    entity_start = html.rfind("&", start, cut)
+    if entity_start > html.rfind(";", start, cut):
+        cut = entity_start
+    if cut <= start:
+        # a single tag or entity that does not fit, so cut it anyway
+        cut = limit
+    return cut
+
+
+def _scan_tags(
+    html: str, start: int, end: int, open_tags: list[tuple[str, str]]
+) -> list[tuple[str, str]]:
+    """Returns the (name, opening tag) pairs open at `end` given those open at `start`."""
+    tags = list(open_tags)
+    for match in tag_re.finditer(html, start, end):
+        name = match.group(2)
+        if not match.group(1):
+            tags.append((name, match.group()))
+        elif tags and tags[-1][0] == name:
+            tags.pop()
+    return tags
+
+
+def _benchmark(paths: list[str], repeat: int = 20) -> None:
+    """
+    Compares the rendering speed with the previous regex-based converter
+    on a set of saved answers.
+    """
+    import time
+
+    pre_re = re.compile(r"^[ ]*```\w*$(.+?)^```$", re.MULTILINE | re.DOTALL)
+    code_re = re.compile(r"`([^`\n]+)`")
+    bold_re = re.compile(r"\*\*([^<*]+?)\*\*")
+    old_bullet_re = re.compile(r"^\*\s\s+(.+)$", re.MULTILINE)
+
+    def to_html_regex(text: str) -> str:
+        text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        text = pre_re.sub(r"<pre>\1</pre>", text)
+        text = code_re.sub(r"<code>\1</code>", text)
+        text = bold_re.sub(r"<b>\1</b>", text)
+        text = old_bullet_re.sub(r"— \1", text)
+        return text
+
+    answers = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as file:
+            answers.append(file.read())
+    n_chars = sum(len(answer) for answer in answers)
+    print(f"answers: {len(answers)}, size: {n_chars // 1024} KiB")
+
+    for name, func in (("regex", to_html_regex), ("single-pass", to_html)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for answer in answers:
+                func(answer)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{name:>12}: {elapsed * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    # Usage: python -m bot.markdown answer.md [answer.md ...]
+    import sys
+
+    _benchmark(sys.argv[1:])
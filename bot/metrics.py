@@ -0,0 +1,280 @@
+"""
+Bot performance metrics.
+
+Counters, gauges and histograms kept in memory and served over HTTP
+in the Prometheus text exposition format, so any scraper (or curl)
+can read them without an external service.
+"""
+
+import asyncio
+import contextlib
+import logging
+import math
+import time
+from typing import Callable, Iterator, Mapping, Optional, Union
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets for durations (in seconds).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The maximum size of an HTTP request to the metrics endpoint.
+MAX_REQUEST_SIZE = 8192
+
+# Label values to sample value, or a single value for metrics without labels.
+Samples = Union[float, Mapping[Union[str, tuple], float]]
+
+# All metrics, in the order they were created.
+_metrics: list["Metric"] = []
+
+# The HTTP server serving the metrics.
+_server: Optional[asyncio.AbstractServer] = None
+
+
+class Metric:
+    """A named metric with optional labels."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self.func: Optional[Callable[[], Samples]] = None
+        _metrics.append(self)
+
+    def set_function(self, func: Callable[[], Samples]) -> None:
+        """Takes the metric values from the function instead of storing them."""
+        self.func = func
+
+    def get(self, **labels: str) -> float:
+        """Returns the metric value for the labels."""
+        return self.values.get(self._key(labels), 0.0)
+
+    def render(self) -> str:
+        """Returns the metric in the text exposition format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        """Yields the metric samples as (name suffix, labels, value)."""
+        values = self.values
+        if self.func is not None:
+            values = self.func()
+            if not isinstance(values, Mapping):
+                values = {(): values}
+        for key, value in sorted(values.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            yield "", dict(zip(self.labels, key)), value
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name}: expected labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increments the counter."""
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        """Sets the gauge value."""
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts observed values (usually durations) in buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # bucket counts (not cumulative) by label values
+        self.counts: dict[tuple, list[int]] = {}
+        # sum of the observed values by label values
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Records an observed value."""
+        key = self._key(labels)
+        if key not in self.counts:
+            self.counts[key] = [0] * len(self.buckets)
+            self.sums[key] = 0.0
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[key][idx] += 1
+                break
+        self.sums[key] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes the duration of the `with` block (in seconds)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels: str) -> float:
+        """Returns the number of observed values for the labels."""
+        return sum(self.counts.get(self._key(labels), []))
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        for key, counts in sorted(self.counts.items()):
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield "_bucket", {**labels, "le": _format_value(bound)}, total
+            yield "_sum", labels, self.sums[key]
+            yield "_count", labels, total
+
+
+def render() -> str:
+    """Returns all the metrics in the text exposition format."""
+    return "".join(metric.render() for metric in _metrics)
+
+
+async def serve(host: str, port: int) -> None:
+    """Starts serving the metrics over HTTP."""
+    global _server
+    _server = await asyncio.start_server(_handle, host, port, limit=MAX_REQUEST_SIZE)
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+
+
+async def close() -> None:
+    """Stops serving the metrics."""
+    global _server
+    if _server is None:
+        return
+    _server.close()
+    await _server.wait_closed()
+    _server = None
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Responds to an HTTP request."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        method, path, *_ = head.decode("latin-1").split(" ", 2)
+        path = path.partition("?")[0]
+        if method != "GET":
+            status, body = "405 Method Not Allowed", "Method not allowed\n"
+        elif path not in ("/", "/metrics"):
+            status, body = "404 Not Found", "Not found\n"
+        else:
+            status, body = "200 OK", render()
+        data = body.encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+        pass
+    except ConnectionError as exc:
+        logger.debug("Metrics client disconnected: %s", exc)
+    finally:
+        writer.close()
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class TelegramRequest(HTTPXRequest):
+    """Telegram Bot API requests that record their latency."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rpartition("/")[2]
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - start, method=api_method)
+
+
+# Bot metrics.
+
+questions = Counter("bot_questions_total", "Questions asked, by chat type.", ("chat_type",))
+answer_seconds = Histogram("bot_answer_seconds", "Time to answer a question.")
+errors = Counter("bot_errors_total", "Errors while handling updates, by class.", ("type",))
+queue_depth = Gauge("bot_queue_depth", "Updates waiting for their turn.")
+updates_running = Gauge("bot_updates_running", "Updates being processed.")
+
+provider_request_seconds = Histogram(
+    "bot_provider_request_seconds",
+    "AI provider request latency (including retries), by provider and outcome.",
+    ("provider", "outcome"),
+)
+provider_first_token_seconds = Histogram(
+    "bot_provider_first_token_seconds",
+    "Time to the first token of a streaming answer, by model.",
+    ("model",),
+)
+provider_retries = Counter(
+    "bot_provider_retries_total",
+    "AI provider request retries by reason, and requests failed after all retries.",
+    ("reason",),
+)
+ratelimit_wait_seconds = Histogram(
+    "bot_ratelimit_wait_seconds", "Time spent waiting for the provider rate limits."
+)
+
+fetch_seconds = Histogram(
+    "bot_fetch_seconds", "Remote content fetch latency, by result.", ("result",)
+)
+fetch_bytes = Counter("bot_fetch_bytes_total", "Remote content bytes downloaded.")
+
+telegram_request_seconds = Histogram(
+    "bot_telegram_request_seconds", "Telegram Bot API request latency, by method.", ("method",)
+)
+
+persistence_write_seconds = Histogram(
+    "bot_persistence_write_seconds",
+    "Time to write changed data to the database, by kind.",
+    ("kind",),
+)
@@ -2,11 +2,39 @@
 
 from collections import deque
 import datetime as dt
-from typing import Generic, Mapping, NamedTuple, Optional, TypeVar
+import hashlib
+import re
+from typing import Generic, Mapping, NamedTuple, Optional, TypeVar, Union
+import zlib
 from bot.config import config
 
 T = TypeVar("T")
 
+# Message texts at least this long are stored in a compact form (see `Packed`).
+PACK_MIN_LEN = 1024
+
+# Attached documents and fetched contents start with one of these,
+# so everything before them is the question itself.
+attachment_re = re.compile(r"\n```|\n\n---\n")
+
+# Data key for the modification counter.
+# The models increment it whenever they change the data,
+# so the persistence can skip saving the data that has not changed.
+VERSION_KEY = "_version"
+
+
+def touch(data: Mapping) -> None:
+    """Marks the data as modified."""
+    data[VERSION_KEY] = data.get(VERSION_KEY, 0) + 1
+
+
+def get_version(data: Mapping) -> Optional[int]:
+    """
+    Returns the data modification counter,
+    or None if the data is not tracked by the models.
+    """
+    return data.get(VERSION_KEY)
+
 
 class ChatData:
     """Represents data associated with a specific chat."""
@@ -21,7 +49,9 @@ class ChatData:
 
     @model.setter
     def model(self, value: str) -> str:
-        self.data["model"] = value
+        if self.data.get("model") != value:
+            self.data["model"] = value
+            touch(self.data)
 
     @property
     def prompt(self) -> str:
@@ -29,7 +59,9 @@ class ChatData:
 
     @prompt.setter
     def prompt(self, value: str) -> str:
-        self.data["prompt"] = value
+        if self.data.get("prompt") != value:
+            self.data["prompt"] = value
+            touch(self.data)
 
 
 class UserData:
@@ -51,38 +83,92 @@ class UserMessage(NamedTuple):
     answer: str
 
 
+class Packed(NamedTuple):
+    """
+    Represents a message text stored in a compact form:
+    the short part is kept as is, while the bulky part (e.g. an attached document)
+    is compressed and stored separately, referenced by its content hash.
+    """
+
+    text: str
+    key: str
+
+
+class MessageTokens(NamedTuple):
+    """Represents the number of tokens in a question and an answer."""
+
+    # Counting algorithm stamp (the counts are only valid for this algorithm).
+    version: str
+    question: int
+    answer: int
+
+
 class UserMessages:
-    """Represents user message history."""
+    """
+    Represents user message history.
+    Stores long questions and answers as `Packed` texts,
+    with the bulky parts kept once per user in the 'blobs' mapping.
+    """
 
     def __init__(self, data: Mapping, maxlen: int) -> None:
-        messages = data.get("messages") or []
-        data["messages"] = deque(messages, maxlen)
+        messages = data.get("messages")
+        if not isinstance(messages, deque) or messages.maxlen != maxlen:
+            data["messages"] = deque(messages or [], maxlen)
+            touch(data)
+        tokens = data.get("tokens")
+        if len(tokens or []) != len(data["messages"]):
+            # token counts are missing or out of sync with messages
+            tokens = [None] * len(data["messages"])
+        if not isinstance(tokens, deque) or tokens.maxlen != maxlen:
+            data["tokens"] = deque(tokens or [], maxlen)
+            touch(data)
         self.data = data
         self.messages = data["messages"]
+        self.tokens = data["tokens"]
 
     @property
     def last(self) -> Optional[UserMessage]:
         """The latest chat message (if any)."""
         if not self.messages:
             return None
-        return self.messages[-1]
+        return self._unpack(self.messages[-1])
 
-    def add(self, question: str, answer: str):
-        """Adds a message to the message history."""
-        self.messages.append(UserMessage(question, answer))
+    def add(self, question: str, answer: str, tokens: Optional[MessageTokens] = None):
+        """
+        Adds a message to the message history,
+        along with the number of tokens in it (if known).
+        """
+        message = UserMessage(self._pack_text(question), self._pack_text(answer))
+        self.messages.append(message)
+        self.tokens.append(tokens)
+        self._collect()
+        touch(self.data)
 
     def pop(self) -> Optional[UserMessage]:
         """Removes the last message from the message history and returns it."""
         if not self.messages:
             return None
-        return self.messages.pop()
+        self.tokens.pop()
+        message = self._unpack(self.messages.pop())
+        self._collect()
+        touch(self.data)
+        return message
 
     def clear(self):
         """Cleares messages history."""
+        if not self.messages and not self.tokens:
+            return
         self.messages.clear()
+        self.tokens.clear()
+        self._collect()
+        touch(self.data)
 
     def as_list(self):
-        return list(self.messages)
+        return [self._unpack(message) for message in self.messages]
+
+    def tokens_list(self) -> list[Optional[MessageTokens]]:
+        """Returns the number of tokens in each message (if known)."""
+        return list(self.tokens)
 
     def __str__(self) -> str:
         return str(self.messages)
@@ -90,6 +176,41 @@ class UserMessages:
     def __repr__(self) -> str:
         return repr(self.messages)
 
+    def _pack_text(self, text: str) -> Union[str, Packed]:
+        """Converts a long text into the compact form."""
+        if len(text) < PACK_MIN_LEN:
+            return text
+        match = attachment_re.search(text)
+        idx = match.start() if match else 0
+        body = text[idx:].encode("utf-8")
+        key = hashlib.sha1(body).hexdigest()
+        blobs = self.data.setdefault("blobs", {})
+        if key not in blobs:
+            blobs[key] = zlib.compress(body)
+        return Packed(text[:idx], key)
+
+    def _unpack_text(self, value: Union[str, Packed]) -> str:
+        """Restores a text from the compact form."""
+        if not isinstance(value, Packed):
+            return value
+        blob = self.data.get("blobs", {}).get(value.key)
+        if blob is None:
+            return value.text
+        return value.text + zlib.decompress(blob).decode("utf-8")
+
+    def _unpack(self, message: UserMessage) -> UserMessage:
+        """Restores a message from the compact form."""
+        return UserMessage(self._unpack_text(message.question), self._unpack_text(message.answer))
+
+    def _collect(self) -> None:
+        """Removes the blobs that are no longer referenced by messages."""
+        blobs = self.data.get("blobs")
+        if not blobs:
+            return
+        keys = {value.key for msg in self.messages for value in msg if isinstance(value, Packed)}
+        for key in blobs.keys() - keys:
+            del blobs[key]
+
 
 class TimestampedValue(Generic[T]):
     """A value with a 'last modified' timestamp."""
@@ -97,6 +218,8 @@ class TimestampedValue(Generic[T]):
     def __init__(self, data: Mapping, name: str, initial: Optional[T] = None) -> None:
         if name not in data:
             data[name] = {"value": initial, "timestamp": dt.datetime.now()}
+            touch(data)
+        self._parent = data
         self._data = data[name]
 
     @property
@@ -109,6 +232,7 @@ class TimestampedValue(Generic[T]):
         """Sets the value."""
         self._data["value"] = value
         self._data["timestamp"] = dt.datetime.now()
+        touch(self._parent)
 
     @property
     def timestamp(self) -> dt.datetime:
@@ -144,9 +268,8 @@ class ExpiringCounter:
 
     def increment(self) -> int:
         """Increments and returns the counter value."""
-        if self.is_expired():
-            self._data.value = 0
-        self._data.value += 1
+        value = 0 if self.is_expired() else self._data.value
+        self._data.value = value + 1
         return self._data.value
 
 
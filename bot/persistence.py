@@ -0,0 +1,241 @@
+"""
+Bot data persistence.
+
+Stores user and chat data in SQLite, one row per user or chat,
+so that saving the data only touches the rows that have changed.
+Loads the data lazily, when a user or chat sends an update.
+Relies on the models to tell whether the data has changed (see `models.touch`).
+Queries run in a dedicated thread, so they do not block the event loop.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import pickle
+import sqlite3
+from typing import Any, Callable, Optional, TypeVar
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+from bot import metrics
+from bot import models
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+create table if not exists data (
+    kind text not null,
+    id integer not null,
+    value blob not null,
+    primary key (kind, id)
+);
+create table if not exists conversations (
+    name text not null,
+    key text not null,
+    state blob not null,
+    primary key (name, key)
+);
+"""
+
+# Data kinds.
+USER = "user"
+CHAT = "chat"
+BOT = "bot"
+
+T = TypeVar("T")
+
+
+def create(path: str) -> BasePersistence:
+    """
+    Creates a persistence for the file path.
+    Uses SQLite for *.db and *.sqlite files, and a pickle file otherwise.
+    """
+    if path.endswith((".db", ".sqlite")):
+        return SqlitePersistence(path)
+    return PicklePersistence(filepath=path)
+
+
+class SqlitePersistence(BasePersistence):
+    """Stores bot data in an SQLite database."""
+
+    def __init__(self, path: str, update_interval: float = 60) -> None:
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False), update_interval=update_interval
+        )
+        self.path = path
+        # the connection is only used by one thread at a time:
+        # the executor runs the queries one by one, in the order they were made
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("pragma journal_mode = wal")
+        self.db.execute("pragma synchronous = normal")
+        self.db.executescript(SCHEMA)
+        # users and chats whose data has been loaded from the database
+        self.loaded: dict[str, set[int]] = {USER: set(), CHAT: set()}
+        # versions of the saved data (see `models.VERSION_KEY`)
+        # and digests for the data not tracked by the models,
+        # used to skip rewriting unchanged rows
+        self.versions: dict[tuple[str, int], int] = {}
+        self.digests: dict[tuple[str, int], bytes] = {}
+        # users and chats whose data is being loaded
+        self.loading: dict[tuple[str, int], asyncio.Future] = {}
+
+    async def get_user_data(self) -> dict[int, dict]:
+        # user data is loaded on first access
+        return {}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        # chat data is loaded on first access
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return await self._load(BOT, 0) or {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await self._fetchall("select key, state from conversations where name = ?", (name,))
+        return {tuple(pickle.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        key_data = pickle.dumps(list(key))
+        if new_state is None:
+            await self._execute(
+                "delete from conversations where name = ? and key = ?", (name, key_data)
+            )
+            return
+        await self._execute(
+            "insert or replace into conversations (name, key, state) values (?, ?, ?)",
+            (name, key_data, pickle.dumps(new_state)),
+        )
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._save(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._save(CHAT, chat_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._save(BOT, 0, data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop(CHAT, chat_id)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop(USER, user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self._run(self.db.close)
+        self.executor.shutdown()
+
+    async def _refresh(self, kind: str, id: int, data: dict) -> None:
+        """Loads the saved data into `data` unless it has already been loaded."""
+        if id in self.loaded[kind]:
+            return
+        loading = self.loading.get((kind, id))
+        if loading:
+            # the first caller loads the data into the same dict
+            await loading
+            return
+        loading = self.loading[(kind, id)] = asyncio.get_running_loop().create_future()
+        try:
+            saved = await self._load(kind, id)
+            if saved:
+                # keep the changes made before loading (if any)
+                data.update({**saved, **data})
+            self.loaded[kind].add(id)
+        finally:
+            del self.loading[(kind, id)]
+            loading.set_result(None)
+
+    async def _load(self, kind: str, id: int) -> Optional[dict]:
+        """Reads the data from the database."""
+        rows = await self._fetchall("select value from data where kind = ? and id = ?", (kind, id))
+        if not rows:
+            return None
+        value = rows[0][0]
+        data = pickle.loads(value)
+        self._remember(kind, id, models.get_version(data), value)
+        return data
+
+    async def _save(self, kind: str, id: int, data: dict) -> None:
+        """Writes the data to the database if it has changed."""
+        version = models.get_version(data)
+        if version is not None and self.versions.get((kind, id)) == version:
+            return
+        # serialize on the event loop, as handlers may change the data meanwhile
+        value = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        if version is None and self.digests.get((kind, id)) == hashlib.sha1(value).digest():
+            return
+        with metrics.persistence_write_seconds.time(kind=kind):
+            await self._execute(
+                "insert or replace into data (kind, id, value) values (?, ?, ?)", (kind, id, value)
+            )
+        self._remember(kind, id, version, value)
+
+    def _remember(self, kind: str, id: int, version: Optional[int], value: bytes) -> None:
+        """Remembers the saved data state to detect changes later."""
+        if version is None:
+            self.digests[(kind, id)] = hashlib.sha1(value).digest()
+        else:
+            self.versions[(kind, id)] = version
+
+    async def _drop(self, kind: str, id: int) -> None:
+        """Deletes the data from the database."""
+        self.versions.pop((kind, id), None)
+        self.digests.pop((kind, id), None)
+        await self._execute("delete from data where kind = ? and id = ?", (kind, id))
+
+    async def _execute(self, sql: str, params: tuple) -> None:
+        """Executes a statement in the database thread."""
+        await self._run(self.db.execute, sql, params)
+
+    async def _fetchall(self, sql: str, params: tuple) -> list[tuple]:
+        """Executes a query in the database thread and returns all the rows."""
+        return await self._run(lambda: self.db.execute(sql, params).fetchall())
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        """Runs a blocking function in the database thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+
+async def migrate(src_path: str, dst_path: str) -> None:
+    """Copies the bot data from a pickle file to an SQLite database."""
+    src = PicklePersistence(filepath=src_path)
+    dst = SqlitePersistence(dst_path)
+    user_data = await src.get_user_data()
+    for user_id, data in user_data.items():
+        await dst.update_user_data(user_id, data)
+    chat_data = await src.get_chat_data()
+    for chat_id, data in chat_data.items():
+        await dst.update_chat_data(chat_id, data)
+    await dst.update_bot_data(await src.get_bot_data() or {})
+    await dst.flush()
+    logger.info(
+        "migrated %s users and %s chats from %s to %s",
+        len(user_data),
+        len(chat_data),
+        src_path,
+        dst_path,
+    )
+
+
+if __name__ == "__main__":
+    # Usage: python -m bot.persistence data/persistence.pkl data/persistence.db
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(migrate(sys.argv[1], sys.argv[2]))
@@ -1,8 +1,41 @@
 """Extracts questions from chat messages."""
 
-from telegram import Message, MessageEntity
+import codecs
+import contextlib
+from typing import AsyncIterator, Optional
+import httpx
+from telegram import File, Message, MessageEntity
 from telegram.ext import CallbackContext
+from bot import ai
 from bot import shortcuts
+from bot.config import config
+from bot.fetcher import CHARS_PER_TOKEN
+from bot.models import ChatData
+
+# Size of the chunks to read documents in (in bytes).
+CHUNK_SIZE = 64 * 1024
+
+# How many bytes to look at when detecting the document encoding.
+SAMPLE_SIZE = 4096
+
+# Byte order marks and the encodings they indicate.
+# UTF-32 goes first, since its little-endian BOM starts with the UTF-16 one.
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# The encoding to use for text that is not valid UTF-8.
+FALLBACK_ENCODING = "cp1252"
+
+# Downloads documents from Telegram.
+client = httpx.AsyncClient(
+    follow_redirects=True,
+    timeout=httpx.Timeout(config.http.read_timeout, connect=config.http.connect_timeout),
+)
 
 
 async def extract_private(message: Message, context: CallbackContext) -> str:
@@ -107,10 +140,132 @@ async def _extract_text(message: Message, context: CallbackContext) -> str:
     return ""
 
 
+async def close() -> None:
+    """Frees network connections."""
+    await client.aclose()
+
+
 async def _extract_document_text(message: Message, context: CallbackContext) -> str:
-    """Extracts text from a document message."""
+    """
+    Extracts text from a document message.
+    Reads the document in chunks, and stops at `documents.max_bytes`
+    or once there is enough text to fill the document's share of the model context.
+    """
+    max_tokens = _calc_max_tokens(message, context)
+
     file = await context.bot.get_file(message.document.file_id)
-    bytes = await file.download_as_bytearray()
-    text = bytes.decode("utf-8").strip()
+    async with contextlib.aclosing(_iter_file(file)) as chunks:
+        text, is_truncated = await _read_text(
+            chunks, config.documents.max_bytes, max_tokens * CHARS_PER_TOKEN
+        )
+
     caption = f"{message.caption}\n\n" if message.caption else ""
-    return f"{caption}{message.document.file_name}:\n```\n{text}\n```"
+    if text is None:
+        return f"{caption}{message.document.file_name}: Unknown binary content"
+    note = "\n[truncated]" if is_truncated else ""
+    return f"{caption}{message.document.file_name}:\n```\n{text.strip()}\n```{note}"
+
+
+def _calc_max_tokens(message: Message, context: CallbackContext) -> int:
+    """
+    Returns the maximum number of tokens a document can take:
+    its share of the model context, minus the prompt and the caption.
+    """
+    chat = ChatData(context.chat_data)
+    model = ai.chat.Model(chat.model or config.openai.model)
+    window = int(ai.chat.max_input_tokens(model.name) * config.documents.window_share)
+    max_tokens = window - model.count_input(chat.prompt, message.caption or "", history=[])
+    if config.documents.max_tokens:
+        max_tokens = min(max_tokens, config.documents.max_tokens)
+    return max(max_tokens, 0)
+
+
+async def _iter_file(file: File) -> AsyncIterator[bytes]:
+    """Reads a Telegram file in chunks."""
+    if not file.file_path.startswith(("http://", "https://")):
+        # the bot works with a local Bot API server,
+        # which stores the files on disk
+        with open(file.file_path, "rb") as fileobj:
+            while chunk := fileobj.read(CHUNK_SIZE):
+                yield chunk
+        return
+    async with client.stream("GET", file.file_path) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            yield chunk
+
+
+async def _read_text(
+    chunks: AsyncIterator[bytes], max_bytes: int, max_chars: int
+) -> tuple[Optional[str], bool]:
+    """
+    Decodes text from the chunks, reading at most `max_bytes`
+    and stopping once there are more than `max_chars` characters.
+    Returns the text (None for binary content)
+    and whether it was cut short.
+    """
+    head = b""
+    decoder = None
+    parts = []
+    n_bytes, n_chars = 0, 0
+    is_truncated = False
+    async for chunk in chunks:
+        if n_bytes + len(chunk) > max_bytes:
+            chunk = chunk[: max_bytes - n_bytes]
+            is_truncated = True
+        n_bytes += len(chunk)
+        if decoder is None:
+            # collect enough bytes to detect the encoding
+            head += chunk
+            if len(head) < SAMPLE_SIZE and not is_truncated:
+                continue
+            encoding = _detect_encoding(head, is_complete=False)
+            if encoding is None:
+                return None, False
+            decoder = codecs.getincrementaldecoder(encoding)("replace")
+            chunk, head = head, b""
+        part = decoder.decode(chunk)
+        parts.append(part)
+        n_chars += len(part)
+        if n_chars > max_chars:
+            is_truncated = True
+        if is_truncated:
+            break
+
+    if decoder is None:
+        # the whole document fits into the sample
+        encoding = _detect_encoding(head, is_complete=not is_truncated)
+        if encoding is None:
+            return None, False
+        decoder = codecs.getincrementaldecoder(encoding)("replace")
+        parts.append(decoder.decode(head))
+    if not is_truncated:
+        parts.append(decoder.decode(b"", final=True))
+
+    text = "".join(parts)
+    if len(text) > max_chars:
+        text = text[:max_chars]
+        is_truncated = True
+    return text, is_truncated
+
+
+def _detect_encoding(sample: bytes, is_complete: bool) -> Optional[str]:
+    """
+    Detects the text encoding from the first bytes of a document.
+    Returns None if the document does not look like text.
+    `is_complete` is False if the sample is only the beginning of the document.
+    """
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    if b"\x00" in sample:
+        # text documents do not contain null bytes
+        return None
+    try:
+        sample.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as exc:
+        if not is_complete and exc.reason == "unexpected end of data":
+            # the sample ends in the middle of a character
+            return "utf-8"
+        return FALLBACK_ENCODING
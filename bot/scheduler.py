@@ -0,0 +1,114 @@
+"""Telegram update scheduling."""
+
+import asyncio
+from collections import deque
+import logging
+from typing import Any, Awaitable, Hashable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from the same chat one by one, in the order they arrive,
+    and updates from different chats in parallel, up to `concurrency` at a time.
+    When there are more busy chats than that, they take turns (round-robin),
+    so a chat with many updates does not hold back the others.
+    """
+
+    def __init__(self, concurrency: int, max_pending: int = 1024) -> None:
+        # the base class limits the number of updates being processed or waiting
+        # for their turn, while the actual concurrency is limited by the scheduler
+        super().__init__(max_concurrent_updates=max_pending)
+        self.concurrency = concurrency
+        # updates waiting for their turn, by chat
+        self.pending: dict[Hashable, deque[asyncio.Future]] = {}
+        # chats with pending updates that are not currently running, in turn order
+        self.ready: deque[Hashable] = deque()
+        # chats currently running an update
+        self.running: set[Hashable] = set()
+        metrics.queue_depth.set_function(self.queue_depth)
+        metrics.updates_running.set_function(lambda: len(self.running))
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Waits for the chat's turn and processes the update."""
+        key = self._get_key(update)
+        turn = asyncio.get_running_loop().create_future()
+        if key not in self.pending:
+            self.pending[key] = deque()
+        self.pending[key].append(turn)
+        if key not in self.running and key not in self.ready:
+            self.ready.append(key)
+        self._dispatch()
+
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # the turn came just before the cancellation
+                self._release(key)
+            else:
+                self._discard(key, turn)
+            if asyncio.iscoroutine(coroutine):
+                # the update will never be processed
+                coroutine.close()
+            raise
+
+        try:
+            await coroutine
+        finally:
+            self._release(key)
+
+    def queue_depth(self) -> int:
+        """Returns the number of updates waiting for their turn."""
+        return sum(len(turns) for turns in self.pending.values())
+
+    def _dispatch(self) -> None:
+        """Gives turns to the ready chats while there are free slots."""
+        while self.ready and len(self.running) < self.concurrency:
+            key = self.ready.popleft()
+            turn = self.pending[key].popleft()
+            if not self.pending[key]:
+                del self.pending[key]
+            if turn.cancelled():
+                # the update was cancelled while waiting, so skip it
+                if key in self.pending:
+                    self.ready.appendleft(key)
+                continue
+            self.running.add(key)
+            turn.set_result(None)
+
+    def _release(self, key: Hashable) -> None:
+        """Frees the chat's slot and lets the next chat run."""
+        self.running.discard(key)
+        if key in self.pending:
+            # the chat has more updates, so it goes to the end of the line
+            self.ready.append(key)
+        self._dispatch()
+
+    def _discard(self, key: Hashable, turn: asyncio.Future) -> None:
+        """Removes a cancelled update from the chat's queue."""
+        queue = self.pending.get(key)
+        if queue is None or turn not in queue:
+            return
+        queue.remove(turn)
+        if not queue:
+            del self.pending[key]
+            if key in self.ready:
+                self.ready.remove(key)
+
+    def _get_key(self, update: object) -> Hashable:
+        """Returns the chat the update belongs to."""
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        # updates without a chat are independent from each other
+        return id(update)
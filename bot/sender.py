@@ -0,0 +1,198 @@
+"""
+Outgoing Telegram requests.
+
+Telegram limits how fast a bot can send messages: about 30 messages per second
+overall and 20 messages per minute in a group. Exceeding the limits results
+in RetryAfter (flood control) errors.
+"""
+
+import asyncio
+from collections import deque
+import logging
+import time
+from typing import Any, Callable, Coroutine, Hashable, Optional, Union
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Requests that post messages to a chat.
+MESSAGE_PREFIXES = ("send", "edit", "copy", "forward")
+
+# Requests that do not count towards the message limits.
+NON_MESSAGE_ENDPOINTS = {"sendChatAction"}
+
+# Requests that edit existing messages.
+EDIT_ENDPOINTS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+
+Result = Union[bool, dict, list]
+
+
+class Window:
+    """Allows at most `limit` events per `period` seconds."""
+
+    def __init__(self, limit: int, period: float) -> None:
+        self.limit = limit
+        self.period = period
+        self.times: deque[float] = deque()
+
+    def delay(self) -> float:
+        """Returns the number of seconds to wait until the next event is allowed."""
+        now = time.monotonic()
+        while self.times and self.times[0] <= now - self.period:
+            self.times.popleft()
+        if len(self.times) < self.limit:
+            return 0
+        return self.times[0] + self.period - now
+
+    def add(self) -> None:
+        """Records an event."""
+        self.times.append(time.monotonic())
+
+
+class FloodLimiter(BaseRateLimiter):
+    """
+    Keeps outgoing requests under Telegram's limits.
+    Requests to the same chat are sent one by one, in the order they were made,
+    and wait for the overall and per-group limits. RetryAfter errors are waited out
+    and the request is sent again. An edit that is still waiting for its turn
+    is skipped if a newer edit of the same message comes along.
+    """
+
+    def __init__(
+        self,
+        overall_per_second: int = 30,
+        group_per_minute: int = 20,
+        max_retries: int = 3,
+    ) -> None:
+        self.overall = Window(overall_per_second, 1)
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        # per-group message limits
+        self.groups: dict[Hashable, Window] = {}
+        self.pruned_at = time.monotonic()
+        # requests to the same chat take turns
+        self.locks: dict[Hashable, asyncio.Lock] = {}
+        # the number of requests to each chat being sent or waiting
+        self.n_pending: dict[Hashable, int] = {}
+        # the latest edit request of each message
+        self.edits: dict[tuple, object] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Result]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: Optional[Any],
+    ) -> Result:
+        """Sends the request when the limits allow."""
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # not a chat request (e.g. getMe or getFile)
+            return await self._send(callback, args, kwargs, endpoint, chat_id)
+
+        edit_key = None
+        token = object()
+        if endpoint in EDIT_ENDPOINTS:
+            edit_key = (chat_id, data.get("message_id"), data.get("inline_message_id"))
+            self.edits[edit_key] = token
+
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        self.n_pending[chat_id] = self.n_pending.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                if edit_key and self.edits.get(edit_key) is not token:
+                    # a newer edit will replace this one anyway
+                    logger.debug("Skipping a superseded %s in chat %s", endpoint, chat_id)
+                    return True
+                return await self._send(callback, args, kwargs, endpoint, chat_id)
+        finally:
+            if edit_key and self.edits.get(edit_key) is token:
+                del self.edits[edit_key]
+            self.n_pending[chat_id] -= 1
+            if not self.n_pending[chat_id]:
+                del self.n_pending[chat_id]
+                del self.locks[chat_id]
+
+    async def _send(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Result]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        chat_id: Optional[Hashable],
+    ) -> Result:
+        """
+        Waits for the limits and sends the request, retrying on flood errors.
+        Other requests to the chat wait too, since the chat's turn is not over.
+        """
+        attempt = 0
+        while True:
+            await self._wait(endpoint, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning(
+                    "Flood control in chat %s, retrying %s in %ss",
+                    chat_id,
+                    endpoint,
+                    exc.retry_after,
+                )
+                await asyncio.sleep(exc.retry_after)
+
+    async def _wait(self, endpoint: str, chat_id: Optional[Hashable]) -> None:
+        """
+        Waits until the request is allowed.
+        Only the requests that post messages count towards the limits.
+        """
+        if not _is_message(endpoint):
+            return
+        group = None
+        if _is_group(chat_id):
+            group = self.groups.get(chat_id)
+            if group is None:
+                group = self.groups[chat_id] = Window(self.group_per_minute, 60)
+        while True:
+            delay = max(self.overall.delay(), group.delay() if group else 0)
+            if delay <= 0:
+                break
+            logger.debug("Waiting %.2fs before %s in chat %s", delay, endpoint, chat_id)
+            await asyncio.sleep(delay)
+        self.overall.add()
+        if group:
+            group.add()
+        self._prune_groups()
+
+    def _prune_groups(self) -> None:
+        """Forgets the groups the bot has not written to for the last minute."""
+        now = time.monotonic()
+        if now - self.pruned_at < 60:
+            return
+        self.pruned_at = now
+        for chat_id, group in list(self.groups.items()):
+            if not group.times or group.times[-1] <= now - group.period:
+                del self.groups[chat_id]
+
+
+def _is_message(endpoint: str) -> bool:
+    """Checks if the request posts a message."""
+    return endpoint.startswith(MESSAGE_PREFIXES) and endpoint not in NON_MESSAGE_ENDPOINTS
+
+
+def _is_group(chat_id: Optional[Hashable]) -> bool:
+    """Checks if the chat is a group or a channel."""
+    if isinstance(chat_id, str):
+        # channel username
+        return chat_id.startswith("@") or chat_id.startswith("-")
+    return isinstance(chat_id, int) and chat_id < 0
@@ -1,5 +1,6 @@
-from typing import Optional
-from telegram import User
+import datetime as dt
+from typing import AsyncIterator, Optional
+from telegram import Chat, Message, User
 from bot import askers
 
 
@@ -10,7 +11,9 @@ class FakeGPT:
         self.question = None
         self.history = None
 
-    async def ask(self, prompt: str, question: str, history: list) -> str:
+    async def ask(
+        self, prompt: str, question: str, history: list, history_tokens: list = None
+    ) -> str:
         self.prompt = prompt
         self.question = question
         self.history = history
@@ -18,6 +21,25 @@ class FakeGPT:
             raise self.error
         return question
 
+    async def ask_stream(
+        self, prompt: str, question: str, history: list, history_tokens: list = None
+    ) -> AsyncIterator[str]:
+        self.prompt = prompt
+        self.question = question
+        self.history = history
+        if self.error:
+            raise self.error
+        for word in question.split(" "):
+            yield f"{word} "
+
+    def count(self, question: str, answer: str) -> None:
+        return None
+
+    def count_input(
+        self, prompt: str, question: str, history: list, history_tokens: list = None
+    ) -> int:
+        return len(question.split())
+
 
 class FakeDalle:
     def __init__(self, error: Optional[Exception] = None):
@@ -36,9 +58,7 @@ class FakeDalle:
 class FakeFile:
     def __init__(self, file_id: str) -> None:
         self.file_id = file_id
-
-    async def download_as_bytearray(self, buf=None, **kwargs) -> bytearray:
-        return bytearray(b"file content")
+        self.file_path = f"https://api.telegram.org/file/bot1234/documents/{file_id}"
 
 
 class FakeBot:
@@ -51,6 +71,8 @@ class FakeBot:
             can_read_all_group_messages=True,
         )
         self.text = ""
+        self.n_sent = 0
+        self.n_edited = 0
 
     @property
     def username(self) -> str:
@@ -70,8 +92,25 @@ class FakeBot:
     async def send_chat_action(self, **kwargs) -> None:
         pass
 
-    async def send_message(self, chat_id: int, text: str, **kwargs) -> None:
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> Message:
+        self.text = text
+        self.n_sent += 1
+        message = Message(
+            message_id=self.n_sent,
+            date=dt.datetime.now(),
+            chat=Chat(id=chat_id, type=Chat.PRIVATE),
+            text=text,
+            from_user=self.user,
+        )
+        message.set_bot(self)
+        return message
+
+    async def edit_message_text(self, text: str, **kwargs) -> None:
         self.text = text
+        self.n_edited += 1
+
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs) -> None:
+        pass
 
     async def send_document(
         self, chat_id: int, document: object, caption: str, filename: str, **kwargs
@@ -93,5 +132,9 @@ class FakeApplication:
 
 
 def mock_text_asker(ai: FakeGPT) -> None:
-    mock_init = lambda asker, _: setattr(asker, "model", ai)
+    def mock_init(asker, _):
+        asker.model = ai
+        asker.partial = None
+        asker.updating = None
+
     askers.TextAsker.__init__ = mock_init
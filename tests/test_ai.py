@@ -1,7 +1,13 @@
+import asyncio
+import base64
+import os
+import tempfile
+import time
 import unittest
-from bot.config import config
-from bot.ai import chat
-from bot.models import UserMessage
+import httpx
+from bot.config import config, Provider
+from bot.ai import cache, chat, clients, ratelimit, retry, router, tokens
+from bot.models import MessageTokens, UserMessage
 
 
 class ModelTest(unittest.TestCase):
@@ -34,6 +40,43 @@ class ModelTest(unittest.TestCase):
         self.assertEqual(messages[5]["content"], "What's your name?")
 
 
+class CountTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.model = chat.Model("gpt")
+
+    def test_count(self):
+        counts = self.model.count("What is your name?", "My name is Alice.")
+        self.assertEqual(counts, MessageTokens(tokens.stamp("words"), 4, 4))
+
+    def test_count_input(self):
+        history = [("Hello", "Hi")]
+        n_tokens = self.model.count_input("", "What's your name?", history)
+        self.assertEqual(n_tokens, 6 + 1 + 1 + 4)
+        history_tokens = [MessageTokens(tokens.stamp("words"), 10, 20)]
+        n_tokens = self.model.count_input("", "What's your name?", history, history_tokens)
+        self.assertEqual(n_tokens, 6 + 10 + 20 + 4)
+
+    def test_calc_lengths(self):
+        history = [UserMessage("Hello", "Hi")]
+        messages = self.model._generate_messages("system", "", "What's your name?", history)
+        lengths = self.model._calc_lengths(messages, history_tokens=None)
+        self.assertEqual(lengths, [6, 1, 1, 4])
+
+    def test_calc_lengths_known(self):
+        history = [UserMessage("Hello", "Hi")]
+        history_tokens = [MessageTokens(tokens.stamp("words"), 10, 20)]
+        messages = self.model._generate_messages("system", "", "What's your name?", history)
+        lengths = self.model._calc_lengths(messages, history_tokens)
+        self.assertEqual(lengths, [6, 10, 20, 4])
+
+    def test_calc_lengths_outdated(self):
+        history = [UserMessage("Hello", "Hi")]
+        history_tokens = [MessageTokens("words/0", 10, 20)]
+        messages = self.model._generate_messages("system", "", "What's your name?", history)
+        lengths = self.model._calc_lengths(messages, history_tokens)
+        self.assertEqual(lengths, [6, 1, 1, 4])
+
+
 class ShortenTest(unittest.TestCase):
     def test_do_not_shorten(self):
         messages = [
@@ -86,6 +129,837 @@ class ShortenTest(unittest.TestCase):
             shortened,
             [
                 {"role": "system", "content": "You are an AI assistant."},
-                {"role": "user", "content": "Is it cold today?"},
+                {"role": "user", "content": "Is it\n[...]\ncold"},
+            ],
+        )
+        self.assertEqual(messages[1]["content"], "Is it cold today? I think it's rather cold")
+
+    def test_remove_and_shorten(self):
+        messages = [
+            {"role": "system", "content": "You are an AI assistant."},
+            {"role": "user", "content": "What is your name?"},
+            {"role": "assistant", "content": "My name is Alice."},
+            {"role": "user", "content": "Is it cold today? I think it's rather cold"},
+        ]
+        shortened = chat.shorten(messages, length=10)
+        self.assertEqual(
+            shortened,
+            [
+                {"role": "system", "content": "You are an AI assistant."},
+                {"role": "user", "content": "Is it\n[...]\ncold"},
             ],
         )
+
+    def test_given_lengths(self):
+        messages = [
+            {"role": "system", "content": "You are an AI assistant."},
+            {"role": "user", "content": "What is your name?"},
+            {"role": "assistant", "content": "My name is Alice."},
+            {"role": "user", "content": "Is it cold today?"},
+        ]
+        shortened = chat.shorten(messages, length=30, lengths=[6, 20, 4, 4])
+        self.assertEqual(shortened, [messages[0], messages[2], messages[3]])
+
+
+class ParseChunkTest(unittest.TestCase):
+    def test_delta(self):
+        line = 'data: {"choices": [{"index": 0, "delta": {"content": "Hello"}}]}'
+        self.assertEqual(chat._parse_chunk(line), "Hello")
+
+    def test_no_content(self):
+        line = 'data: {"choices": [{"index": 0, "delta": {"role": "assistant"}}]}'
+        self.assertIsNone(chat._parse_chunk(line))
+        line = 'data: {"choices": []}'
+        self.assertIsNone(chat._parse_chunk(line))
+        line = 'data: {"usage": {"total_tokens": 5}}'
+        self.assertIsNone(chat._parse_chunk(line))
+
+    def test_ignored(self):
+        self.assertIsNone(chat._parse_chunk(""))
+        self.assertIsNone(chat._parse_chunk(": keep-alive"))
+        self.assertIsNone(chat._parse_chunk("event: message"))
+        self.assertIsNone(chat._parse_chunk("data: [DONE]"))
+
+    def test_error(self):
+        line = 'data: {"error": {"message": "Rate limit exceeded"}}'
+        with self.assertRaises(Exception):
+            chat._parse_chunk(line)
+
+
+class WordEncoderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.encoder = tokens.WordEncoder()
+
+    def test_words(self):
+        self.assertEqual(self.encoder.count("You are an AI assistant."), 6)
+        self.assertEqual(self.encoder.count(""), 0)
+
+    def test_code(self):
+        self.assertEqual(self.encoder.count("print(sum(map(int,values)))"), 6)
+
+    def test_cjk(self):
+        self.assertEqual(self.encoder.count("你好世界"), 5)
+
+
+class TruncateTest(unittest.TestCase):
+    def test_fits(self):
+        text = "Is it cold today?"
+        self.assertEqual(tokens.truncate(text, 4), text)
+
+    def test_head_and_tail(self):
+        text = "Translate this: " + "word " * 1000 + "Thank you!"
+        truncated = tokens.truncate(text, 100)
+        self.assertLessEqual(tokens.WordEncoder().count(truncated), 100)
+        self.assertTrue(truncated.startswith("Translate this: word"))
+        self.assertTrue(truncated.endswith("word Thank you!"))
+        self.assertIn(tokens.TRUNCATED, truncated)
+
+    def test_too_short(self):
+        self.assertEqual(tokens.truncate("Is it cold today?", 1), "")
+
+
+class CountCacheTest(unittest.TestCase):
+    def test_cache(self):
+        text = "How are you doing today?"
+        self.assertEqual(tokens.count(text), 6)
+        self.assertEqual(tokens.count(text), 6)
+        key = ("words", len(text), hash(text))
+        self.assertEqual(tokens._counts[key], 6)
+        # the cache keeps the counts, not the texts
+        self.assertNotIn(text, [item for key in tokens._counts for item in key])
+
+
+class BPEEncoderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "test_base.tiktoken")
+        vocab = [b"a", b"b", b"c", b" ", b"ab", b"abc", b" abc"]
+        with open(self.path, "wb") as file:
+            for rank, token in enumerate(vocab):
+                file.write(base64.b64encode(token) + f" {rank}\n".encode())
+        self.encoder = tokens.BPEEncoder("test_base", self.path)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_lazy_load(self):
+        self.assertIsNone(self.encoder._ranks)
+        self.encoder.count("abc")
+        self.assertEqual(len(self.encoder.ranks), 7)
+
+    def test_count(self):
+        self.assertEqual(self.encoder.count("abc"), 1)
+        self.assertEqual(self.encoder.count("abc abc"), 2)
+        self.assertEqual(self.encoder.count("abca"), 2)
+        self.assertEqual(self.encoder.count("cab"), 2)
+
+    def test_unknown_bytes(self):
+        self.assertEqual(self.encoder.count("xyz"), 3)
+
+    def test_long_piece(self):
+        self.assertEqual(self.encoder.count("ab" * 4000), 4000)
+        self.assertEqual(self.encoder.count("abc" * 3000 + "a"), 3001)
+
+    def test_get_encoder(self):
+        vocab_path = config.vocab_path
+        config.vocab_path = self.dir.name
+        try:
+            encoder = tokens.get_encoder("test_base")
+            self.assertIsInstance(encoder, tokens.BPEEncoder)
+            encoder = tokens.get_encoder("missing_base")
+            self.assertIsInstance(encoder, tokens.WordEncoder)
+        finally:
+            config.vocab_path = vocab_path
+            tokens._encoders.clear()
+
+
+class ClientsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self) -> None:
+        await clients.close()
+
+    async def test_get(self):
+        client = clients.get("https://example.org/v1")
+        self.assertIs(clients.get("https://example.org/v1"), client)
+        self.assertIsNot(clients.get("https://example.com/v1"), client)
+        self.assertEqual(client.timeout.connect, config.http.connect_timeout)
+        self.assertEqual(client.timeout.read, config.http.read_timeout)
+
+    async def test_close(self):
+        client = clients.get("https://example.org/v1")
+        await clients.close()
+        self.assertTrue(client.is_closed)
+        self.assertIsNot(clients.get("https://example.org/v1"), client)
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.enabled = config.completion_cache.enabled
+        self.size = config.completion_cache.size
+        self.allow_random = config.completion_cache.allow_random
+        config.completion_cache.enabled = True
+
+    def tearDown(self) -> None:
+        config.completion_cache.enabled = self.enabled
+        config.completion_cache.size = self.size
+        config.completion_cache.allow_random = self.allow_random
+        cache.clear()
+
+    def test_key(self):
+        request = {"model": "gpt", "messages": [{"role": "user", "content": "Hi"}]}
+        key = cache.key({**request, "temperature": 0})
+        self.assertEqual(key, cache.key({"temperature": 0, **request}))
+        self.assertNotEqual(key, cache.key({**request, "temperature": 0, "model": "other"}))
+
+    def test_key_disabled(self):
+        config.completion_cache.enabled = False
+        self.assertIsNone(cache.key({"model": "gpt", "temperature": 0}))
+
+    def test_key_random(self):
+        self.assertIsNone(cache.key({"model": "gpt", "temperature": 0.7}))
+        self.assertIsNone(cache.key({"model": "gpt"}))
+        config.completion_cache.allow_random = True
+        self.assertIsNotNone(cache.key({"model": "gpt", "temperature": 0.7}))
+
+    def test_get_put(self):
+        self.assertIsNone(cache.get("one"))
+        cache.put("one", "answer")
+        self.assertEqual(cache.get("one"), "answer")
+        cache.put(None, "answer")
+        self.assertIsNone(cache.get(None))
+
+    def test_expired(self):
+        cache.put("one", "answer")
+        cache._answers["one"] = ("answer", time.time() - 1)
+        self.assertIsNone(cache.get("one"))
+
+    def test_evict(self):
+        config.completion_cache.size = 2
+        cache.put("one", "1")
+        cache.put("two", "2")
+        cache.get("one")
+        cache.put("three", "3")
+        self.assertEqual(cache.get("one"), "1")
+        self.assertIsNone(cache.get("two"))
+        self.assertEqual(cache.get("three"), "3")
+
+
+class ModelCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.enabled = config.completion_cache.enabled
+        self.params = config.openai.params
+        config.completion_cache.enabled = True
+        config.openai.params = {**self.params, "temperature": 0}
+        self.n_requests = 0
+
+        def handle(request: httpx.Request) -> httpx.Response:
+            self.n_requests += 1
+            return httpx.Response(
+                200,
+                json={
+                    "choices": [{"message": {"content": f"answer {self.n_requests}"}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                },
+            )
+
+        clients._clients[config.openai.url] = httpx.AsyncClient(
+            transport=httpx.MockTransport(handle)
+        )
+
+    async def asyncTearDown(self) -> None:
+        config.completion_cache.enabled = self.enabled
+        config.openai.params = self.params
+        cache.clear()
+        await clients.close()
+
+    async def test_ask(self):
+        model = chat.Model("gpt")
+        answer = await model.ask(prompt="", question="Hi", history=[])
+        self.assertEqual(answer, "answer 1")
+        answer = await model.ask(prompt="", question="Hi", history=[])
+        self.assertEqual(answer, "answer 1")
+        self.assertEqual(self.n_requests, 1)
+        answer = await model.ask(prompt="", question="Hello", history=[])
+        self.assertEqual(answer, "answer 2")
+
+    async def test_ask_stream(self):
+        model = chat.Model("gpt")
+        await model.ask(prompt="", question="Hi", history=[])
+        parts = [part async for part in model.ask_stream(prompt="", question="Hi", history=[])]
+        self.assertEqual(parts, ["answer 1"])
+        self.assertEqual(self.n_requests, 1)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = ratelimit.TokenBucket(0)
+        bucket.take(1000)
+        self.assertEqual(bucket.delay(1000), 0)
+
+    def test_take(self):
+        bucket = ratelimit.TokenBucket(60)
+        self.assertEqual(bucket.delay(60), 0)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.delay(1), 1, places=2)
+        self.assertAlmostEqual(bucket.delay(1000), 60, places=1)
+
+    def test_give(self):
+        bucket = ratelimit.TokenBucket(60)
+        bucket.take(60)
+        bucket.give(30)
+        self.assertEqual(bucket.delay(30), 0)
+        bucket.give(100)
+        self.assertLessEqual(bucket.level, 60)
+
+    def test_update(self):
+        bucket = ratelimit.TokenBucket(0)
+        bucket.update(limit=60, remaining=10, reset_after=None)
+        self.assertEqual(bucket.delay(10), 0)
+        self.assertAlmostEqual(bucket.delay(11), 1, places=2)
+        bucket.update(limit=60, remaining=0, reset_after=5)
+        self.assertAlmostEqual(bucket.delay(1), 6, places=2)
+
+
+class LimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_acquire(self):
+        limiter = ratelimit.Limiter(requests_per_minute=6000, tokens_per_minute=0)
+        limiter.requests.take(6000)
+        start = time.perf_counter()
+        await limiter.acquire()
+        self.assertGreaterEqual(time.perf_counter() - start, 0.009)
+
+    async def test_acquire_tokens(self):
+        limiter = ratelimit.Limiter(requests_per_minute=0, tokens_per_minute=60000)
+        await limiter.acquire(60000)
+        start = time.perf_counter()
+        await limiter.acquire(10)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.009)
+
+    def test_update(self):
+        limiter = ratelimit.Limiter(requests_per_minute=0, tokens_per_minute=0)
+        limiter.update(
+            {
+                "x-ratelimit-limit-requests": "60",
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": "1s",
+                "x-ratelimit-limit-tokens": "150000",
+                "x-ratelimit-remaining-tokens": "149984",
+                "x-ratelimit-reset-tokens": "6ms",
+            }
+        )
+        self.assertEqual(limiter.requests.capacity, 60)
+        self.assertAlmostEqual(limiter.requests.delay(1), 2, places=2)
+        self.assertEqual(limiter.tokens.capacity, 150000)
+        self.assertEqual(limiter.tokens.delay(1000), 0)
+
+    def test_update_invalid(self):
+        limiter = ratelimit.Limiter(requests_per_minute=10, tokens_per_minute=0)
+        limiter.update(
+            {"x-ratelimit-limit-requests": "many", "x-ratelimit-remaining-requests": "1"}
+        )
+        self.assertEqual(limiter.requests.capacity, 10)
+
+    def test_get(self):
+        limiter = ratelimit.get("https://example.org/v1", "gpt")
+        self.assertIs(ratelimit.get("https://example.org/v1", "gpt"), limiter)
+        self.assertIsNot(ratelimit.get("https://example.org/v1", "gpt-4"), limiter)
+
+
+class ParseDurationTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(ratelimit.parse_duration("1s"), 1)
+        self.assertEqual(ratelimit.parse_duration("6m0s"), 360)
+        self.assertEqual(ratelimit.parse_duration("1h2m3s"), 3723)
+        self.assertAlmostEqual(ratelimit.parse_duration("20ms"), 0.02)
+        self.assertAlmostEqual(ratelimit.parse_duration("1.5s"), 1.5)
+        self.assertIsNone(ratelimit.parse_duration(""))
+
+
+class RetryTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.base_delay = config.retry.base_delay
+        self.deadline = config.retry.deadline
+        config.retry.base_delay = 0.001
+        retry.counts.clear()
+
+    def tearDown(self) -> None:
+        config.retry.base_delay = self.base_delay
+        config.retry.deadline = self.deadline
+
+    def sender(self, results: list):
+        results = iter(results)
+
+        async def send() -> httpx.Response:
+            result = next(results)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return send
+
+    async def test_success(self):
+        send = self.sender([httpx.Response(200)])
+        response = await retry.request(send)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(retry.counts, {})
+
+    async def test_retry_status(self):
+        send = self.sender([httpx.Response(503), httpx.Response(429), httpx.Response(200)])
+        response = await retry.request(send)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(retry.counts, {"503": 1, "429": 1})
+
+    async def test_retry_error(self):
+        send = self.sender([httpx.ConnectError("connection refused"), httpx.Response(200)])
+        response = await retry.request(send)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(retry.counts, {"ConnectError": 1})
+
+    async def test_not_retryable(self):
+        send = self.sender([httpx.Response(400), httpx.Response(200)])
+        response = await retry.request(send)
+        self.assertEqual(response.status_code, 400)
+        send = self.sender([ValueError("invalid"), httpx.Response(200)])
+        with self.assertRaises(ValueError):
+            await retry.request(send)
+
+    async def test_give_up(self):
+        send = self.sender([httpx.Response(500)] * config.retry.max_attempts)
+        response = await retry.request(send)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(retry.counts["failed"], 1)
+
+        send = self.sender([httpx.ReadTimeout("timeout")] * config.retry.max_attempts)
+        with self.assertRaises(httpx.ReadTimeout):
+            await retry.request(send)
+
+    async def test_deadline(self):
+        config.retry.deadline = 1
+        send = self.sender([httpx.Response(429, headers={"retry-after": "5"})])
+        response = await retry.request(send)
+        self.assertEqual(response.status_code, 429)
+
+    async def test_retry_after(self):
+        backoff = retry.Backoff()
+        delay = backoff.next_delay(httpx.Response(429, headers={"retry-after": "2"}))
+        self.assertEqual(delay, 2)
+        delay = backoff.next_delay(httpx.Response(429, headers={"retry-after-ms": "20"}))
+        self.assertEqual(delay, 0.02)
+
+    async def test_backoff_deadline(self):
+        backoff = retry.Backoff(deadline=time.monotonic() + 1)
+        self.assertIsNotNone(backoff.next_delay(httpx.Response(429, headers={"retry-after": "0"})))
+        backoff = retry.Backoff(deadline=time.monotonic())
+        self.assertIsNone(backoff.next_delay(httpx.Response(429, headers={"retry-after": "1"})))
+
+    def test_parse_retry_after(self):
+        self.assertIsNone(retry._parse_retry_after(None))
+        self.assertIsNone(retry._parse_retry_after(httpx.Response(429)))
+        self.assertEqual(
+            retry._parse_retry_after(httpx.Response(429, headers={"retry-after": "1.5"})), 1.5
+        )
+        date = "Wed, 21 Oct 2015 07:28:00 GMT"
+        self.assertEqual(
+            retry._parse_retry_after(httpx.Response(429, headers={"retry-after": date})), 0
+        )
+
+
+class ModelRetryTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.base_delay = config.retry.base_delay
+        config.retry.base_delay = 0.001
+        self.n_requests = 0
+
+    async def asyncTearDown(self) -> None:
+        config.retry.base_delay = self.base_delay
+        await clients.close()
+
+    def use_responses(self, *responses: httpx.Response) -> None:
+        def handle(request: httpx.Request) -> httpx.Response:
+            self.n_requests += 1
+            return responses[self.n_requests - 1]
+
+        clients._clients[config.openai.url] = httpx.AsyncClient(
+            transport=httpx.MockTransport(handle)
+        )
+
+    async def test_ask(self):
+        self.use_responses(
+            httpx.Response(503, json={"error": "overloaded"}),
+            httpx.Response(
+                200,
+                json={
+                    "choices": [{"message": {"content": "Hi!"}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                },
+            ),
+        )
+        answer = await chat.Model("gpt").ask(prompt="", question="Hello", history=[])
+        self.assertEqual(answer, "Hi!")
+        self.assertEqual(self.n_requests, 2)
+
+    async def test_ask_tokens(self):
+        settled = []
+
+        class Limiter(ratelimit.Limiter):
+            def settle(self, n_estimated: int, n_actual: int) -> None:
+                settled.append(n_actual)
+
+        limiter = Limiter(requests_per_minute=0, tokens_per_minute=0)
+        ratelimit._limiters[(config.openai.url, "gpt")] = limiter
+        try:
+            self.use_responses(
+                httpx.Response(503, json={"error": "overloaded"}),
+                httpx.Response(
+                    200,
+                    json={
+                        "choices": [{"message": {"content": "Hi!"}}],
+                        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                    },
+                ),
+            )
+            await chat.Model("gpt").ask(prompt="", question="Hello", history=[])
+            # the failed attempt is refunded, the successful one is settled
+            self.assertEqual(settled, [0, 2])
+        finally:
+            del ratelimit._limiters[(config.openai.url, "gpt")]
+
+    async def test_ask_stream_tokens(self):
+        settled = []
+
+        class Limiter(ratelimit.Limiter):
+            def settle(self, n_estimated: int, n_actual: int) -> None:
+                settled.append(n_actual)
+
+        limiter = Limiter(requests_per_minute=0, tokens_per_minute=0)
+        ratelimit._limiters[(config.openai.url, "gpt")] = limiter
+        delta = 'data: {"choices": [{"delta": {"content": "Hi there!"}}]}\n\n'
+        usage = (
+            'data: {"choices": [], "usage": '
+            '{"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}}\n\n'
+        )
+        done = "data: [DONE]\n\n"
+        model = chat.Model("gpt")
+        try:
+            # settled against the reported usage
+            self.use_responses(
+                httpx.Response(503, json={"error": "overloaded"}),
+                httpx.Response(200, text=delta + usage + done),
+            )
+            _ = [part async for part in model.ask_stream(prompt="", question="Hello", history=[])]
+            self.assertEqual(settled, [0, 5])
+
+            # settled against the counted tokens without usage
+            settled.clear()
+            self.n_requests = 0
+            self.use_responses(httpx.Response(200, text=delta + done))
+            _ = [part async for part in model.ask_stream(prompt="", question="Hi", history=[])]
+            n_prompt = model.count_input(prompt="", question="Hi", history=[])
+            self.assertEqual(settled, [n_prompt + tokens.count("Hi there!")])
+
+            # refunded when the stream is abandoned
+            settled.clear()
+            self.n_requests = 0
+            self.use_responses(httpx.Response(200, text=delta + usage + done))
+            stream = model.ask_stream(prompt="", question="Hey", history=[])
+            await anext(stream)
+            await stream.aclose()
+            self.assertEqual(settled, [0])
+        finally:
+            del ratelimit._limiters[(config.openai.url, "gpt")]
+
+    async def test_ask_stream(self):
+        self.use_responses(
+            httpx.Response(502, text="bad gateway"),
+            httpx.Response(
+                200,
+                text='data: {"choices": [{"delta": {"content": "Hi!"}}]}\n\ndata: [DONE]\n\n',
+            ),
+        )
+        model = chat.Model("gpt")
+        parts = [part async for part in model.ask_stream(prompt="", question="Hello", history=[])]
+        self.assertEqual(parts, ["Hi!"])
+        self.assertEqual(self.n_requests, 2)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cooldown = config.router.cooldown
+
+    def tearDown(self) -> None:
+        config.router.cooldown = self.cooldown
+
+    def test_open(self):
+        breaker = router.CircuitBreaker()
+        for _ in range(config.router.max_failures - 1):
+            breaker.fail()
+        self.assertTrue(breaker.allow())
+        breaker.fail()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+
+    def test_trial(self):
+        config.router.cooldown = 0.01
+        breaker = router.CircuitBreaker()
+        for _ in range(config.router.max_failures):
+            breaker.fail()
+        time.sleep(0.02)
+        self.assertTrue(breaker.is_available())
+        self.assertTrue(breaker.is_available())
+        self.assertTrue(breaker.allow())
+        # only a single trial request
+        self.assertFalse(breaker.is_available())
+        self.assertFalse(breaker.allow())
+        breaker.succeed()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial(self):
+        config.router.cooldown = 0.01
+        breaker = router.CircuitBreaker()
+        for _ in range(config.router.max_failures):
+            breaker.fail()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.fail()
+        self.assertFalse(breaker.allow())
+
+
+class EndpointTest(unittest.TestCase):
+    def test_latency(self):
+        endpoint = router.Endpoint(Provider(url="https://a", api_key=""))
+        self.assertEqual(endpoint.latency(), (router.DEFAULT_LATENCY, router.DEFAULT_LATENCY))
+        for latency in range(1, 101):
+            endpoint.succeed(latency / 100)
+        p50, p95 = endpoint.latency()
+        self.assertAlmostEqual(p50, 0.505)
+        self.assertAlmostEqual(p95, 0.9595)
+
+    def test_score(self):
+        fast = router.Endpoint(Provider(url="https://a", api_key=""))
+        slow = router.Endpoint(Provider(url="https://b", api_key=""))
+        fast.succeed(0.1)
+        slow.succeed(1.0)
+        self.assertGreater(fast.score(), slow.score())
+        fast.fail()
+        self.assertEqual(fast.error_rate(), 0.5)
+        self.assertLess(fast.score(), 10)
+
+    def test_serves(self):
+        endpoint = router.Endpoint(Provider(url="https://a", api_key="", models=["gpt"]))
+        self.assertTrue(endpoint.serves("gpt"))
+        self.assertFalse(endpoint.serves("llama"))
+
+
+class RouterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.providers = config.providers
+        self.max_attempts = config.retry.max_attempts
+        self.cooldown = config.router.cooldown
+        config.providers = [
+            Provider(url="https://a.example.com", api_key="a"),
+            Provider(url="https://b.example.com", api_key="b"),
+        ]
+        config.retry.max_attempts = 1
+        router._endpoints.clear()
+        self.requests = []
+
+    async def asyncTearDown(self) -> None:
+        config.providers = self.providers
+        config.retry.max_attempts = self.max_attempts
+        config.router.cooldown = self.cooldown
+        router._endpoints.clear()
+        await clients.close()
+
+    def use_responses(self, url: str, *responses: httpx.Response) -> None:
+        responses = list(responses)
+
+        def handle(request: httpx.Request) -> httpx.Response:
+            self.requests.append(url)
+            return responses.pop(0)
+
+        clients._clients[url] = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+
+    def answer(self, text: str) -> httpx.Response:
+        return httpx.Response(
+            200,
+            json={
+                "choices": [{"message": {"content": text}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            },
+        )
+
+    def test_select(self):
+        endpoints = router.select("gpt")
+        self.assertEqual(len(endpoints), 2)
+        config.providers[1].models = ["llama"]
+        endpoints = router.select("gpt")
+        self.assertEqual([endpoint.url for endpoint in endpoints], ["https://a.example.com"])
+
+    def test_select_open(self):
+        endpoint = router.get(config.providers[0])
+        for _ in range(config.router.max_failures):
+            endpoint.fail()
+        endpoints = router.select("gpt")
+        self.assertEqual([endpoint.url for endpoint in endpoints], ["https://b.example.com"])
+
+    def test_select_recovering(self):
+        config.router.cooldown = 0.01
+        endpoint = router.get(config.providers[0])
+        for _ in range(config.router.max_failures):
+            endpoint.fail()
+        time.sleep(0.02)
+        # listing the endpoint as a candidate does not use up its trial request
+        self.assertEqual(len(router.select("gpt")), 2)
+        self.assertEqual(len(router.select("gpt")), 2)
+        self.assertTrue(endpoint.breaker.allow())
+
+    def test_default_provider(self):
+        config.providers = []
+        endpoints = router.select("gpt")
+        self.assertEqual([endpoint.url for endpoint in endpoints], [config.openai.url])
+
+    async def test_failover(self):
+        config.providers[1].weight = 0.000001
+        self.use_responses("https://a.example.com", httpx.Response(503, text="overloaded"))
+        self.use_responses("https://b.example.com", self.answer("Hi!"))
+        answer = await chat.Model("gpt").ask(prompt="", question="Hello", history=[])
+        self.assertEqual(answer, "Hi!")
+        self.assertEqual(self.requests, ["https://a.example.com", "https://b.example.com"])
+        self.assertEqual(router.get(config.providers[0]).error_rate(), 1.0)
+        self.assertEqual(router.get(config.providers[1]).error_rate(), 0.0)
+
+    async def test_failover_error(self):
+        def fail(request: httpx.Request) -> httpx.Response:
+            self.requests.append("https://a.example.com")
+            raise httpx.ConnectError("connection refused")
+
+        config.providers[1].weight = 0.000001
+        clients._clients["https://a.example.com"] = httpx.AsyncClient(
+            transport=httpx.MockTransport(fail)
+        )
+        self.use_responses("https://b.example.com", self.answer("Hi!"))
+        answer = await chat.Model("gpt").ask(prompt="", question="Hello", history=[])
+        self.assertEqual(answer, "Hi!")
+        self.assertEqual(self.requests, ["https://a.example.com", "https://b.example.com"])
+
+    async def test_failover_endpoint_status(self):
+        config.providers[1].weight = 0.000001
+        self.use_responses("https://a.example.com", httpx.Response(401, text="invalid api key"))
+        self.use_responses("https://b.example.com", self.answer("Hi!"))
+        answer = await chat.Model("gpt").ask(prompt="", question="Hello", history=[])
+        self.assertEqual(answer, "Hi!")
+        self.assertEqual(self.requests, ["https://a.example.com", "https://b.example.com"])
+        self.assertEqual(router.get(config.providers[0]).error_rate(), 1.0)
+
+    async def test_request_status(self):
+        config.providers[1].weight = 0.000001
+        self.use_responses("https://a.example.com", httpx.Response(400, json={"error": "bad"}))
+        self.use_responses("https://b.example.com", self.answer("Hi!"))
+        # a bad request fails the same way everywhere
+        with self.assertRaises(Exception):
+            await chat.Model("gpt").ask(prompt="", question="Hello", history=[])
+        self.assertEqual(self.requests, ["https://a.example.com"])
+        self.assertEqual(router.get(config.providers[0]).error_rate(), 0.0)
+
+    async def test_all_failed(self):
+        self.use_responses("https://a.example.com", httpx.Response(503, text="overloaded"))
+        self.use_responses("https://b.example.com", httpx.Response(503, text="overloaded"))
+        with self.assertRaises(Exception):
+            await chat.Model("gpt").ask(prompt="", question="Hello", history=[])
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_deadline(self):
+        self.use_responses("https://a.example.com", httpx.Response(503, text="overloaded"))
+        self.use_responses("https://b.example.com", self.answer("Hi!"))
+        endpoints = [router.get(provider) for provider in config.providers]
+
+        async def send(endpoint: router.Endpoint) -> httpx.Response:
+            return await clients.get(endpoint.url).post(f"{endpoint.url}/chat/completions")
+
+        # the deadline has passed, so there is no failover
+        response = await router._request(endpoints, send, deadline=time.monotonic())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.requests, ["https://a.example.com"])
+
+
+class HedgeTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.providers = config.providers
+        config.providers = [
+            Provider(url="https://a.example.com", api_key="a", weight=1000),
+            Provider(url="https://b.example.com", api_key="b", weight=0.000001),
+        ]
+        router._endpoints.clear()
+        router.budget.balance = 1.0
+        # the first endpoint usually answers in 10ms
+        for _ in range(router.HEDGE_MIN_SAMPLES):
+            router.get(config.providers[0]).succeed(0.01)
+        self.delays = {"https://a.example.com": 1.0, "https://b.example.com": 0.0}
+        self.sent = []
+        self.cancelled = []
+
+    def tearDown(self) -> None:
+        config.providers = self.providers
+        router._endpoints.clear()
+        router.budget.balance = 0.0
+
+    async def send(self, endpoint: router.Endpoint) -> httpx.Response:
+        self.sent.append(endpoint.url)
+        try:
+            await asyncio.sleep(self.delays[endpoint.url])
+        except asyncio.CancelledError:
+            self.cancelled.append(endpoint.url)
+            raise
+        return httpx.Response(200, text=endpoint.url)
+
+    async def test_hedge(self):
+        response = await router.request("gpt", self.send, hedge=True)
+        self.assertEqual(response.text, "https://b.example.com")
+        self.assertEqual(self.sent, ["https://a.example.com", "https://b.example.com"])
+        self.assertEqual(self.cancelled, ["https://a.example.com"])
+        self.assertLess(router.budget.balance, 1)
+
+    async def test_fast(self):
+        self.delays["https://a.example.com"] = 0.0
+        response = await router.request("gpt", self.send, hedge=True)
+        self.assertEqual(response.text, "https://a.example.com")
+        self.assertEqual(self.sent, ["https://a.example.com"])
+
+    async def test_budget(self):
+        router.budget.balance = 0.0
+        self.delays["https://a.example.com"] = 0.05
+        response = await router.request("gpt", self.send, hedge=True)
+        self.assertEqual(response.text, "https://a.example.com")
+        self.assertEqual(self.sent, ["https://a.example.com"])
+
+    async def test_no_stats(self):
+        router._endpoints.clear()
+        self.delays["https://a.example.com"] = 0.05
+        response = await router.request("gpt", self.send, hedge=True)
+        self.assertEqual(response.text, "https://a.example.com")
+        self.assertEqual(self.sent, ["https://a.example.com"])
+
+    async def test_hedge_failed(self):
+        async def send(endpoint: router.Endpoint) -> httpx.Response:
+            if endpoint.url == "https://b.example.com":
+                return httpx.Response(503, text="overloaded")
+            return await self.send(endpoint)
+
+        max_attempts = config.retry.max_attempts
+        config.retry.max_attempts = 1
+        self.delays["https://a.example.com"] = 0.05
+        response = await router.request("gpt", send, hedge=True)
+        config.retry.max_attempts = max_attempts
+        self.assertEqual(response.text, "https://a.example.com")
+        self.assertEqual(router.get(config.providers[1]).error_rate(), 1.0)
+
+    def test_budget_rate(self):
+        max_rate = config.hedging.max_rate
+        config.hedging.max_rate = 0.25
+        router.budget.balance = 0.0
+        n_hedged = 0
+        for _ in range(100):
+            router.budget.deposit()
+            n_hedged += router.budget.withdraw()
+        config.hedging.max_rate = max_rate
+        self.assertEqual(n_hedged, 25)
@@ -1,3 +1,4 @@
+import asyncio
 import datetime as dt
 import unittest
 from telegram import Chat, Message, User
@@ -28,6 +29,53 @@ class TextAskerTest(unittest.IsolatedAsyncioTestCase):
         await asker.reply(message, context, answer="My name is ChatGPT.")
         self.assertEqual(context.bot.text, "My name is ChatGPT.")
 
+    async def test_reply_long(self):
+        message, context = _create_message()
+        asker = TextAsker("gpt")
+        answer = "\n\n".join(f"Paragraph {idx}. " + "Lorem ipsum. " * 100 for idx in range(10))
+        await asker.reply(message, context, answer=answer)
+        self.assertEqual(context.bot.n_sent, 4)
+        self.assertTrue(context.bot.text.startswith("Paragraph 9."))
+
+    async def test_ask_stream(self):
+        message, context = _create_message()
+        asker = TextAsker("gpt")
+        answer = await asker.ask_stream(
+            message, context, prompt="Answer me", question="My name is ChatGPT.", history=[]
+        )
+        self.assertEqual(answer, "My name is ChatGPT.")
+        self.assertEqual(context.bot.n_sent, 1)
+        self.assertEqual(context.bot.text, "My")
+
+        await asker.reply(message, context, answer=answer)
+        self.assertEqual(context.bot.n_sent, 1)
+        self.assertEqual(context.bot.text, "My name is ChatGPT.")
+
+    async def test_ask_stream_slow_edits(self):
+        async def ask_stream(*args, **kwargs):
+            for idx in range(10):
+                await asyncio.sleep(0.005)
+                yield f"word{idx} "
+
+        async def edit_message_text(text: str, **kwargs) -> None:
+            # the edit waits for the rate limits
+            await asyncio.sleep(0.02)
+            edits.append(text)
+
+        edits = []
+        message, context = _create_message()
+        context.bot.edit_message_text = edit_message_text
+        asker = TextAsker("gpt")
+        asker.edit_interval = 0
+        self.ai.ask_stream = ask_stream
+        answer = await asker.ask_stream(
+            message, context, prompt="Answer me", question="Hello", history=[]
+        )
+        self.assertEqual(answer, " ".join(f"word{idx}" for idx in range(10)))
+        # the stream is not held up by the edits, which skip the intermediate texts
+        self.assertLess(len(edits), 5)
+        self.assertIsNone(asker.updating)
+
 
 class ImagineAskerTest(unittest.IsolatedAsyncioTestCase):
     def setUp(self) -> None:
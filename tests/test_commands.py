@@ -1,7 +1,7 @@
 import datetime as dt
 import unittest
 from telegram import Chat, Message, MessageEntity, Update, User
-from telegram.constants import ChatType
+from telegram.constants import ChatType, MessageLimit
 from telegram.ext import CallbackContext
 from telegram.ext import filters as tg_filters
 
@@ -413,6 +413,17 @@ class MessageTest(unittest.IsolatedAsyncioTestCase, Helper):
         self.assertEqual(self.ai.question, "What is your name?")
         self.assertEqual(self.ai.history, [])
 
+    async def test_stream(self):
+        config.openai.stream = True
+        try:
+            update = self._create_update(11, text="What is your name?")
+            await self.command(update, self.context)
+            self.assertEqual(self.bot.text, "What is your name?")
+            self.assertEqual(self.bot.n_sent, 1)
+            self.assertEqual(self.ai.question, "What is your name?")
+        finally:
+            config.openai.stream = False
+
     async def test_follow_up(self):
         update = self._create_update(11, text="What is your name?")
         await self.command(update, self.context)
@@ -440,10 +451,12 @@ class MessageTest(unittest.IsolatedAsyncioTestCase, Helper):
         await self.command(update, self.context)
         self.assertTrue(self.bot.text.startswith("This is a forwarded message"))
 
-    async def test_document(self):
-        update = self._create_update(11, text="I have so much to say" + "." * 5000)
+    async def test_long_answer(self):
+        update = self._create_update(11, text="I have so much to say. " * 250)
         await self.command(update, self.context)
-        self.assertEqual(self.bot.text, "I have so much to... (see attachment for the rest): 11.md")
+        self.assertEqual(self.bot.n_sent, 2)
+        self.assertLessEqual(len(self.bot.text), MessageLimit.MAX_TEXT_LENGTH)
+        self.assertTrue(self.bot.text.endswith("say."))
 
     async def test_exception(self):
         ai = FakeGPT(error=Exception("connection timeout"))
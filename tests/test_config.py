@@ -23,10 +23,41 @@ class ConfigTest(unittest.TestCase):
         self.assertTrue(config.openai.prompt, "You are an AI assistant.")
         self.assertEqual(config.openai.params["temperature"], 0.7)
         self.assertEqual(config.openai.params["max_tokens"], 4096)
-
+        self.assertFalse(config.openai.stream)
+
+        self.assertFalse(config.webhook)
+        self.assertEqual(config.webhook.listen, "127.0.0.1")
+        self.assertEqual(config.webhook.port, 8080)
+        self.assertEqual(config.scheduler.concurrency, 16)
+        self.assertFalse(config.metrics.enabled)
+        self.assertEqual(config.metrics.port, 9090)
+        self.assertEqual(config.providers, [])
+        self.assertEqual(config.router.max_failures, 5)
+        self.assertEqual(config.router.cooldown, 30.0)
+        self.assertFalse(config.hedging.enabled)
+        self.assertEqual(config.hedging.percentile, 95)
+        self.assertEqual(config.hedging.max_rate, 0.1)
         self.assertEqual(config.conversation.depth, 5)
         self.assertEqual(config.imagine.enabled, "none")
         self.assertEqual(config.persistence_path, "./data/persistence.pkl")
+        self.assertEqual(config.vocab_path, "./data/vocab")
+        self.assertEqual(config.http.max_connections, 100)
+        self.assertEqual(config.http.read_timeout, 60.0)
+        self.assertFalse(config.http.http2)
+        self.assertEqual(config.retry.max_attempts, 3)
+        self.assertEqual(config.retry.deadline, 60.0)
+        self.assertEqual(config.ratelimit.requests_per_minute, 0)
+        self.assertEqual(config.ratelimit.tokens_per_minute, 0)
+        self.assertEqual(config.ratelimit.models, {})
+        self.assertFalse(config.completion_cache.enabled)
+        self.assertEqual(config.completion_cache.size, 1000)
+        self.assertEqual(config.completion_cache.ttl, 3600)
+        self.assertEqual(config.fetcher.concurrency, 4)
+        self.assertEqual(config.fetcher.budget, 10.0)
+        self.assertEqual(config.fetcher.max_bytes, 4 * 1024 * 1024)
+        self.assertEqual(config.documents.max_bytes, 1024 * 1024)
+        self.assertEqual(config.documents.max_tokens, 0)
+        self.assertEqual(config.documents.window_share, 0.5)
         self.assertEqual(config.shortcuts, {})
 
     def test_as_dict(self):
@@ -228,6 +259,12 @@ class SetValueTest(unittest.TestCase):
         _, is_immediate, _ = self.editor.set_value("telegram.token", "tg-5678")
         self.assertFalse(is_immediate)
 
+    def test_is_delayed_section(self):
+        _, is_immediate, _ = self.editor.set_value("http.max_connections", "10")
+        self.assertFalse(is_immediate)
+        _, is_immediate, _ = self.editor.set_value("webhook.port", "8443")
+        self.assertFalse(is_immediate)
+
 
 class MigrateTest(unittest.TestCase):
     def test_migrate_v1(self):
@@ -0,0 +1,67 @@
+import unittest
+from bot import extractor
+
+
+class ExtractTextTest(unittest.TestCase):
+    def test_text(self):
+        html = "<html><body><p>Hello,   <b>world</b>!\n</p></body></html>"
+        self.assertEqual(extractor.extract_text(html), "Hello, world!")
+
+    def test_main(self):
+        html = "<body><div>menu</div><main><p>content</p></main><div>more</div></body>"
+        self.assertEqual(extractor.extract_text(html), "content")
+
+    def test_empty_main(self):
+        html = "<body><main> </main><p>content</p></body>"
+        self.assertEqual(extractor.extract_text(html), "content")
+
+    def test_skip(self):
+        html = (
+            "<html><head><title>Title</title><style>p { color: red }</style></head>"
+            "<body><nav><a href='/'>Home</a></nav><p>content</p>"
+            "<script>alert('hi')</script><footer>© 2023</footer></body></html>"
+        )
+        self.assertEqual(extractor.extract_text(html), "content")
+
+    def test_headings(self):
+        html = "<h1>Title</h1><p>Intro</p><h2>Section</h2><p>Text</p>"
+        self.assertEqual(extractor.extract_text(html), "# Title\n\nIntro\n\n## Section\n\nText")
+
+    def test_lists(self):
+        html = "<ul><li>one</li><li>two<ol><li>first</li><li>second</li></ol></li></ul>"
+        self.assertEqual(extractor.extract_text(html), "- one\n- two\n  1. first\n  2. second")
+
+    def test_code(self):
+        html = (
+            "<p>Call <code>main()</code>:</p>"
+            "<pre><code>def main():\n    print(42)\n</code></pre>"
+        )
+        self.assertEqual(
+            extractor.extract_text(html),
+            "Call `main()`:\n\n```\ndef main():\n    print(42)\n```",
+        )
+
+    def test_line_breaks(self):
+        html = "<div>one<br>two</div><div>three</div>"
+        self.assertEqual(extractor.extract_text(html), "one\ntwo\nthree")
+
+    def test_entities(self):
+        html = "<p>fish &amp; chips &lt;3</p>"
+        self.assertEqual(extractor.extract_text(html), "fish & chips <3")
+
+    def test_unclosed_tags(self):
+        html = "<body><nav>menu</nav><h1>Title</h1><ul><li>one<li>two</ul></body>"
+        self.assertEqual(extractor.extract_text(html), "# Title\n\n- one\n- two")
+
+    def test_unclosed_head(self):
+        html = (
+            "<html><head><title>T</title><meta charset=utf-8>"
+            "<body><p>Hello world</p></body></html>"
+        )
+        self.assertEqual(extractor.extract_text(html), "Hello world")
+        html = "<head><title>T</title><p>Hello world</p>"
+        self.assertEqual(extractor.extract_text(html), "Hello world")
+
+    def test_unclosed_skipped(self):
+        html = "<div><nav><a href='/'>Home</a></div><p>content</p><aside>ads</body>"
+        self.assertEqual(extractor.extract_text(html), "content")
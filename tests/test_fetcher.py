@@ -1,22 +1,36 @@
+import asyncio
+import contextlib
+import os
+import tempfile
+import time
 import unittest
 from httpx import Request, Response
 
-from bot.fetcher import Fetcher, Content
+from bot import fetcher
+from bot.config import config
+from bot.fetcher import CacheEntry, ContentCache, Fetcher, Content
 
 
 class FakeClient:
-    def __init__(self, responses: dict[str, Response | Exception]) -> None:
+    def __init__(
+        self, responses: dict[str, Response | Exception], delays: dict[str, float] = None
+    ) -> None:
         self.responses = responses
+        self.delays = delays or {}
+        self.headers = {}
 
-    async def get(self, url: str) -> Response:
-        request = Request(method="GET", url=url)
+    @contextlib.asynccontextmanager
+    async def stream(self, method: str, url: str, headers: dict = None):
+        self.headers[url] = headers or {}
+        await asyncio.sleep(self.delays.get(url, 0))
+        request = Request(method=method, url=url)
         response = self.responses[url]
         if isinstance(response, Exception):
             raise response
-        return Response(
+        yield Response(
             status_code=response.status_code,
             headers=response.headers,
-            text=response.text,
+            content=response.content,
             request=request,
         )
 
@@ -53,6 +67,44 @@ second
 ---""",
         )
 
+    async def test_substitute_concurrently(self):
+        resp_1 = Response(status_code=200, headers={"content-type": "text/plain"}, text="first")
+        resp_2 = Response(status_code=200, headers={"content-type": "text/plain"}, text="second")
+        self.fetcher.client = FakeClient(
+            responses={
+                "https://example.org/first": resp_1,
+                "https://example.org/second": resp_2,
+            },
+            delays={"https://example.org/first": 0.2, "https://example.org/second": 0.1},
+        )
+        text = "Compare https://example.org/first and https://example.org/second"
+        start = time.perf_counter()
+        text = await self.fetcher.substitute_urls(text)
+        self.assertLess(time.perf_counter() - start, 0.3)
+        self.assertLess(text.index("first contents"), text.index("second contents"))
+
+    async def test_substitute_budget(self):
+        resp_1 = Response(status_code=200, headers={"content-type": "text/plain"}, text="first")
+        resp_2 = Response(status_code=200, headers={"content-type": "text/plain"}, text="second")
+        self.fetcher.client = FakeClient(
+            responses={
+                "https://example.org/first": resp_1,
+                "https://example.org/second": resp_2,
+            },
+            delays={"https://example.org/first": 1},
+        )
+        budget = config.fetcher.budget
+        config.fetcher.budget = 0.1
+        try:
+            text = "Compare https://example.org/first and https://example.org/second"
+            text = await self.fetcher.substitute_urls(text)
+        finally:
+            config.fetcher.budget = budget
+        self.assertIn(
+            "https://example.org/first contents:\n\nFailed to fetch (builtins.TimeoutError)", text
+        )
+        self.assertIn("https://example.org/second contents:\n\nsecond", text)
+
     async def test_fetch_url(self):
         resp = Response(status_code=200, headers={"content-type": "text/plain"}, text="hello")
         exc = ConnectionError("timeout")
@@ -86,6 +138,165 @@ second
         self.assertEqual(urls, [])
 
 
+class FetcherLimitsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fetcher = Fetcher()
+        self.max_bytes = config.fetcher.max_bytes
+
+    def tearDown(self) -> None:
+        config.fetcher.max_bytes = self.max_bytes
+
+    async def test_max_bytes(self):
+        config.fetcher.max_bytes = 10
+        resp = Response(status_code=200, headers={"content-type": "text/plain"}, text="a" * 100)
+        self.fetcher.client = FakeClient({"https://example.org/large": resp})
+        text = await self.fetcher._fetch_url("https://example.org/large")
+        self.assertEqual(text, "aaaaaaaaaa\n[truncated]")
+
+    async def test_max_bytes_multibyte(self):
+        config.fetcher.max_bytes = 5
+        resp = Response(status_code=200, headers={"content-type": "text/plain"}, text="привет")
+        self.fetcher.client = FakeClient({"https://example.org/large": resp})
+        text = await self.fetcher._fetch_url("https://example.org/large")
+        self.assertEqual(text, "пр\ufffd\n[truncated]")
+
+    async def test_max_chars(self):
+        resp = Response(status_code=200, headers={"content-type": "text/plain"}, text="a" * 100)
+        self.fetcher.client = FakeClient({"https://example.org/large": resp})
+        text = await self.fetcher._fetch_url("https://example.org/large", max_chars=10)
+        self.assertEqual(text, "aaaaaaaaaa\n[truncated]")
+        # partial contents are not cached
+        self.assertIsNone(self.fetcher.cache.get("https://example.org/large"))
+
+    async def test_max_tokens(self):
+        resp_1 = Response(status_code=200, headers={"content-type": "text/plain"}, text="a" * 100)
+        resp_2 = Response(status_code=200, headers={"content-type": "text/plain"}, text="b" * 10)
+        self.fetcher.client = FakeClient(
+            {
+                "https://example.org/first": resp_1,
+                "https://example.org/second": resp_2,
+            }
+        )
+        text = "Compare https://example.org/first and https://example.org/second"
+        text = await self.fetcher.substitute_urls(text, max_tokens=10)
+        self.assertIn("a" * 20 + "\n[truncated]", text)
+        self.assertIn("b" * 10 + "\n---", text)
+
+    async def test_no_room(self):
+        client = FakeClient({"https://example.org/first": ConnectionError()})
+        self.fetcher.client = client
+        src = "Summarize https://example.org/first"
+        self.assertEqual(await self.fetcher.substitute_urls(src, max_tokens=0), src)
+        self.assertEqual(await self.fetcher.substitute_urls(src, max_tokens=-5), src)
+        self.assertEqual(client.headers, {})
+
+    async def test_cached_max_chars(self):
+        headers = {"content-type": "text/plain", "cache-control": "max-age=60"}
+        resp = Response(status_code=200, headers=headers, text="a" * 100)
+        self.fetcher.client = FakeClient({"https://example.org/large": resp})
+        text = await self.fetcher._fetch_url("https://example.org/large")
+        self.assertEqual(text, "a" * 100)
+        text = await self.fetcher._fetch_url("https://example.org/large", max_chars=10)
+        self.assertEqual(text, "aaaaaaaaaa\n[truncated]")
+
+    async def test_binary(self):
+        resp = Response(
+            status_code=200, headers={"content-type": "application/pdf"}, content=b"%PDF"
+        )
+        self.fetcher.client = FakeClient({"https://example.org/file.pdf": resp})
+        text = await self.fetcher._fetch_url("https://example.org/file.pdf")
+        self.assertEqual(text, "Unknown binary content")
+
+
+class FetcherCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fetcher = Fetcher()
+
+    async def test_fresh(self):
+        headers = {"content-type": "text/plain", "cache-control": "max-age=60"}
+        resp = Response(status_code=200, headers=headers, text="hello")
+        self.fetcher.client = FakeClient({"https://example.org/hello": resp})
+        text = await self.fetcher._fetch_url("https://example.org/hello")
+        self.assertEqual(text, "hello")
+
+        self.fetcher.client = FakeClient({"https://EXAMPLE.org:443/hello#world": ConnectionError()})
+        text = await self.fetcher._fetch_url("https://EXAMPLE.org:443/hello#world")
+        self.assertEqual(text, "hello")
+
+    async def test_revalidate(self):
+        headers = {"content-type": "text/plain", "cache-control": "no-cache", "etag": '"v1"'}
+        resp = Response(status_code=200, headers=headers, text="hello")
+        self.fetcher.client = FakeClient({"https://example.org/hello": resp})
+        text = await self.fetcher._fetch_url("https://example.org/hello")
+        self.assertEqual(text, "hello")
+
+        resp = Response(status_code=304, headers={"etag": '"v1"'}, text="")
+        client = FakeClient({"https://example.org/hello": resp})
+        self.fetcher.client = client
+        text = await self.fetcher._fetch_url("https://example.org/hello")
+        self.assertEqual(text, "hello")
+        self.assertEqual(client.headers["https://example.org/hello"], {"if-none-match": '"v1"'})
+
+    async def test_modified(self):
+        headers = {"content-type": "text/plain", "cache-control": "no-cache", "etag": '"v1"'}
+        resp = Response(status_code=200, headers=headers, text="hello")
+        self.fetcher.client = FakeClient({"https://example.org/hello": resp})
+        await self.fetcher._fetch_url("https://example.org/hello")
+
+        headers = {"content-type": "text/plain", "etag": '"v2"'}
+        resp = Response(status_code=200, headers=headers, text="hello again")
+        self.fetcher.client = FakeClient({"https://example.org/hello": resp})
+        text = await self.fetcher._fetch_url("https://example.org/hello")
+        self.assertEqual(text, "hello again")
+
+    async def test_no_store(self):
+        headers = {"content-type": "text/plain", "cache-control": "no-store"}
+        resp = Response(status_code=200, headers=headers, text="hello")
+        self.fetcher.client = FakeClient({"https://example.org/hello": resp})
+        await self.fetcher._fetch_url("https://example.org/hello")
+        self.assertIsNone(self.fetcher.cache.get("https://example.org/hello"))
+
+
+class ContentCacheTest(unittest.TestCase):
+    def test_evict(self):
+        cache = ContentCache(max_size=10)
+        cache.put("one", CacheEntry("1234", "", "", 0))
+        cache.put("two", CacheEntry("5678", "", "", 0))
+        cache.get("one")
+        cache.put("three", CacheEntry("90", "", "", 0))
+        self.assertEqual(list(cache.entries), ["two", "one", "three"])
+        cache.put("four", CacheEntry("abcd", "", "", 0))
+        self.assertEqual(list(cache.entries), ["one", "three", "four"])
+        self.assertEqual(cache.size, 10)
+
+    def test_too_large(self):
+        cache = ContentCache(max_size=3)
+        cache.put("one", CacheEntry("1234", "", "", 0))
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = os.path.join(dirname, "cache.pkl")
+            cache = ContentCache(max_size=100, path=path)
+            cache.put("one", CacheEntry("hello", '"v1"', "", 42))
+            cache.save()
+
+            cache = ContentCache(max_size=100, path=path)
+            self.assertEqual(cache.get("one"), CacheEntry("hello", '"v1"', "", 42))
+            self.assertEqual(cache.size, 9)
+
+
+class NormalizeUrlTest(unittest.TestCase):
+    def test_normalize(self):
+        self.assertEqual(fetcher._normalize_url("https://Example.org"), "https://example.org/")
+        self.assertEqual(
+            fetcher._normalize_url("http://example.org:80/a?b=c#d"), "http://example.org/a?b=c"
+        )
+        self.assertEqual(
+            fetcher._normalize_url("https://example.org:8443/a"), "https://example.org:8443/a"
+        )
+
+
 class ContentTest(unittest.TestCase):
     def test_extract_as_is(self):
         resp = Response(
@@ -0,0 +1,97 @@
+import asyncio
+import datetime as dt
+import unittest
+
+from telegram import Chat, Message
+from telegram.constants import ChatAction
+
+from bot import heartbeat
+
+
+class ActionBot:
+    def __init__(self, fail: bool = False) -> None:
+        self.actions = []
+        self.fail = fail
+
+    async def send_chat_action(self, **kwargs) -> None:
+        self.actions.append(kwargs)
+        if self.fail:
+            raise ConnectionError("network is down")
+
+
+def make_message(bot: ActionBot, chat_id: int = 1, thread_id: int = None) -> Message:
+    message = Message(
+        message_id=11,
+        date=dt.datetime.now(),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE),
+        text="question",
+        message_thread_id=thread_id,
+    )
+    message.set_bot(bot)
+    return message
+
+
+class KeepTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.interval = heartbeat.INTERVAL
+        heartbeat.INTERVAL = 0.01
+        self.bot = ActionBot()
+
+    def tearDown(self) -> None:
+        heartbeat.INTERVAL = self.interval
+
+    async def test_repeat(self):
+        message = make_message(self.bot, thread_id=5)
+        async with heartbeat.keep(message, ChatAction.TYPING):
+            await asyncio.sleep(0.035)
+        self.assertGreaterEqual(len(self.bot.actions), 3)
+        self.assertEqual(
+            self.bot.actions[0], {"chat_id": 1, "action": "typing", "message_thread_id": 5}
+        )
+        self.assertEqual(heartbeat._heartbeats, {})
+
+    async def test_stop(self):
+        message = make_message(self.bot)
+        async with heartbeat.keep(message, ChatAction.TYPING):
+            await asyncio.sleep(0)
+        n_actions = len(self.bot.actions)
+        await asyncio.sleep(0.03)
+        self.assertEqual(len(self.bot.actions), n_actions)
+
+    async def test_error(self):
+        message = make_message(self.bot)
+        with self.assertRaises(ValueError):
+            async with heartbeat.keep(message, ChatAction.TYPING):
+                await asyncio.sleep(0)
+                raise ValueError("failed to answer")
+        self.assertEqual(heartbeat._heartbeats, {})
+
+    async def test_action_fails(self):
+        bot = ActionBot(fail=True)
+        message = make_message(bot)
+        async with heartbeat.keep(message, ChatAction.TYPING):
+            await asyncio.sleep(0.025)
+        self.assertGreaterEqual(len(bot.actions), 2)
+
+    async def test_shared(self):
+        async def answer(delay: float) -> None:
+            async with heartbeat.keep(make_message(self.bot), ChatAction.TYPING):
+                await asyncio.sleep(delay)
+
+        await asyncio.gather(answer(0.035), answer(0.035), answer(0.035))
+        # one action per interval, not three
+        self.assertLess(len(self.bot.actions), 8)
+        self.assertEqual(heartbeat._heartbeats, {})
+
+    async def test_separate(self):
+        async def answer(chat_id: int, action: str) -> None:
+            async with heartbeat.keep(make_message(self.bot, chat_id), action):
+                await asyncio.sleep(0)
+
+        await asyncio.gather(
+            answer(1, ChatAction.TYPING),
+            answer(2, ChatAction.TYPING),
+            answer(1, ChatAction.UPLOAD_PHOTO),
+        )
+        sent = {(action["chat_id"], action["action"]) for action in self.bot.actions}
+        self.assertEqual(sent, {(1, "typing"), (2, "typing"), (1, "upload_photo")})
@@ -1,3 +1,4 @@
+import time
 import unittest
 from bot import markdown
 
@@ -24,23 +25,19 @@ See [Documentation](https://github.com/nalgeon/sqlean) for reference.
 
 TEXT_HTML = r"""You can easily regular expressions them using the <code>sqlean-regexp</code> extension.
 
-&gt; <b>Note</b>. Unlike other DBMS, adding extensions to SQLite is a breeze.
+<blockquote><b>Note</b>. Unlike other DBMS, adding extensions to SQLite is a breeze.</blockquote>
 
 With <code>sqlean-regexp</code>, matching a string against a pattern becomes as easy as:
 
-<pre>
-select count(*) from messages
-where msg_text regexp '\d+';
-</pre>
+<pre><code class="language-sql">select count(*) from messages
+where msg_text regexp '\d+';</code></pre>
 
 <code>regexp_like(source, pattern)</code> checks if the source string matches the pattern:
 
-<pre>
-select regexp_like('Meet me at 10:30', '\d+:\d+');
-select 10 &gt; 5 = true;
-</pre>
+<pre><code class="language-sql">select regexp_like('Meet me at 10:30', '\d+:\d+');
+select 10 &gt; 5 = true;</code></pre>
 
-See [Documentation](https://github.com/nalgeon/sqlean) for reference.
+See <a href="https://github.com/nalgeon/sqlean">Documentation</a> for reference.
 """
 
 
@@ -57,20 +54,131 @@ class Test(unittest.TestCase):
         text = markdown.to_html("one `two\n` three")
         self.assertEqual(text, "one `two\n` three")
 
+    def test_adjacent_pre(self):
+        text = markdown.to_html("```\na\n```\n  ```py\nb\n```\nend")
+        self.assertEqual(text, '<pre>a</pre>\n<pre><code class="language-py">b</code></pre>\nend')
+        text = markdown.to_html("```\na\n```\n```\nb\n```")
+        self.assertEqual(text, "<pre>a</pre>\n<pre>b</pre>")
+
+    def test_pre(self):
+        text = markdown.to_html("```\nif a < b:\n    pass\n```")
+        self.assertEqual(text, "<pre>if a &lt; b:\n    pass</pre>")
+        text = markdown.to_html("```c++\nint **p;\n```")
+        self.assertEqual(text, '<pre><code class="language-c++">int **p;</code></pre>')
+        text = markdown.to_html("```python\nprint(**kwargs)")
+        self.assertEqual(text, '<pre><code class="language-python">print(**kwargs)</code></pre>')
+        text = markdown.to_html("text ```code``` text")
+        self.assertEqual(text, "text <code>code</code> text")
+
     def test_bold(self):
         text = markdown.to_html("one **two** three")
         self.assertEqual(text, "one <b>two</b> three")
-        text = markdown.to_html("one *two* three")
-        self.assertEqual(text, "one *two* three")
+        text = markdown.to_html("one __two__ three")
+        self.assertEqual(text, "one <b>two</b> three")
         text = markdown.to_html("one **two three")
         self.assertEqual(text, "one **two three")
         text = markdown.to_html("operator `**` is so ** powerful")
         self.assertEqual(text, "operator <code>**</code> is so ** powerful")
+        text = markdown.to_html("one ** two ** three")
+        self.assertEqual(text, "one ** two ** three")
+
+    def test_italic(self):
+        text = markdown.to_html("one *two* three")
+        self.assertEqual(text, "one <i>two</i> three")
+        text = markdown.to_html("one _two_ three")
+        self.assertEqual(text, "one <i>two</i> three")
+        text = markdown.to_html("2 * 3 * 4")
+        self.assertEqual(text, "2 * 3 * 4")
+        text = markdown.to_html("snake_case_name")
+        self.assertEqual(text, "snake_case_name")
+        text = markdown.to_html("one **two *three* four**")
+        self.assertEqual(text, "one <b>two <i>three</i> four</b>")
+
+    def test_link(self):
+        text = markdown.to_html("see [the docs](https://example.com/?a=1&b=2)")
+        self.assertEqual(text, 'see <a href="https://example.com/?a=1&amp;b=2">the docs</a>')
+        text = markdown.to_html("see [**the** docs](https://example.com)")
+        self.assertEqual(text, 'see <a href="https://example.com"><b>the</b> docs</a>')
+        text = markdown.to_html("see [the docs](javascript:alert(1))")
+        self.assertEqual(text, "see [the docs](javascript:alert(1))")
+        text = markdown.to_html("items[0](1)")
+        self.assertEqual(text, "items[0](1)")
+
+    def test_heading(self):
+        text = markdown.to_html("## Installation ##\nRun `pip install`")
+        self.assertEqual(text, "<b>Installation</b>\nRun <code>pip install</code>")
+        text = markdown.to_html("#hashtag")
+        self.assertEqual(text, "#hashtag")
+
+    def test_blockquote(self):
+        text = markdown.to_html("> one\n> **two**\nthree")
+        self.assertEqual(text, "<blockquote>one\n<b>two</b></blockquote>\nthree")
+        text = markdown.to_html("a > b")
+        self.assertEqual(text, "a &gt; b")
+
+    def test_escape(self):
+        text = markdown.to_html("if a < b && b > c")
+        self.assertEqual(text, "if a &lt; b &amp;&amp; b &gt; c")
+        text = markdown.to_html("`<b>` tag")
+        self.assertEqual(text, "<code>&lt;b&gt;</code> tag")
+
+    def test_unclosed_scaling(self):
+        # openers without closers do not rescan the rest of the line
+        for opener in ("_a ", "*a ", "**a ", "__a ", "[a ", "[a](b "):
+            start = time.perf_counter()
+            text = markdown.to_html(opener * 20000)
+            self.assertLess(time.perf_counter() - start, 1, opener)
+            self.assertEqual(len(text), len(opener) * 20000)
 
     def test_bullet(self):
         text = markdown.to_html("*   one two three")
         self.assertEqual(text, "— one two three")
         text = markdown.to_html("* one two three")
-        self.assertEqual(text, "* one two three")
-        text = markdown.to_html(" *  one two three")
-        self.assertEqual(text, " *  one two three")
+        self.assertEqual(text, "— one two three")
+        text = markdown.to_html("- one\n  - two")
+        self.assertEqual(text, "— one\n  — two")
+        text = markdown.to_html("*one* two three")
+        self.assertEqual(text, "<i>one</i> two three")
+        text = markdown.to_html("-1 degrees")
+        self.assertEqual(text, "-1 degrees")
+
+
+class SplitTest(unittest.TestCase):
+    def test_short(self):
+        self.assertEqual(markdown.split("one <b>two</b>", 100), ["one <b>two</b>"])
+        self.assertEqual(markdown.split("", 100), [])
+
+    def test_paragraphs(self):
+        html = "one two\n\nthree four\n\nfive six"
+        self.assertEqual(markdown.split(html, 20), ["one two\n\nthree four", "five six"])
+
+    def test_words(self):
+        html = "one two three four five six"
+        self.assertEqual(markdown.split(html, 10), ["one two", "three four", "five six"])
+
+    def test_pre(self):
+        code = "\n".join(f"x = {idx}" for idx in range(10))
+        html = markdown.to_html(f"Code:\n```python\n{code}\n```\nDone.")
+        chunks = markdown.split(html, 80)
+        self.assertEqual(len(chunks), 3)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 80)
+            self.assertEqual(chunk.count("<pre>"), chunk.count("</pre>"))
+            self.assertEqual(chunk.count("<code"), chunk.count("</code>"))
+        self.assertTrue(chunks[1].startswith('<pre><code class="language-python">x = '))
+        self.assertTrue(chunks[1].endswith("</code></pre>"))
+        self.assertTrue(chunks[2].endswith("Done."))
+
+    def test_tags(self):
+        html = "<b>" + "word " * 10 + "</b>"
+        chunks = markdown.split(html, 30)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 30)
+            self.assertTrue(chunk.startswith("<b>"))
+            self.assertTrue(chunk.endswith("</b>"))
+
+    def test_entities(self):
+        html = "a" * 8 + "&amp;&lt;"
+        self.assertEqual(markdown.split(html, 12), ["a" * 8, "&amp;&lt;"])
+        html = '<a href="https://example.com">link</a>'
+        self.assertEqual(markdown.split("ab " + html, 40), ["ab", html])
@@ -0,0 +1,132 @@
+import asyncio
+import unittest
+
+from bot import metrics
+
+
+class CounterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.counter = metrics.Counter("test_total", "Test counter.", ("kind",))
+
+    def tearDown(self) -> None:
+        metrics._metrics.remove(self.counter)
+
+    def test_inc(self):
+        self.counter.inc(kind="a")
+        self.counter.inc(2, kind="a")
+        self.counter.inc(kind="b")
+        self.assertEqual(self.counter.get(kind="a"), 3)
+        self.assertEqual(self.counter.get(kind="b"), 1)
+        self.assertEqual(self.counter.get(kind="c"), 0)
+
+    def test_labels(self):
+        with self.assertRaises(ValueError):
+            self.counter.inc(other="a")
+
+    def test_render(self):
+        self.counter.inc(kind='say "hi"\n')
+        self.counter.inc(0.5, kind="b")
+        self.assertEqual(
+            self.counter.render(),
+            "# HELP test_total Test counter.\n"
+            "# TYPE test_total counter\n"
+            'test_total{kind="b"} 0.5\n'
+            'test_total{kind="say \\"hi\\"\\n"} 1\n',
+        )
+
+    def test_function(self):
+        self.counter.set_function(lambda: {"a": 3, "b": 4})
+        self.assertEqual(
+            self.counter.render(),
+            "# HELP test_total Test counter.\n"
+            "# TYPE test_total counter\n"
+            'test_total{kind="a"} 3\n'
+            'test_total{kind="b"} 4\n',
+        )
+
+
+class GaugeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gauge = metrics.Gauge("test_depth", "Test gauge.")
+
+    def tearDown(self) -> None:
+        metrics._metrics.remove(self.gauge)
+
+    def test_set(self):
+        self.gauge.set(5)
+        self.gauge.set(3)
+        self.assertIn("test_depth 3\n", self.gauge.render())
+
+    def test_function(self):
+        self.gauge.set_function(lambda: 7)
+        self.assertIn("test_depth 7\n", self.gauge.render())
+
+
+class HistogramTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.histogram = metrics.Histogram(
+            "test_seconds", "Test histogram.", ("op",), buckets=(0.1, 1)
+        )
+
+    def tearDown(self) -> None:
+        metrics._metrics.remove(self.histogram)
+
+    def test_render(self):
+        self.histogram.observe(0.05, op="get")
+        self.histogram.observe(0.5, op="get")
+        self.histogram.observe(5, op="get")
+        self.assertEqual(self.histogram.get(op="get"), 3)
+        self.assertEqual(
+            self.histogram.render(),
+            "# HELP test_seconds Test histogram.\n"
+            "# TYPE test_seconds histogram\n"
+            'test_seconds_bucket{op="get",le="0.1"} 1\n'
+            'test_seconds_bucket{op="get",le="1"} 2\n'
+            'test_seconds_bucket{op="get",le="+Inf"} 3\n'
+            'test_seconds_sum{op="get"} 5.55\n'
+            'test_seconds_count{op="get"} 3\n',
+        )
+
+    def test_time(self):
+        with self.histogram.time(op="put"):
+            pass
+        self.assertEqual(self.histogram.get(op="put"), 1)
+        self.assertEqual(self.histogram.counts[("put",)], [1, 0, 0])
+
+    def test_empty(self):
+        self.assertEqual(
+            self.histogram.render(),
+            "# HELP test_seconds Test histogram.\n# TYPE test_seconds histogram\n",
+        )
+
+
+class ServeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        await metrics.serve("127.0.0.1", 0)
+        self.port = metrics._server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self) -> None:
+        await metrics.close()
+
+    async def get(self, request: bytes) -> str:
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(request)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        await writer.wait_closed()
+        return response.decode()
+
+    async def test_metrics(self):
+        metrics.questions.inc(chat_type="private")
+        response = await self.get(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        head, _, body = response.partition("\r\n\r\n")
+        self.assertTrue(head.startswith("HTTP/1.1 200 OK"))
+        self.assertIn("Content-Type: text/plain; version=0.0.4", head)
+        self.assertIn("# TYPE bot_questions_total counter\n", body)
+        self.assertIn('bot_questions_total{chat_type="private"}', body)
+        self.assertIn("# TYPE bot_provider_request_seconds histogram\n", body)
+
+    async def test_not_found(self):
+        response = await self.get(b"GET /other HTTP/1.1\r\n\r\n")
+        self.assertTrue(response.startswith("HTTP/1.1 404 Not Found"))
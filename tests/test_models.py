@@ -4,7 +4,16 @@ import unittest
 
 from bot import models
 from bot.config import config
-from bot.models import ExpiringCounter, TimestampedValue, UserData, UserMessage, UserMessages
+from bot.models import (
+    ChatData,
+    ExpiringCounter,
+    MessageTokens,
+    Packed,
+    TimestampedValue,
+    UserData,
+    UserMessage,
+    UserMessages,
+)
 
 
 class UserDataTest(unittest.TestCase):
@@ -33,6 +42,51 @@ class UserDataTest(unittest.TestCase):
         self.assertEqual(data["message_counter"]["value"], 2)
 
 
+class VersionTest(unittest.TestCase):
+    def test_new_user(self):
+        data = {}
+        UserData(data)
+        self.assertIsNotNone(models.get_version(data))
+
+    def test_unchanged(self):
+        data = {}
+        user = UserData(data)
+        version = models.get_version(data)
+        user = UserData(data)
+        user.messages.clear()
+        self.assertEqual(user.message_counter.value, 0)
+        self.assertEqual(models.get_version(data), version)
+
+    def test_changed(self):
+        data = {}
+        user = UserData(data)
+        version = models.get_version(data)
+        user.messages.add("question", "answer")
+        self.assertGreater(models.get_version(data), version)
+        version = models.get_version(data)
+        user.message_counter.increment()
+        self.assertGreater(models.get_version(data), version)
+
+    def test_maxlen_changed(self):
+        data = {}
+        UserMessages(data, maxlen=3)
+        version = models.get_version(data)
+        UserMessages(data, maxlen=5)
+        self.assertGreater(models.get_version(data), version)
+        self.assertEqual(data["messages"].maxlen, 5)
+
+    def test_chat(self):
+        data = {}
+        chat = ChatData(data)
+        self.assertIsNone(models.get_version(data))
+        chat.model = "gpt-4"
+        version = models.get_version(data)
+        chat.model = "gpt-4"
+        self.assertEqual(models.get_version(data), version)
+        chat.prompt = "You are a cat."
+        self.assertGreater(models.get_version(data), version)
+
+
 class UserMessagesTest(unittest.TestCase):
     def test_init(self):
         um = UserMessages({}, maxlen=config.conversation.depth)
@@ -80,6 +134,31 @@ class UserMessagesTest(unittest.TestCase):
         um.clear()
         self.assertEqual(len(um.messages), 0)
 
+    def test_tokens(self):
+        data = {"messages": deque([UserMessage("Hello", "Hi")])}
+        um = UserMessages(data, maxlen=2)
+        self.assertEqual(um.tokens_list(), [None])
+
+        um.add("Is it cold today?", "Yep!", tokens=MessageTokens("words/2", 4, 1))
+        um.add("Why?", "Winter", tokens=MessageTokens("words/2", 1, 1))
+        self.assertEqual(
+            um.tokens_list(), [MessageTokens("words/2", 4, 1), MessageTokens("words/2", 1, 1)]
+        )
+        self.assertEqual(data["tokens"], deque(um.tokens_list(), maxlen=2))
+
+        um.pop()
+        self.assertEqual(um.tokens_list(), [MessageTokens("words/2", 4, 1)])
+        um.clear()
+        self.assertEqual(um.tokens_list(), [])
+
+    def test_tokens_out_of_sync(self):
+        data = {
+            "messages": deque([UserMessage("Hello", "Hi")]),
+            "tokens": deque([MessageTokens("words/2", 1, 1), MessageTokens("words/2", 1, 1)]),
+        }
+        um = UserMessages(data, maxlen=3)
+        self.assertEqual(um.tokens_list(), [None])
+
     def test_as_list(self):
         data = {
             "messages": deque(
@@ -90,6 +169,55 @@ class UserMessagesTest(unittest.TestCase):
         self.assertEqual(um.as_list(), [("Hello", "Hi"), ("Is it cold today?", "Yep!")])
 
 
+class PackTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.document = "report.txt:\n```\n" + "Lorem ipsum dolor sit amet. " * 100 + "\n```"
+
+    def test_short(self):
+        data = {}
+        um = UserMessages(data, maxlen=3)
+        um.add("Hello", "Hi")
+        self.assertEqual(data["messages"][0], UserMessage("Hello", "Hi"))
+        self.assertNotIn("blobs", data)
+
+    def test_attachment(self):
+        data = {}
+        um = UserMessages(data, maxlen=3)
+        question = f"Summarize\n\n{self.document}"
+        um.add(question, "It's about lorem ipsum.")
+        stored = data["messages"][0]
+        self.assertIsInstance(stored.question, Packed)
+        self.assertEqual(stored.question.text, "Summarize\n\nreport.txt:")
+        self.assertEqual(len(data["blobs"]), 1)
+        self.assertLess(len(data["blobs"][stored.question.key]), len(question) // 10)
+        self.assertEqual(um.as_list(), [(question, "It's about lorem ipsum.")])
+        self.assertEqual(um.last, (question, "It's about lorem ipsum."))
+
+    def test_dedup(self):
+        data = {}
+        um = UserMessages(data, maxlen=3)
+        um.add(f"Summarize\n\n{self.document}", "Lorem ipsum.")
+        um.add(f"Translate\n\n{self.document}", "Лорем ипсум.")
+        self.assertEqual(len(data["blobs"]), 1)
+
+    def test_long_answer(self):
+        data = {}
+        um = UserMessages(data, maxlen=3)
+        answer = "Lorem ipsum dolor sit amet. " * 100
+        um.add("Say something", answer)
+        self.assertEqual(data["messages"][0].answer, Packed("", data["messages"][0].answer.key))
+        self.assertEqual(um.pop(), ("Say something", answer))
+
+    def test_collect(self):
+        data = {}
+        um = UserMessages(data, maxlen=1)
+        um.add(f"Summarize\n\n{self.document}", "Lorem ipsum.")
+        self.assertEqual(len(data["blobs"]), 1)
+        # the oldest message is evicted along with its blob
+        um.add("Hello", "Hi")
+        self.assertEqual(data["blobs"], {})
+
+
 class TimestampedValueTest(unittest.TestCase):
     def test_init(self):
         data = {}
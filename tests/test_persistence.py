@@ -0,0 +1,158 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from telegram.ext import PicklePersistence
+from bot import models, persistence
+from bot.persistence import SqlitePersistence
+
+
+class SpyConnection:
+    def __init__(self, conn, execute) -> None:
+        self.conn = conn
+        self.execute = execute
+
+
+class SqlitePersistenceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "persistence.db")
+        self.persistence = SqlitePersistence(self.path)
+
+    async def asyncTearDown(self) -> None:
+        await self.persistence.flush()
+        self.dir.cleanup()
+
+    async def reopen(self) -> SqlitePersistence:
+        await self.persistence.flush()
+        self.persistence = SqlitePersistence(self.path)
+        return self.persistence
+
+    async def test_user_data(self):
+        await self.persistence.update_user_data(1, {"messages": ["hello"]})
+        await self.persistence.update_user_data(2, {"messages": ["hi"]})
+        db = await self.reopen()
+        # the data is loaded lazily
+        self.assertEqual(await db.get_user_data(), {})
+        data = {}
+        await db.refresh_user_data(1, data)
+        self.assertEqual(data, {"messages": ["hello"]})
+        # only once
+        data["messages"].append("world")
+        await db.refresh_user_data(1, data)
+        self.assertEqual(data, {"messages": ["hello", "world"]})
+
+    async def test_concurrent_refresh(self):
+        await self.persistence.update_user_data(1, {"messages": ["hello"]})
+        db = await self.reopen()
+        # both updates get the same data dict, loaded once
+        data = {}
+        await asyncio.gather(db.refresh_user_data(1, data), db.refresh_user_data(1, data))
+        self.assertEqual(data, {"messages": ["hello"]})
+        self.assertEqual(db.loading, {})
+
+    async def test_thread(self):
+        threads = set()
+        execute = self.persistence.db.execute
+
+        def spy(*args):
+            threads.add(threading.get_ident())
+            return execute(*args)
+
+        db = self.persistence
+        db.db = SpyConnection(db.db, spy)
+        await db.update_user_data(1, {"messages": ["hello"]})
+        await db.refresh_user_data(2, {})
+        await db.get_conversations("chat")
+        db.db = db.db.conn
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    async def test_chat_data(self):
+        await self.persistence.update_chat_data(-1, {"model": "gpt-4"})
+        db = await self.reopen()
+        self.assertEqual(await db.get_chat_data(), {})
+        data = {}
+        await db.refresh_chat_data(-1, data)
+        self.assertEqual(data, {"model": "gpt-4"})
+        data = {}
+        await db.refresh_chat_data(-2, data)
+        self.assertEqual(data, {})
+
+    async def test_bot_data(self):
+        await self.persistence.update_bot_data({"answer": 42})
+        db = await self.reopen()
+        self.assertEqual(await db.get_bot_data(), {"answer": 42})
+
+    async def test_drop(self):
+        await self.persistence.update_user_data(1, {"messages": ["hello"]})
+        await self.persistence.drop_user_data(1)
+        db = await self.reopen()
+        data = {}
+        await db.refresh_user_data(1, data)
+        self.assertEqual(data, {})
+
+    async def test_unchanged(self):
+        await self.persistence.update_user_data(1, {"messages": ["hello"]})
+        # rows are not rewritten unless the data changes
+        self.persistence.db.execute("update data set value = x'00'")
+        await self.persistence.update_user_data(1, {"messages": ["hello"]})
+        (value,) = self.persistence.db.execute("select value from data").fetchone()
+        self.assertEqual(value, b"\x00")
+
+    async def test_version(self):
+        data = {"messages": ["hello"]}
+        models.touch(data)
+        await self.persistence.update_user_data(1, data)
+        # tracked data is not even serialized unless its version changes
+        data["messages"].append("world")
+        await self.persistence.update_user_data(1, data)
+        db = await self.reopen()
+        loaded = {}
+        await db.refresh_user_data(1, loaded)
+        self.assertEqual(loaded["messages"], ["hello"])
+
+        models.touch(data)
+        await db.update_user_data(1, data)
+        db = await self.reopen()
+        loaded = {}
+        await db.refresh_user_data(1, loaded)
+        self.assertEqual(loaded["messages"], ["hello", "world"])
+
+    async def test_conversations(self):
+        await self.persistence.update_conversation("chat", (1, 2), "state")
+        await self.persistence.update_conversation("chat", (1, 3), "other")
+        await self.persistence.update_conversation("chat", (1, 3), None)
+        db = await self.reopen()
+        self.assertEqual(await db.get_conversations("chat"), {(1, 2): "state"})
+
+
+class CreateTest(unittest.TestCase):
+    def test_create(self):
+        with tempfile.TemporaryDirectory() as dir:
+            db = persistence.create(os.path.join(dir, "persistence.db"))
+            self.assertIsInstance(db, SqlitePersistence)
+            db.db.close()
+            pkl = persistence.create(os.path.join(dir, "persistence.pkl"))
+            self.assertIsInstance(pkl, PicklePersistence)
+
+
+class MigrateTest(unittest.IsolatedAsyncioTestCase):
+    async def test_migrate(self):
+        with tempfile.TemporaryDirectory() as dir:
+            src_path = os.path.join(dir, "persistence.pkl")
+            dst_path = os.path.join(dir, "persistence.db")
+            src = PicklePersistence(filepath=src_path)
+            await src.update_user_data(1, {"messages": ["hello"]})
+            await src.update_chat_data(-1, {"model": "gpt-4"})
+            await src.flush()
+
+            await persistence.migrate(src_path, dst_path)
+            dst = SqlitePersistence(dst_path)
+            user_data, chat_data = {}, {}
+            await dst.refresh_user_data(1, user_data)
+            await dst.refresh_chat_data(-1, chat_data)
+            await dst.flush()
+            self.assertEqual(user_data, {"messages": ["hello"]})
+            self.assertEqual(chat_data, {"model": "gpt-4"})
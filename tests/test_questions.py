@@ -1,19 +1,37 @@
+import codecs
 import datetime as dt
 import unittest
+import httpx
 from telegram import Chat, Document, Message, MessageEntity, User
 from telegram.constants import ChatType
 from telegram.ext import CallbackContext
 
+from bot import ai
 from bot import questions
 from bot.config import config
 from tests.mocks import FakeApplication, FakeBot
 
 
+def mock_download(content: bytes) -> httpx.AsyncClient:
+    """Returns a document download client that responds with the content."""
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=content)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handle))
+
+
 class ExtractPrivateTest(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         self.chat = Chat(id=1, type=ChatType.PRIVATE)
         bot = FakeBot("bot")
-        self.context = CallbackContext(FakeApplication(bot))
+        self.context = CallbackContext(FakeApplication(bot), chat_id=1, user_id=1)
+        self.client = questions.client
+        questions.client = mock_download(b"file content")
+
+    async def asyncTearDown(self):
+        await questions.client.aclose()
+        questions.client = self.client
 
     async def test_text(self):
         message = Message(
@@ -57,8 +75,14 @@ class ExtractGroupTest(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         self.chat = Chat(id=1, type=ChatType.GROUP)
         self.bot = FakeBot("bot")
-        self.context = CallbackContext(FakeApplication(self.bot))
+        self.context = CallbackContext(FakeApplication(self.bot), chat_id=1, user_id=1)
         self.user = User(id=1, first_name="Alice", is_bot=False, username="alice")
+        self.client = questions.client
+        questions.client = mock_download(b"file content")
+
+    async def asyncTearDown(self):
+        await questions.client.aclose()
+        questions.client = self.client
 
     async def test_message(self):
         message = Message(
@@ -190,6 +214,124 @@ class ExtractGroupTest(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(result, "What is this?\n\nfile.txt:\n```\nfile content\n```")
 
 
+class ExtractDocumentTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.chat = Chat(id=1, type=ChatType.PRIVATE)
+        self.context = CallbackContext(FakeApplication(FakeBot("bot")), chat_id=1, user_id=1)
+        self.client = questions.client
+        self.max_bytes = config.documents.max_bytes
+        self.max_tokens = config.documents.max_tokens
+        self.window_share = config.documents.window_share
+
+    async def asyncTearDown(self):
+        if questions.client is not self.client:
+            await questions.client.aclose()
+        questions.client = self.client
+        config.documents.max_bytes = self.max_bytes
+        config.documents.max_tokens = self.max_tokens
+        config.documents.window_share = self.window_share
+
+    async def extract(self, content: bytes) -> str:
+        questions.client = mock_download(content)
+        message = Message(
+            message_id=123,
+            date=dt.datetime.now(),
+            chat=self.chat,
+            document=Document(
+                file_id="f1234", file_unique_id="f1234", file_name="app.log", file_size=1234
+            ),
+        )
+        return await questions.extract_private(message, self.context)
+
+    async def test_max_bytes(self):
+        config.documents.max_bytes = 10
+        result = await self.extract(b"0123456789abcdef")
+        self.assertEqual(result, "app.log:\n```\n0123456789\n```\n[truncated]")
+
+    async def test_max_tokens(self):
+        config.documents.max_tokens = 2
+        result = await self.extract(b"0123456789abcdef")
+        self.assertEqual(result, "app.log:\n```\n01234567\n```\n[truncated]")
+
+    async def test_window_share(self):
+        # the document gets 10 tokens of the window, minus 6 tokens of the default prompt
+        n_input = ai.chat.max_input_tokens(config.openai.model)
+        config.documents.window_share = 10.5 / n_input
+        result = await self.extract(b"0123456789abcdef" * 2)
+        self.assertEqual(result, "app.log:\n```\n0123456789abcdef\n```\n[truncated]")
+
+    async def test_encoding(self):
+        result = await self.extract("café crème".encode("cp1252"))
+        self.assertEqual(result, "app.log:\n```\ncafé crème\n```")
+
+    async def test_binary(self):
+        result = await self.extract(b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR")
+        self.assertEqual(result, "app.log: Unknown binary content")
+
+
+class ReadTextTest(unittest.IsolatedAsyncioTestCase):
+    async def read(self, chunks: list[bytes], max_bytes: int = 1000, max_chars: int = 1000):
+        async def iterate():
+            for chunk in chunks:
+                yield chunk
+
+        return await questions._read_text(iterate(), max_bytes, max_chars)
+
+    async def test_complete(self):
+        result = await self.read([b"hello ", b"world"])
+        self.assertEqual(result, ("hello world", False))
+
+    async def test_stops_early(self):
+        chunks = [b"a" * questions.SAMPLE_SIZE, b"b" * 100, b"c" * 100, b"d" * 100]
+        read = []
+
+        async def iterate():
+            for chunk in chunks:
+                read.append(chunk)
+                yield chunk
+
+        text, is_truncated = await questions._read_text(
+            iterate(), questions.SAMPLE_SIZE + 150, 10000
+        )
+        self.assertEqual(text, "a" * questions.SAMPLE_SIZE + "b" * 100 + "c" * 50)
+        self.assertTrue(is_truncated)
+        self.assertEqual(len(read), 3)
+
+    async def test_max_chars(self):
+        chunks = [b"a" * questions.SAMPLE_SIZE, b"b" * 100, b"c" * 100]
+        text, is_truncated = await self.read(chunks, max_bytes=10000, max_chars=50)
+        self.assertEqual(text, "a" * 50)
+        self.assertTrue(is_truncated)
+
+    async def test_split_character(self):
+        data = "привет".encode("utf-8")
+        result = await self.read([data[:3], data[3:]])
+        self.assertEqual(result, ("привет", False))
+
+    async def test_cut_character(self):
+        # the byte limit falls in the middle of a character
+        result = await self.read(["привет".encode("utf-8")], max_bytes=5)
+        self.assertEqual(result, ("пр", True))
+
+    async def test_bom(self):
+        result = await self.read(["hello".encode("utf-16")])
+        self.assertEqual(result, ("hello", False))
+        result = await self.read([codecs.BOM_UTF8 + b"hello"])
+        self.assertEqual(result, ("hello", False))
+
+    async def test_fallback(self):
+        result = await self.read([b"caf\xe9"])
+        self.assertEqual(result, ("café", False))
+
+    async def test_binary(self):
+        result = await self.read([b"\x00\x01\x02"])
+        self.assertEqual(result, (None, False))
+
+    async def test_empty(self):
+        result = await self.read([])
+        self.assertEqual(result, ("", False))
+
+
 class TestPrepare(unittest.TestCase):
     def test_ordinary(self):
         question, is_follow_up = questions.prepare("How are you?")
@@ -0,0 +1,87 @@
+import asyncio
+import unittest
+from telegram import Chat, Message, Update
+from telegram.constants import ChatType
+
+from bot.scheduler import ChatUpdateProcessor
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(id=chat_id, type=ChatType.PRIVATE)
+    message = Message(message_id=update_id, date=None, chat=chat, text="hello")
+    return Update(update_id=update_id, message=message)
+
+
+class ChatUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.events = []
+
+    async def handle(self, name: str, delay: float = 0.01) -> None:
+        self.events.append(f"{name}+")
+        await asyncio.sleep(delay)
+        self.events.append(f"{name}-")
+
+    async def test_same_chat(self):
+        processor = ChatUpdateProcessor(concurrency=4)
+        await asyncio.gather(
+            processor.process_update(make_update(1, 1), self.handle("a1")),
+            processor.process_update(make_update(2, 1), self.handle("a2")),
+            processor.process_update(make_update(3, 1), self.handle("a3")),
+        )
+        self.assertEqual(self.events, ["a1+", "a1-", "a2+", "a2-", "a3+", "a3-"])
+
+    async def test_different_chats(self):
+        processor = ChatUpdateProcessor(concurrency=4)
+        await asyncio.gather(
+            processor.process_update(make_update(1, 1), self.handle("a")),
+            processor.process_update(make_update(2, 2), self.handle("b")),
+        )
+        self.assertEqual(self.events, ["a+", "b+", "a-", "b-"])
+
+    async def test_concurrency(self):
+        processor = ChatUpdateProcessor(concurrency=2)
+        await asyncio.gather(
+            processor.process_update(make_update(1, 1), self.handle("a", delay=0.01)),
+            processor.process_update(make_update(2, 2), self.handle("b", delay=0.05)),
+            processor.process_update(make_update(3, 3), self.handle("c", delay=0.1)),
+        )
+        self.assertEqual(self.events, ["a+", "b+", "a-", "c+", "b-", "c-"])
+
+    async def test_round_robin(self):
+        processor = ChatUpdateProcessor(concurrency=1)
+        await asyncio.gather(
+            processor.process_update(make_update(1, 1), self.handle("a1")),
+            processor.process_update(make_update(2, 1), self.handle("a2")),
+            processor.process_update(make_update(3, 1), self.handle("a3")),
+            processor.process_update(make_update(4, 2), self.handle("b1")),
+        )
+        # the second chat does not wait for all the updates from the first one
+        self.assertEqual(
+            [event for event in self.events if event.endswith("+")], ["a1+", "b1+", "a2+", "a3+"]
+        )
+
+    async def test_cancelled(self):
+        processor = ChatUpdateProcessor(concurrency=1)
+        first = asyncio.create_task(processor.process_update(make_update(1, 1), self.handle("a")))
+        coroutine = self.handle("b")
+        second = asyncio.create_task(processor.process_update(make_update(2, 2), coroutine))
+        third = asyncio.create_task(processor.process_update(make_update(3, 3), self.handle("c")))
+        await asyncio.sleep(0)
+        second.cancel()
+        await asyncio.gather(first, third)
+        self.assertTrue(second.cancelled())
+        # the coroutine is closed, not left unawaited
+        self.assertIsNone(coroutine.cr_frame)
+        self.assertEqual(self.events, ["a+", "a-", "c+", "c-"])
+        self.assertEqual(processor.pending, {})
+        self.assertEqual(processor.running, set())
+
+    async def test_error(self):
+        async def fail():
+            raise ValueError("failed")
+
+        processor = ChatUpdateProcessor(concurrency=1)
+        with self.assertRaises(ValueError):
+            await processor.process_update(make_update(1, 1), fail())
+        await processor.process_update(make_update(2, 1), self.handle("a"))
+        self.assertEqual(self.events, ["a+", "a-"])
@@ -0,0 +1,114 @@
+import asyncio
+import time
+import unittest
+from telegram.error import RetryAfter
+
+from bot.sender import FloodLimiter, Window
+
+
+class WindowTest(unittest.TestCase):
+    def test_delay(self):
+        window = Window(limit=2, period=0.05)
+        self.assertEqual(window.delay(), 0)
+        window.add()
+        self.assertEqual(window.delay(), 0)
+        window.add()
+        self.assertGreater(window.delay(), 0)
+        time.sleep(0.05)
+        self.assertEqual(window.delay(), 0)
+        self.assertEqual(len(window.times), 0)
+
+
+class FloodLimiterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.limiter = FloodLimiter()
+        self.sent = []
+
+    async def send(self, text: str, delay: float = 0) -> dict:
+        await asyncio.sleep(delay)
+        self.sent.append(text)
+        return {"text": text}
+
+    def request(self, endpoint: str, data: dict, delay: float = 0):
+        return self.limiter.process_request(
+            callback=self.send,
+            args=(data.get("text"), delay),
+            kwargs={},
+            endpoint=endpoint,
+            data=data,
+            rate_limit_args=None,
+        )
+
+    async def test_send(self):
+        result = await self.request("sendMessage", {"chat_id": 1, "text": "hello"})
+        self.assertEqual(result, {"text": "hello"})
+        self.assertEqual(self.limiter.locks, {})
+        self.assertEqual(self.limiter.n_pending, {})
+
+    async def test_order(self):
+        await asyncio.gather(
+            self.request("sendMessage", {"chat_id": 1, "text": "a1"}, delay=0.02),
+            self.request("sendMessage", {"chat_id": 1, "text": "a2"}),
+            self.request("sendMessage", {"chat_id": 2, "text": "b1"}),
+        )
+        # the same chat takes turns, while the other one does not wait
+        self.assertEqual(self.sent, ["b1", "a1", "a2"])
+
+    async def test_coalesce_edits(self):
+        results = await asyncio.gather(
+            self.request("sendMessage", {"chat_id": 1, "text": "one"}, delay=0.01),
+            self.request("editMessageText", {"chat_id": 1, "message_id": 5, "text": "one two"}),
+            self.request("editMessageText", {"chat_id": 1, "message_id": 6, "text": "other"}),
+            self.request("editMessageText", {"chat_id": 1, "message_id": 5, "text": "one two 3"}),
+        )
+        self.assertEqual(self.sent, ["one", "other", "one two 3"])
+        self.assertTrue(results[1])
+        self.assertEqual(self.limiter.edits, {})
+
+    async def test_retry_after(self):
+        n_calls = 0
+
+        async def send() -> bool:
+            nonlocal n_calls
+            n_calls += 1
+            if n_calls == 1:
+                raise RetryAfter(0)
+            return True
+
+        result = await self.limiter.process_request(
+            send, (), {}, "sendMessage", {"chat_id": -1}, None
+        )
+        self.assertTrue(result)
+        self.assertEqual(n_calls, 2)
+
+    async def test_retry_after_exhausted(self):
+        async def send() -> bool:
+            raise RetryAfter(0)
+
+        self.limiter.max_retries = 1
+        with self.assertRaises(RetryAfter):
+            await self.limiter.process_request(send, (), {}, "sendMessage", {"chat_id": 1}, None)
+        self.assertEqual(self.limiter.locks, {})
+
+    async def test_group_limit(self):
+        await self.request("sendMessage", {"chat_id": -100, "text": "a"})
+        await self.request("sendChatAction", {"chat_id": -100})
+        await self.request("sendMessage", {"chat_id": 100, "text": "b"})
+        self.assertEqual(len(self.limiter.groups[-100].times), 1)
+        self.assertNotIn(100, self.limiter.groups)
+        self.assertEqual(len(self.limiter.overall.times), 2)
+
+    async def test_other_requests(self):
+        await self.request("getUpdates", {"timeout": 10})
+        await self.request("answerCallbackQuery", {"callback_query_id": "1"})
+        await self.request("sendMessage", {"chat_id": 1, "text": "a"})
+        self.assertEqual(len(self.limiter.overall.times), 1)
+
+    async def test_prune_groups(self):
+        self.limiter.groups[-100] = window = Window(limit=20, period=0.01)
+        window.add()
+        await asyncio.sleep(0.01)
+        self.limiter.pruned_at = 0
+        await self.request("sendMessage", {"chat_id": -200, "text": "a"})
+        self.assertNotIn(-100, self.limiter.groups)
+        self.assertIn(-200, self.limiter.groups)